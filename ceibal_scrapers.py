@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
-import json
-import requests
 import re
-import youtube_dl
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
 from bs4 import BeautifulSoup
-from ricecooker.utils import downloader
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
 from le_utils.constants import content_kinds
 from gdrive_scraper import GoogleDriveScraper
 from pages import HTMLPageScraper, PresentationScraper, BasicPageScraper, ImageScraper, WebVideoScraper, VideoScraper, AudioScraper
 from tags import ImageTag, MediaTag
+from utils import EXCEPTIONS, UnscrapableSourceException, find_matches, rewrite_matches
+import fetch
+import settings
 
 ######### CUSTOM TAGS #########
 
@@ -25,7 +28,8 @@ class CeibalVideoAudioTag(MediaTag):
             source_tag = self.create_tag('source')
             audio_tag.append(source_tag)
             source_tag['src'] = self.write_url(self.link)
-            self.tag.replaceWith(audio_tag)
+            self.replace_tag(audio_tag)
+            self.replace_tag(self.split_media(self.tag))
 
 class CeibalVideoTag(MediaTag):
     default_ext = '.mp4'
@@ -38,13 +42,13 @@ class CeibalVideoTag(MediaTag):
         try:
             video_tag = self.create_tag('video')
             video_tag['style'] = 'margin-left: auto; margin-right: auto; width: 500px;'
-            video_tag['preload'] = 'auto'
             video_tag['controls'] = 'controls'
             for source in self.tag.find_all('source'):
                 source_tag = self.create_tag('source')
                 source_tag['src'] = self.write_url(source['src'])
                 video_tag.append(source_tag)
-            self.tag.replaceWith(video_tag)
+            self.replace_tag(video_tag)
+            self.replace_tag(self.split_media(self.tag))
         except Exception as e:
             LOGGER.warn('Cannot parse video at {} ({})'.format(self.url, str(e)))
 
@@ -60,8 +64,9 @@ class CeibalAudioTag(MediaTag):
             audio_tag['style'] = 'margin-left: auto; margin-right: auto;'
             source_tag = self.create_tag('source')
             audio_tag.append(source_tag)
-            source['src'] = self.write_url(self.tag.find('audio')['src'])
-            self.tag.replaceWith(audio_tag)
+            source_tag['src'] = self.write_url(self.tag.find('audio')['src'])
+            self.replace_tag(audio_tag)
+            self.replace_tag(self.split_media(self.tag))
         except Exception as e:
             LOGGER.warn('Cannot parse audio at {}'.format(self.url, str(e)))
 
@@ -81,10 +86,20 @@ class ThingLinkTag(ImageTag):
 
 ######### CUSTOM SCRAPERS #########
 
+THINGLINK_API_URL = 'https://www.thinglink.com/api/tags?url={}'
+NUBBIN_URL = 'https://cdn.thinglink.me/api/nubbin/{}/{}'
+NUBBIN_VARIANTS = ('plain', 'highlight', 'hover', 'hoverlink')
+PRELOAD_IMAGES_REGEX = re.compile(r"(?:'|\")([^'\"]+)(?:'|\"),")
+SCRIPT_URL_REGEX = re.compile(r"url\s*=\s*(?:'|\")([^'\"]+)(?:'|\")")
+VAR_URL_REGEX = re.compile(r"var url\s*=\s*(?:'|\")([^'\"]+)(?:'|\")")
+DORESIZE_REGEX = re.compile(r'\$tlJQ\(document\)\.ready\(function\(\) \{\s+(doresize\(\);)')
+STYLE_URL_REGEX = re.compile(r"\((?:'|\")*(http[^'\"]+)(?:'|\")*\)")
+
 class ThingLinkScraper(HTMLPageScraper):
     partially_scrapable = True
     loadjs = True
     scrape_subpages = False
+    embed_script_version = 1    # Bump when patch_embed_script changes
     omit_list = [
         ('nav', {'class': 'item-header'}),
     ]
@@ -98,39 +113,67 @@ class ThingLinkScraper(HTMLPageScraper):
 
         for script in contents.find_all('script'):
             if script.get('src') and 'embed.js' in script['src']:
-                response = requests.get('https://www.thinglink.com/api/tags?url={}'.format(thinglink_id))
-                script_contents = downloader.read(self.get_relative_url(script['src'])).decode('utf-8')
-                tag_data = json.loads(response.content)
+                tag_data = fetch.read_json(THINGLINK_API_URL.format(thinglink_id))
 
                 if tag_data[thinglink_id].get('image'):
                     tag_data[thinglink_id]['image'] = ImageScraper(tag_data[thinglink_id]['image'], zipper=self.zipper).to_zip()
 
-                for thing in tag_data[thinglink_id]['things']:
-                    if thing['thingUrl']:
-                        try:
-                            thing['thingUrl'] = WebVideoScraper(thing['thingUrl'], zipper=self.zipper).to_zip()
-                            thing['contentUrl'] = thing['thingUrl']
-                            thing['icon'] = ImageScraper(thing['icon'], zipper=self.zipper).to_zip()
-                        except youtube_dl.utils.DownloadError as e:
-                            LOGGER.warning('Youtube download error on thinglink page ({})'.format(str(e)))
-                    if thing.get('nubbin'):
-                        self.write_url('https://cdn.thinglink.me/api/nubbin/{}/plain'.format(thing['nubbin']), filename='nubbin-{}-plain.png'.format(thing['nubbin']), directory="thinglink")
-                        self.write_url('https://cdn.thinglink.me/api/nubbin/{}/highlight'.format(thing['nubbin']), filename='nubbin-{}-highlight.png'.format(thing['nubbin']), directory="thinglink")
-                        self.write_url('https://cdn.thinglink.me/api/nubbin/{}/hover'.format(thing['nubbin']), filename='nubbin-{}-hover.png'.format(thing['nubbin']), directory="thinglink")
-                        self.write_url('https://cdn.thinglink.me/api/nubbin/{}/hoverlink'.format(thing['nubbin']), filename='nubbin-{}-hoverlink.png'.format(thing['nubbin']), directory="thinglink")
-
-                script_contents = script_contents.replace('d.ajax({url:A+"/api/tags",data:u,dataType:"jsonp",success:z})', 'z({})'.format(json.dumps(tag_data)))
-                script_contents = script_contents.replace('n.getJSON(A+"/api/internal/logThingAccess?callback=?",{thing:y,sceneId:w,e:"hover",referer:t.referer,dwell:v});', '')
-                script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logThingAccess?callback=?",{time:y,sceneId:v,thing:w,e:"hoverend",referer:t.referer})', '')
-                script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logSceneAccess?callback=?",{time:z,sceneId:w,referer:t.referer,dwell:v,event:"scene.hover"})', '')
-                script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logSceneAccess?callback=?",{sceneId:v,referer:t.referer,event:"scene.view",channelId:b.getChannelId(x)})', '')
-                script_contents = script_contents.replace('n.getJSON(B+"/api/internal/logThingAccess?callback=?",z,C);', '')
-
-                icon_str = 'k.src=l;return"style=\\"background-image: url(\'"+l+"\') !important;\\"'
-                script_contents = script_contents.replace(icon_str, 'var slices=l.split("/"); l="thinglink/"+slices.slice(slices.length-3,slices.length).join("-")+".png";{}'.format(icon_str))
-                script['src'] = self.write_contents('thinglink-{}-embed.js'.format(thinglink_id), script_contents, directory="thinglink")
+                # Nubbins, videos and icons are shared between things (and scenes), so fetch each one once and in parallel
+                things = tag_data[thinglink_id]['things']
+                self.write_nubbins(thing['nubbin'] for thing in things if thing.get('nubbin'))
+                videos = self.write_videos(thing['thingUrl'] for thing in things if thing.get('thingUrl'))
+                icons = self.write_urls([thing.get('icon') for thing in things if videos.get(thing.get('thingUrl'))],
+                    directory=ImageScraper.directory, default_ext=ImageScraper.default_ext)
+                for thing in things:
+                    if videos.get(thing.get('thingUrl')):
+                        thing['thingUrl'] = videos[thing['thingUrl']]
+                        thing['contentUrl'] = thing['thingUrl']
+                        thing['icon'] = icons.get(thing.get('icon'), thing.get('icon'))
+
+                script.insert_before(self.create_data_script('__thinglinkData', tag_data))
+                script['src'] = self.write_patched_script(script['src'], self.patch_embed_script, self.embed_script_version, directory="thinglink")
                 self.mark_tag_to_skip(script)
 
+    def patch_embed_script(self, script_contents):
+        """ Makes embed.js read the scene from window.__thinglinkData and load nubbins/icons from the zip """
+        script_contents = script_contents.replace('d.ajax({url:A+"/api/tags",data:u,dataType:"jsonp",success:z})', 'z(window.__thinglinkData)')
+        script_contents = script_contents.replace('n.getJSON(A+"/api/internal/logThingAccess?callback=?",{thing:y,sceneId:w,e:"hover",referer:t.referer,dwell:v});', '')
+        script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logThingAccess?callback=?",{time:y,sceneId:v,thing:w,e:"hoverend",referer:t.referer})', '')
+        script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logSceneAccess?callback=?",{time:z,sceneId:w,referer:t.referer,dwell:v,event:"scene.hover"})', '')
+        script_contents = script_contents.replace('n.getJSON(t.getApiBaseUrl()+"/api/internal/logSceneAccess?callback=?",{sceneId:v,referer:t.referer,event:"scene.view",channelId:b.getChannelId(x)})', '')
+        script_contents = script_contents.replace('n.getJSON(B+"/api/internal/logThingAccess?callback=?",z,C);', '')
+
+        icon_str = 'k.src=l;return"style=\\"background-image: url(\'"+l+"\') !important;\\"'
+        return script_contents.replace(icon_str, 'var slices=l.split("/"); l="thinglink/"+slices.slice(slices.length-3,slices.length).join("-")+".png";{}'.format(icon_str))
+
+    def write_nubbins(self, nubbins):
+        nubbin_files = OrderedDict()
+        for nubbin in sorted(set(nubbins)):
+            for variant in NUBBIN_VARIANTS:
+                # embed.js is patched to load nubbins from thinglink/nubbin-<id>-<variant>.png
+                filename = 'nubbin-{}-{}.png'.format(nubbin, variant)
+                if not self.zipper.contains('thinglink/{}'.format(filename)):
+                    nubbin_files[NUBBIN_URL.format(nubbin, variant)] = filename
+
+        for url, contents in fetch.fetch_all(nubbin_files).items():
+            if isinstance(contents, Exception):
+                LOGGER.warning('Unable to download thinglink nubbin {} ({})'.format(url, str(contents)))
+            else:
+                self.write_contents(nubbin_files[url], contents, directory="thinglink")
+
+    def write_videos(self, urls):
+        """ Downloads videos in parallel, returning {url: zip path} (None for videos that couldn't be downloaded) """
+        import youtube_dl
+        def write_video(url):
+            try:
+                return WebVideoScraper(url, zipper=self.zipper).to_zip()
+            except (youtube_dl.utils.DownloadError, UnscrapableSourceException) + EXCEPTIONS as e:
+                LOGGER.warning('Youtube download error on thinglink page ({})'.format(str(e)))
+
+        urls = list(OrderedDict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=settings.FETCH_WORKERS) as pool:
+            return dict(zip(urls, pool.map(fetch.propagate(write_video), urls)))
+
     def postprocess(self, contents):
         style_tag = self.create_tag('style')
         style_tag.string = '.tlExceededViewsLimit, .tlThingText:not(.tlVariantVideoThing) .tlThingClose, .tlSidebar, .tlThinglinkSite {visibility: hidden !important;} .tlFourDotsButton, .btnViewOnSS {pointer-events: none;} .tlFourDotsButton .btn, .tlFourDotsButton .arrowRight {display: none !important;}'
@@ -139,27 +182,17 @@ class ThingLinkScraper(HTMLPageScraper):
             if not script.string or 'skip-scrape' in (script.get('class') or []):
                 continue
             elif 'preloadImages' in script.string:
-                regex = r"(?:'|\")([^'\"]+)(?:'|\"),"
-                for match in re.finditer(regex, script.string, re.MULTILINE):
-                    new_str = match.group(0).replace(match.group(1), self.write_url(match.group(1), default_ext=".png", directory="thinglink"))
-                    script.string = script.text.replace(match.group(0), new_str)
-            elif re.search(r"var url\s*=\s*(?:'|\")([^'\"]+)(?:'|\")", script.string, re.MULTILINE):
-                regex = r"url\s*=\s*(?:'|\")([^'\"]+)(?:'|\")"
-                for match in re.finditer(regex, script.string, re.MULTILINE):
-                    new_str = match.group(0).replace(match.group(1), self.write_url(match.group(1), default_ext=".png", directory="thinglink"))
-                    script.string = script.text.replace(match.group(0), new_str)
+                script.string = self.rewrite_urls(PRELOAD_IMAGES_REGEX, script.string, default_ext=".png", directory="thinglink")
+            elif VAR_URL_REGEX.search(script.string):
+                script.string = self.rewrite_urls(SCRIPT_URL_REGEX, script.string, default_ext=".png", directory="thinglink")
             elif 'doresize' in script.string:
-                match = re.search(r'\$tlJQ\(document\)\.ready\(function\(\) \{\s+(doresize\(\);)', script.string)
-                new_str = match.group(0).replace(match.group(1), 'doresize(); __thinglink.reposition(); __thinglink.rebuild();')
-                script.string = script.text.replace(match.group(0), new_str)
+                script.string = rewrite_matches(DORESIZE_REGEX, script.string, lambda call: 'doresize(); __thinglink.reposition(); __thinglink.rebuild();')
 
-        for nubbin in contents.find_all('div', {'class': 'nubbin'}):
-            for subnubbin in nubbin.find_all('div'):
-                if not subnubbin.get('style'):
-                    continue
-                regex = r"\((?:'|\")*(http[^'\"]+)(?:'|\")*\)"
-                for match in re.finditer(regex, subnubbin['style'], re.MULTILINE):
-                    subnubbin['style'] = subnubbin['style'].replace(match.group(1), self.write_url(match.group(1), default_ext=".png", directory="thinglink"))
+        # Download the images of every nubbin at once, then point their styles to the zip
+        subnubbins = [subnubbin for nubbin in contents.find_all('div', {'class': 'nubbin'}) for subnubbin in nubbin.find_all('div') if subnubbin.get('style')]
+        paths = self.write_urls([link for subnubbin in subnubbins for link in find_matches(STYLE_URL_REGEX, subnubbin['style'])], default_ext=".png", directory="thinglink")
+        for subnubbin in subnubbins:
+            subnubbin['style'] = rewrite_matches(STYLE_URL_REGEX, subnubbin['style'], paths.get)
 
 
 class EducaplayScraper(HTMLPageScraper):
@@ -170,6 +203,7 @@ class EducaplayScraper(HTMLPageScraper):
         ('ins', {'class': 'adsbygoogle'})
     ]
     media_directory = "media"
+    events_script_version = 1   # Bump when patch_events_script changes
 
     @classmethod
     def test(self, url):
@@ -178,14 +212,16 @@ class EducaplayScraper(HTMLPageScraper):
     def preprocess(self, contents):
         for script in contents.find_all('script'):
             if script.get('src') and 'xapiEventos.js' in script['src']:
-                script_contents = downloader.read(self.get_relative_url(script['src'])).decode('utf-8')
-                script_contents = script_contents.replace('img.src=rutaRecursos+imagen;', 'img.src = "img/" + imagen;');
-                script_contents = script_contents.replace('/snd_html5/', '{}/-snd_html5-'.format(self.media_directory))
-                script['src'] = self.write_contents(self.get_filename(self.url, default_ext='.js'), script_contents, directory="js")
+                script['src'] = self.write_patched_script(script['src'], self.patch_events_script, self.events_script_version, directory="js")
                 self.mark_tag_to_skip(script)
             elif script.string and 'socializarPage' in script.string:
                 script.decompose()  # Remove share on social media links
 
+    def patch_events_script(self, script_contents):
+        """ Makes xapiEventos.js load images and sounds from the zip """
+        script_contents = script_contents.replace('img.src=rutaRecursos+imagen;', 'img.src = "img/" + imagen;')
+        return script_contents.replace('/snd_html5/', '{}/-snd_html5-'.format(self.media_directory))
+
     def postprocess(self, contents):
         style_tag = self.create_tag('style')
         style_tag.string = '#banner { display: none !important; }'
@@ -196,8 +232,12 @@ class EducaplayScraper(HTMLPageScraper):
             self.mark_tag_to_skip(audio)
 
 
+GENIALLY_API_URL = 'https://view.genial.ly/api/view/{}'
+HTML_IMG_SRC_REGEX = re.compile(r"""(<img\b[^>]*?\ssrc\s*=\s*)(["'])(.*?)\2""", re.IGNORECASE | re.DOTALL)
+
 class GeniallyScraper(HTMLPageScraper):
     scrape_subpages = False
+    main_script_version = 1     # Bump when patch_main_script changes
 
     @classmethod
     def test(self, url):
@@ -212,32 +252,48 @@ class GeniallyScraper(HTMLPageScraper):
 
         # Prefetch API response and replace script content accordingly
         genial_id = self.url.split('/')[-1]
-        response = requests.get('https://view.genial.ly/api/view/{}'.format(genial_id))
         for script in contents.find_all('script'):
             if script.get('src') and 'main' in script['src']:
-                script_contents = downloader.read(self.get_relative_url(script['src'])).decode('utf-8')
-                genial_data = json.loads(response.content)
+                genial_data = fetch.read_json(GENIALLY_API_URL.format(genial_id))
 
                 if len(genial_data['Videos']) or len(genial_data['Audios']):
-                    LOGGER.error('Unhandled genial.ly video or audio at {}'.format(url))
+                    LOGGER.error('Unhandled genial.ly video or audio at {}'.format(self.url))
+
+                # Images are often repeated across slides, so fetch each one once and in parallel
+                code_images = [[unescape(match.group(3)) for match in HTML_IMG_SRC_REGEX.finditer(code['HtmlCode'])] for code in genial_data['Contents']]
+                images = self.write_urls(
+                    [genial_data['Genially']['ImageRender']]
+                    + [image['Source'] for image in genial_data['Images']]
+                    + [slide['Background'] for slide in genial_data['Slides']]
+                    + [src for srcs in code_images for src in srcs],
+                    directory='webimg'
+                )
 
                 if genial_data['Genially']['ImageRender']:
-                    genial_data['Genially']['ImageRender'] = self.write_url(genial_data['Genially']['ImageRender'], directory='webimg')
+                    genial_data['Genially']['ImageRender'] = images.get(genial_data['Genially']['ImageRender'], genial_data['Genially']['ImageRender'])
                 for image in genial_data['Images']:
-                    image['Source'] = self.write_url(image['Source'], directory='webimg')
+                    image['Source'] = images.get(image['Source'], image['Source'])
                 for slide in genial_data['Slides']:
-                    slide['Background'] = self.write_url(slide['Background'], directory='webimg')
+                    slide['Background'] = images.get(slide['Background'], slide['Background'])
                 for code in genial_data['Contents']:
-                    code_contents = BeautifulSoup(code['HtmlCode'], 'html.parser')
-                    for img in code_contents.find_all('img'):
-                        try:
-                            img['src'] = self.write_url(img['src'], directory='webimg')
-                        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as e:
-                            LOGGER.warning("Error processing genial.ly at {} ({})".format(url, str(e)))
-                    code['HtmlCode'] = code_contents.prettify()
-                script_contents = script_contents.replace('r.a.get(c).then(function(e){return n(e.data)})', 'n({})'.format(json.dumps(genial_data)))
+                    code['HtmlCode'] = self.rewrite_image_sources(code['HtmlCode'], images)
+
+                script.insert_before(self.create_data_script('__geniallyData', genial_data))
                 script['class'] = ['skip-scrape']
-                script['src'] = self.write_contents('genial-{}-embed.js'.format(genial_id), script_contents,  directory="js")
+                script['src'] = self.write_patched_script(script['src'], self.patch_main_script, self.main_script_version, directory="js")
+
+    def patch_main_script(self, script_contents):
+        """ Makes the main bundle read the genial from window.__geniallyData instead of the API """
+        return script_contents.replace('r.a.get(c).then(function(e){return n(e.data)})', 'n(window.__geniallyData)')
+
+    def rewrite_image_sources(self, html, images):
+        """ Points the <img> tags in an HtmlCode block to their zip paths (leaving the rest of the markup untouched) """
+        def replace(match):
+            src = unescape(match.group(3))
+            if src not in images:
+                return match.group(0)
+            return '{0}{1}{2}{1}'.format(match.group(1), match.group(2), images[src])
+        return HTML_IMG_SRC_REGEX.sub(replace, html)
 
 
 class SlideShareScraper(PresentationScraper):
@@ -258,13 +314,13 @@ class EasellyScraper(ImageScraper):
         return 'easel.ly' in url
 
     def _download_file(self, write_to_path):
-        contents = BeautifulSoup(downloader.read(self.url), 'html5lib')
+        contents = BeautifulSoup(fetch.read(self.url), 'html5lib')
         easel = contents.find('div', {'id': 'easelly-frame'}).find('img')
         with open(write_to_path, 'wb') as fobj:
-            fobj.write(downloader.read(easel['src']))
+            fobj.write(fetch.read(easel['src']))
 
     def to_zip(self, filename=None):
-        contents = BeautifulSoup(downloader.read(self.url), 'html5lib')
+        contents = BeautifulSoup(fetch.read(self.url), 'html5lib')
         easel = contents.find('div', {'id': 'easelly-frame'}).find('img')
         return self.write_url(easel['src'], filename=filename)
 
@@ -277,7 +333,7 @@ class WeVideoScraper(VideoScraper):
     def _download_file(self, write_to_path):
         video_id = self.url.split('#')[1]
         with open(write_to_path, 'wb') as fobj:
-            fobj.write(downloader.read('https://www.wevideo.com/api/2/media/{}/content'.format(video_id)))
+            fobj.write(fetch.read('https://www.wevideo.com/api/2/media/{}/content'.format(video_id)))
 
     def to_zip(self, filename=None):
         video_id = self.url.split('#')[1]
@@ -292,7 +348,7 @@ class IVooxScraper(AudioScraper):
     def _download_file(self, write_to_path):
         audio_id = re.search(r'(?:player_ek_)([^_]+)(?:_2_1\.html)', self.url).group(1)
         with open(write_to_path, 'wb') as fobj:
-            fobj.write(downloader.read('http://www.ivoox.com/listenembeded_mn_{}_1.m4a?source=EMBEDEDHTML5'.format(audio_id)))
+            fobj.write(fetch.read('http://www.ivoox.com/listenembeded_mn_{}_1.m4a?source=EMBEDEDHTML5'.format(audio_id)))
 
     def to_zip(self, filename=None):
         audio_id = re.search(r'(?:player_ek_)([^_]+)(?:_2_1\.html)', self.url).group(1)
@@ -326,7 +382,6 @@ class WikipediaScraper(HTMLPageScraper):
             if popup.get('videopayload'):
                 video = BeautifulSoup(popup['videopayload'], 'html.parser')
                 video.video['style'] = 'width: 100%; height: auto;'
-                video.video['preload'] = 'auto'
                 self.mark_tag_to_skip(video.video)
                 for source in video.find_all('source'):
                     try:
@@ -373,7 +428,7 @@ class SoundCloudScraper(WebVideoScraper):
     def to_tag(self, filename=None):
         # Get image if there is one
         div = self.create_tag('div')
-        contents = BeautifulSoup(downloader.read(self.url, loadjs=True), 'html5lib')
+        contents = BeautifulSoup(fetch.read(self.url, loadjs=True), 'html5lib')
         image = contents.find('div', {'class': 'sc-artwork'})
         if image:
             url = re.search(r'background-image:url\(([^\)]+)\)', image.find('span')['style']).group(1)
@@ -391,6 +446,9 @@ class SoundCloudScraper(WebVideoScraper):
 
         return div
 
+RECURSOSTIC_SRC_REGEX = re.compile(r'(?:src)=(?:\'|\")([^\'\"]+)(?:\'|\")')
+RECURSOSTIC_LOCATION_REGEX = re.compile(r"onclick=\\(?:'|\")parent\.location\s*=\s*(?:'|\")([^'\"]+)(?:'|\")")
+
 class RecursosticScraper(HTMLPageScraper):
 
     @classmethod
@@ -400,15 +458,11 @@ class RecursosticScraper(HTMLPageScraper):
     def postprocess(self, contents):
         for script in contents.find_all('script'):
             if script.string:
-                script.string = script.text.replace('background="HalfBakedBG.gif"', '')
-                for match in re.finditer(r'(?:src)=(?:\'|\")([^\'\"]+)(?:\'|\")', script.string, re.MULTILINE):
-                    img_filename = match.group(1).split('?')[0].split('/')[-1][-20:]
-                    script.string = script.text.replace(match.group(1), self.write_url(match.group(1), directory="webimg"))
-                for match in re.finditer(r"onclick=\\(?:'|\")parent\.location\s*=\s*(?:'|\")([^'\"]+)(?:'|\")", script.string, re.MULTILINE):
-                    page_filename = 'recursostic-{}'.format(match.group(1).split('?')[0].split('/')[-1])
-                    page = BeautifulSoup(downloader.read(self.get_relative_url(match.group(1))), 'html5lib')
-                    page_link = RecursosticScraper(self.get_relative_url(match.group(1)), zipper=self.zipper, locale=self.locale).to_zip()
-                    script.string = script.text.replace(match.group(1), page_link)
+                script_contents = script.string.replace('background="HalfBakedBG.gif"', '')
+                script_contents = self.rewrite_urls(RECURSOSTIC_SRC_REGEX, script_contents, directory="webimg")
+                script_contents = rewrite_matches(RECURSOSTIC_LOCATION_REGEX, script_contents,
+                    lambda link: self.scrape_subpage(RecursosticScraper, self.get_relative_url(link)))
+                script.string = script_contents
 
 
 class DisfrutalasmatematicasScraper(HTMLPageScraper):
@@ -508,6 +562,7 @@ class ContenidosScraper(HTMLPageScraper):
 
 class CeibalPageScraper(HTMLPageScraper):
     color = "#2E72B0"
+    cacheable = False   # Resource pages only belong to one zip
     extra_tags = [
         CeibalVideoAudioTag,
         CeibalVideoTag,
@@ -550,7 +605,7 @@ class CeibalPageScraper(HTMLPageScraper):
     def preprocess(self, contents):
         # Some scripts only load if there's a video on the page
         if 'rea.ceibal.edu.uy' in self.url and contents.find('video'):
-            contents = BeautifulSoup(downloader.read(self.url, loadjs=True), 'html5lib')
+            contents = BeautifulSoup(fetch.read(self.url, loadjs=True), 'html5lib')
 
         for block in contents.find_all('div', {'class': 'iDevice_content'}):
             block['style'] = 'word-break: break-word;'
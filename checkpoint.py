@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Channel tree checkpoints
+
+    The tree built by crawling the site is saved as json (titles, source ids, licenses, tags,
+    thumbnails and file paths), so it can be rebuilt without crawling again (e.g. to retry an
+    upload or fix metadata by editing the checkpoint)
+"""
+import json
+import os
+from ricecooker.classes import nodes, files, licenses
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+from le_utils.constants import content_kinds
+
+import storage
+
+# Node classes to rebuild, by content kind
+NODE_CLASSES = {
+    content_kinds.TOPIC: nodes.TopicNode,
+    content_kinds.HTML5: nodes.HTML5AppNode,
+    content_kinds.VIDEO: nodes.VideoNode,
+    content_kinds.AUDIO: nodes.AudioNode,
+    content_kinds.DOCUMENT: nodes.DocumentNode,
+}
+
+
+def serialize_license(license):
+    if not license:
+        return None
+    return {'id': license.license_id, 'copyright_holder': license.copyright_holder or ''}
+
+def serialize_node(node):
+    thumbnail = node.thumbnail.path if isinstance(node.thumbnail, files.ThumbnailFile) else node.thumbnail
+    data = {
+        'kind': node.kind,
+        'title': node.title,
+        'source_id': node.source_id,
+        'description': node.description,
+        'author': node.author,
+        'tags': node.tags,
+        'thumbnail': thumbnail,
+        'files': [
+            {'type': file.__class__.__name__, 'path': file.path}
+            for file in node.files if not isinstance(file, files.ThumbnailFile)
+        ],
+        'children': [serialize_node(child) for child in node.children],
+    }
+    if node.kind != content_kinds.TOPIC:
+        data['license'] = serialize_license(node.license)
+    return data
+
+def save_tree(channel, path):
+    """ Writes the children of channel to path """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tree = [serialize_node(child) for child in channel.children]
+    storage.write_contents(path, json.dumps(tree, indent=2, sort_keys=True, ensure_ascii=False).encode('utf-8'), store=False)
+    LOGGER.info('Saved channel tree to {}'.format(path))
+
+
+def get_missing_files(data):
+    paths = [file['path'] for file in data['files']]
+    if data['thumbnail'] and '://' not in data['thumbnail']:
+        paths.append(data['thumbnail'])
+    return [path for path in paths if '://' not in path and not os.path.exists(path)]
+
+def create_node(data):
+    """ Rebuilds a node and its children from serialize_node's output (None if its files are gone) """
+    missing = get_missing_files(data)
+    if missing:
+        LOGGER.warning('Skipping {} (missing {})'.format(data['source_id'], ', '.join(missing)))
+        return None
+
+    kwargs = {
+        'title': data['title'],
+        'source_id': data['source_id'],
+        'description': data['description'],
+        'author': data['author'],
+        'tags': data['tags'],
+        'thumbnail': data['thumbnail'],
+    }
+    if data['kind'] != content_kinds.TOPIC:
+        license = data.get('license')
+        kwargs['license'] = license and licenses.get_license(license['id'], copyright_holder=license['copyright_holder'])
+        kwargs['files'] = [getattr(files, file['type'])(path=file['path']) for file in data['files']]
+    node = NODE_CLASSES[data['kind']](**kwargs)
+    for child_data in data['children']:
+        child = create_node(child_data)
+        if child:
+            node.add_child(child)
+    return node
+
+def load_tree(channel, path):
+    """ Adds the nodes saved by save_tree to channel """
+    with open(path) as fobj:
+        tree = json.load(fobj)
+    for data in tree:
+        node = create_node(data)
+        if node:
+            channel.add_child(node)
+    LOGGER.info('Loaded channel tree from {}'.format(path))
+    return channel
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import atexit
+import hashlib
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import fetch
+import settings
+from utils import EXCEPTIONS, BasicScraper, UnscrapableSourceException
+
+PLACEHOLDER_PAGE = '<!DOCTYPE html><html><head><meta charset="utf-8"><script src="{script}"></script></head><body>{message}</body></html>'
+
+
+class RecordingZipper(object):
+    """ Passes writes through to a zip, keeping track of every zip path a page used """
+
+    def __init__(self, zipper):
+        self.zipper = zipper
+        self.paths = set()
+        self.has_split = False
+
+    def __getattr__(self, name):
+        return getattr(self.zipper, name)
+
+    def contains(self, filename):
+        if self.zipper.contains(filename):
+            self.paths.add(filename)
+            return True
+        return False
+
+    def write_contents(self, *args, **kwargs):
+        path = self.zipper.write_contents(*args, **kwargs)
+        self.paths.add(path)
+        return path
+
+    def write_file(self, *args, **kwargs):
+        path = self.zipper.write_file(*args, **kwargs)
+        self.paths.add(path)
+        return path
+
+    def write_url(self, *args, **kwargs):
+        path = self.zipper.write_url(*args, **kwargs)
+        self.paths.add(path)
+        return path
+
+    def split(self, *args, **kwargs):
+        self.has_split = True
+        return self.zipper.split(*args, **kwargs)
+
+
+class RecordingTriaged(object):
+    """ View of a crawl's triaged map that keeps track of the urls a page looked up """
+
+    def __init__(self, triaged):
+        self.triaged = triaged
+        self.urls = set()
+
+    def __contains__(self, url):
+        return url in self.triaged
+
+    def __getitem__(self, url):
+        self.urls.add(url)
+        return self.triaged[url]
+
+    def __setitem__(self, url, filename):
+        self.urls.add(url)
+        self.triaged[url] = filename
+
+    def get(self, url, default=None):
+        if url in self.triaged:
+            self.urls.add(url)
+        return self.triaged.get(url, default)
+
+
+class SubpageRecorder(object):
+    """ Stands in for the crawler while a subpage is scraped to record everything the page depends on """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.zipper = RecordingZipper(crawler.zipper)
+        self.triaged = RecordingTriaged(crawler.triaged)
+        self.subpages = set()
+        self.refused = False
+
+    def __getattr__(self, name):
+        return getattr(self.crawler, name)
+
+    def enqueue(self, scraper_class, url, depth):
+        filename = self.crawler.enqueue(scraper_class, url, depth)
+        self.refused = self.refused or not filename
+        self.subpages.add((scraper_class, url))
+        return filename
+
+    def get_dependencies(self):
+        """ Returns the zip paths and subpages the page refers to (None if the page can't be reused elsewhere) """
+        if self.refused or self.zipper.has_split:
+            return None     # Split media has to be recorded for every resource, so the page can't be replayed
+        paths = set(self.zipper.paths)
+        subpages = set(self.subpages)
+        for url in self.triaged.urls:
+            filename = self.crawler.triaged[url]
+            if url in self.crawler.planned:
+                subpages.add((self.crawler.planned[url], url))
+            else:
+                paths.add(filename)
+        # Links to pages that are named differently in this zip (e.g. index.html) are zip-specific
+        if 'index.html' in paths:
+            return None
+        for scraper_class, url in subpages:
+            if self.crawler.triaged.get(url) != scraper_class.prefetch_filename(url):
+                return None
+        return paths, subpages
+
+
+class SubpageCache(object):
+    """
+        Run-wide cache of finished subpages keyed by (url, scraper class, options)
+
+        Each record holds the page's html and assets (copied to a temporary directory,
+        as the zip they were scraped for may be closed by the time they are reused) and
+        the subpages it links to, so other zips can replay it instead of scraping it again
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def get_key(self, scraper_class, url, locale):
+        if not settings.SUBPAGE_CACHE or not scraper_class.cacheable:
+            return None
+        return (url, scraper_class, locale, settings.COMPACT_HTML, settings.MINIFY_ASSETS, settings.OUTPUT_PROFILE)
+
+    def get_blob_path(self, path):
+        with self.lock:
+            if not self.directory:
+                self.directory = tempfile.mkdtemp(prefix='subpages-')
+                atexit.register(shutil.rmtree, self.directory, True)
+        return os.path.join(self.directory, hashlib.md5(path.encode('utf-8')).hexdigest())
+
+    def store(self, key, recorder):
+        dependencies = recorder.get_dependencies()
+        if not dependencies:
+            return
+        paths, subpages = dependencies
+        entries = []
+        for path in sorted(paths):
+            blob_path = self.get_blob_path(path)
+            if not os.path.exists(blob_path):
+                temp_path = '{}.{}'.format(blob_path, threading.get_ident())
+                if not recorder.zipper.export(path, temp_path):
+                    return  # Asset is still being written by another page
+                os.replace(temp_path, blob_path)
+            entries.append((path, blob_path))
+        with self.lock:
+            self.records[key] = (entries, sorted(subpages, key=lambda subpage: subpage[1]))
+
+    def replay(self, key, crawler, depth):
+        """ Writes a cached page into crawler's zip (returns False if the page isn't cached) """
+        with self.lock:
+            record = self.records.get(key)
+        if not record:
+            return False
+        entries, subpages = record
+        for path, blob_path in entries:
+            directory, filename = posixpath.split(path)
+            crawler.zipper.write_file(blob_path, filename=filename, directory=directory or None)
+        for scraper_class, url in subpages:
+            filename = scraper_class.prefetch_filename(url)
+            if crawler.enqueue(scraper_class, url, depth + 1) != filename:
+                crawler.write_placeholder(url, filename)
+        return True
+
+SUBPAGE_CACHE = SubpageCache()
+
+
+class SubpageCrawler(object):
+    """
+        Breadth-first work queue for the subpages linked from a zip's pages
+
+        Links are rewritten as soon as a subpage is queued (using the filename it is
+        planned to be written to), so parent pages never wait on their children.
+        Queued pages are scraped concurrently once the parent page is done.
+    """
+
+    def __init__(self, zipper, triaged=None, locale='en', max_depth=None, max_pages=None, max_bytes=None, workers=None):
+        """
+            zipper: zipper.ZipWriter   # Zip to write subpages to
+            triaged: dict              # Maps urls to the filename they are written to in the zip
+            locale: string             # Language to use when writing error messages
+            max_depth: int             # Subpages further than this many links from index.html are not scraped
+            max_pages: int             # Maximum number of subpages to scrape
+            max_bytes: int             # Stop scraping subpages once the zip holds this many bytes
+            workers: int               # Number of subpages to scrape at the same time
+        """
+        self.zipper = zipper
+        self.triaged = triaged if triaged is not None else {}
+        self.locale = locale
+        self.max_depth = max_depth if max_depth is not None else settings.SUBPAGE_MAX_DEPTH
+        self.max_pages = max_pages if max_pages is not None else settings.SUBPAGE_MAX_PAGES
+        self.max_bytes = max_bytes if max_bytes is not None else settings.SUBPAGE_MAX_BYTES
+        self.workers = workers or settings.SUBPAGE_WORKERS
+        self.queue = deque()
+        self.planned = {}       # Maps queued urls to the scraper class they are scraped with
+        self.page_count = 0
+        self.lock = threading.Lock()
+
+    def enqueue(self, scraper_class, url, depth):
+        """ Plans url to be scraped with scraper_class and returns its filename (None if over budget) """
+        with self.lock:
+            if self.triaged.get(url):
+                return self.triaged[url]
+            if (self.max_depth and depth > self.max_depth) or (self.max_pages and self.page_count >= self.max_pages):
+                LOGGER.warning('Subpage budget exceeded, not scraping {}'.format(url))
+                return None
+            filename = scraper_class.prefetch_filename(url)
+            self.triaged[url] = filename
+            self.planned[url] = scraper_class
+            self.page_count += 1
+            self.queue.append((scraper_class, url, filename, depth))
+            return filename
+
+    def write_placeholder(self, url, filename, broken=False):
+        scraper = BasicScraper(url, locale=self.locale, zipper=self.zipper)
+        self.zipper.write_contents(filename, PLACEHOLDER_PAGE.format(
+            script=scraper.write_copy_link_script(),
+            message=scraper.get_copy_link_html(url, broken=broken),
+        ))
+
+    def scrape(self, scraper_class, url, filename, depth):
+        # Pages were linked as soon as they were queued, so always write something to filename
+        if self.max_bytes and self.zipper.size > self.max_bytes:
+            LOGGER.warning('Zip size budget exceeded, not scraping {}'.format(url))
+            self.write_placeholder(url, filename)
+            return
+        key = SUBPAGE_CACHE.get_key(scraper_class, url, self.locale)
+        if key and SUBPAGE_CACHE.replay(key, self, depth):
+            return
+        try:
+            recorder = SubpageRecorder(self)
+            scraper = scraper_class(url, locale=self.locale, triaged=recorder.triaged, zipper=recorder.zipper, crawler=recorder, depth=depth)
+            scraper.to_zip(filename=filename)
+            if key:
+                SUBPAGE_CACHE.store(key, recorder)
+        except EXCEPTIONS as e:
+            LOGGER.warning('Broken subpage found at {} ({})'.format(url, str(e)))
+            self.write_placeholder(url, filename, broken=True)
+        except UnscrapableSourceException:
+            LOGGER.warning('Unscrapable subpage found at {}'.format(url))
+            self.write_placeholder(url, filename)
+        except Exception as e:
+            LOGGER.error('Unable to scrape subpage {} ({})'.format(url, str(e)))
+            self.write_placeholder(url, filename, broken=True)
+
+    def run(self):
+        """ Scrapes queued subpages (and any subpages they queue) until the queue is empty """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = set()
+            while True:
+                with self.lock:
+                    jobs = list(self.queue)
+                    self.queue.clear()
+                running.update(pool.submit(fetch.propagate(self.scrape), *job) for job in jobs)
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Dry runs
+
+    Only the category, filter and listing pages are crawled. Each resource's detail page and download
+    endpoint are read, the media embedded at the top level of the endpoint is probed with HEAD requests,
+    and the download time is estimated from the throughput earlier runs measured for each host
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import fetch
+import settings
+from utils import EXCEPTIONS, BasicScraper
+
+# Tags that embed media at the top level of a page
+MEDIA_SELECTORS = (
+    (('video',), 'src'),
+    (('audio',), 'src'),
+    (('source',), 'src'),
+    (('embed',), 'src'),
+    (('iframe',), 'src'),
+    (('object',), 'data'),
+)
+
+
+def find_media(url, contents):
+    """ Returns the absolute urls of the media the html in contents embeds """
+    page = BeautifulSoup(contents, 'html.parser')
+    scraper = BasicScraper(url)
+    media = OrderedDict()
+    for selector, attribute in MEDIA_SELECTORS:
+        for tag in page.find_all(*selector):
+            link = tag.get(attribute)
+            if link and not link.startswith(('data:', '#', 'javascript:')):
+                media[scraper.get_relative_url(link)] = True
+    return list(media)
+
+def get_category(topic):
+    """ Returns the title of the top-level topic topic is in """
+    while topic.parent is not None and topic.parent.parent is not None:
+        topic = topic.parent
+    return topic.title
+
+def format_size(size):
+    return '{:.1f} MB'.format(size / 1024 ** 2)
+
+def format_time(seconds):
+    return '{}h{:02d}m'.format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+
+class ResourceEstimate(object):
+    """ What scraping a resource would download """
+
+    def __init__(self, url):
+        self.url = url
+        self.pages = 0          # Pages read while probing (detail page and download endpoint)
+        self.media = 0          # Media embedded in the download endpoint
+        self.unknown = 0        # Media whose size couldn't be probed (e.g. embedded players)
+        self.size = 0           # Bytes
+        self.seconds = 0.0      # Estimated download time
+
+    def add(self, url, size):
+        self.size += size
+        self.seconds += size / fetch.get_throughput(url)
+
+
+class Estimate(object):
+    """ Collects the resources listed during the crawl (passed as scrape_channel's plan) and estimates their size """
+
+    def __init__(self, get_endpoint, workers=None):
+        """
+            get_endpoint: function     # Returns the download endpoint listed on a resource's detail page
+            workers: int               # Number of resources to probe at the same time
+        """
+        self.get_endpoint = get_endpoint
+        self.workers = workers or settings.ESTIMATE_WORKERS
+        self.entries = []                   # (resource url, topic) in the order resources were listed
+        self.resources = OrderedDict()      # Maps resource urls to ResourceEstimate
+
+    def add_resource(self, url, topic):
+        self.entries.append((url, topic))
+        if url not in self.resources:
+            self.resources[url] = ResourceEstimate(url)
+
+    def probe_resource(self, resource):
+        try:
+            contents = fetch.read(resource.url)
+            resource.pages += 1
+            resource.add(resource.url, len(contents))
+            endpoint = self.get_endpoint(contents)
+            contents = fetch.read(endpoint)
+            resource.pages += 1
+            resource.add(endpoint, len(contents))
+        except EXCEPTIONS as e:
+            LOGGER.warning('Unable to probe {} ({})'.format(resource.url, str(e)))
+            return
+
+        for url in find_media(endpoint, contents):
+            resource.media += 1
+            try:
+                size, content_type = fetch.probe(url)
+            except EXCEPTIONS as e:
+                size, content_type = None, ''
+            if size is None or content_type.startswith('text/html'):
+                resource.unknown += 1       # Players and pages are scraped separately, so their size isn't known here
+            else:
+                resource.add(url, size)
+
+    def run(self):
+        """ Probes every listed resource and logs the estimate for each category, returning {category: totals} """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self.probe_resource, self.resources.values()))
+
+        report = OrderedDict()
+        for url, topic in self.entries:
+            totals = report.setdefault(get_category(topic), OrderedDict((
+                ('resources', OrderedDict()), ('listings', 0), ('pages', 0), ('media', 0), ('unknown', 0), ('size', 0), ('seconds', 0.0),
+            )))
+            totals['listings'] += 1
+            if url not in totals['resources']:
+                resource = totals['resources'][url] = self.resources[url]
+                for field in ('pages', 'media', 'unknown', 'size', 'seconds'):
+                    totals[field] += getattr(resource, field)
+
+        for category, totals in report.items():
+            LOGGER.info('{}: {} resources ({} listings), {} pages, {} media ({} of unknown size), {}, ~{}'.format(
+                category, len(totals['resources']), totals['listings'], totals['pages'], totals['media'], totals['unknown'],
+                format_size(totals['size']), format_time(totals['seconds'])))
+        LOGGER.info('Total: {} resources ({} listings), {}, ~{} (downloading one resource at a time)'.format(
+            len(self.resources), len(self.entries),
+            format_size(sum(resource.size for resource in self.resources.values())),
+            format_time(sum(resource.seconds for resource in self.resources.values()))))
+        return report
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import hashlib
+import json
+import asyncio
+import os
+import socket
+import threading
+import time
+import urllib.error
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+from ricecooker.utils import downloader
+
+import settings
+from utils import EXCEPTIONS, BrokenSourceException, RunCache
+
+# Assets shared between pages and resources (icons, nubbins, images, patched player scripts) are only downloaded once per run
+ASSET_CACHE = RunCache(max_size=settings.ASSET_CACHE_MAX_BYTES, sizeof=len)
+
+# Pages and assets a planned build still has to read, kept apart from ASSET_CACHE so its size limit can't evict them
+PINNED = {}         # Maps cache keys to [contents, number of unpin calls left]
+PINNED_LOCK = threading.Lock()
+
+# API responses are small and requested once per resource, so keep all of them for the run (and on disk between runs)
+API_CACHE = RunCache()
+
+# Maps hosts to the semaphore limiting how many requests are sent to them at once
+HOST_LIMITS = {}
+HOST_LIMITS_LOCK = threading.Lock()
+
+# Maps hosts to (consecutive failures, time of the last failure), so hosts that keep failing are skipped
+HOST_FAILURES = {}
+HOST_FAILURES_LOCK = threading.Lock()
+
+# Maps hosts to [bytes, seconds] downloaded from them this run (see save_host_stats)
+HOST_STATS = {}
+HOST_STATS_LOCK = threading.Lock()
+SAVED_HOST_STATS = None     # Stats of earlier runs, loaded the first time they're needed
+RECORD_THROUGHPUT = True    # Off for dry runs, whose small page reads would skew the stats used to estimate full runs
+
+# Wall-clock budget of the resource the current thread is working on (see deadline)
+DEADLINE = threading.local()
+
+
+def get_host_limit(url):
+    host = urlparse(url).netloc
+    with HOST_LIMITS_LOCK:
+        if host not in HOST_LIMITS:
+            HOST_LIMITS[host] = threading.BoundedSemaphore(settings.FETCH_HOST_WORKERS)
+        return HOST_LIMITS[host]
+
+def get_host(url):
+    return urlparse(url).netloc
+
+def check_host(url):
+    """ Raises BrokenSourceException if url's host has failed too many times in a row recently """
+    with HOST_FAILURES_LOCK:
+        failures, last_failure = HOST_FAILURES.get(get_host(url), (0, 0))
+    if failures >= settings.HOST_FAILURE_LIMIT and time.time() - last_failure < settings.HOST_RETRY_AFTER:
+        raise BrokenSourceException('Skipping {} ({} is not responding)'.format(url, get_host(url)))
+
+def record_host(url, failed):
+    host = get_host(url)
+    with HOST_FAILURES_LOCK:
+        if not failed:
+            HOST_FAILURES.pop(host, None)
+            return
+        failures = HOST_FAILURES.get(host, (0, 0))[0] + 1
+        HOST_FAILURES[host] = (failures, time.time())
+    if failures == settings.HOST_FAILURE_LIMIT:
+        LOGGER.warning('{} failed {} times in a row, skipping it for {} seconds'.format(host, failures, settings.HOST_RETRY_AFTER))
+
+def is_host_failure(error):
+    """ Returns True if error means url's host is failing (rather than that the url can't be read) """
+    error = getattr(error, 'exc_info', None) and error.exc_info[1] or error     # youtube_dl wraps the errors it hits
+    error = getattr(error, 'cause', None) or error
+    if isinstance(error, requests.exceptions.HTTPError):
+        # Error pages still mean the host is up, unless the server itself is failing
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, urllib.error.URLError, socket.timeout))
+
+def record_throughput(url, size, seconds):
+    if not RECORD_THROUGHPUT:
+        return
+    with HOST_STATS_LOCK:
+        stats = HOST_STATS.setdefault(get_host(url), [0, 0.0])
+        stats[0] += size
+        stats[1] += seconds
+
+def load_host_stats():
+    """ Returns {host: [bytes, seconds]} downloaded by earlier runs """
+    global SAVED_HOST_STATS
+    if SAVED_HOST_STATS is None:
+        try:
+            with open(settings.HOST_STATS_PATH) as fobj:
+                SAVED_HOST_STATS = json.load(fobj)
+        except (OSError, ValueError):
+            SAVED_HOST_STATS = {}
+    return SAVED_HOST_STATS
+
+def save_host_stats():
+    """ Adds this run's downloads to the stats of earlier runs """
+    totals = {host: list(stats) for host, stats in load_host_stats().items()}
+    with HOST_STATS_LOCK:
+        for host, (size, seconds) in HOST_STATS.items():
+            stats = totals.setdefault(host, [0, 0.0])
+            stats[0] += size
+            stats[1] += seconds
+    os.makedirs(os.path.dirname(settings.HOST_STATS_PATH), exist_ok=True)
+    temp_path = '{}.{}'.format(settings.HOST_STATS_PATH, threading.get_ident())
+    with open(temp_path, 'w') as fobj:
+        json.dump(totals, fobj, indent=2, sort_keys=True)
+    os.replace(temp_path, settings.HOST_STATS_PATH)
+
+def get_throughput(url):
+    """ Returns the bytes per second downloaded from url's host by this and earlier runs """
+    host = get_host(url)
+    size, seconds = load_host_stats().get(host, (0, 0.0))
+    with HOST_STATS_LOCK:
+        run_size, run_seconds = HOST_STATS.get(host, (0, 0.0))
+    size, seconds = size + run_size, seconds + run_seconds
+    return size / seconds if size and seconds else settings.ESTIMATE_THROUGHPUT
+
+
+@contextmanager
+def deadline(seconds):
+    """ Makes reads on this thread (and the pools it starts through propagate) fail once seconds have passed """
+    previous = getattr(DEADLINE, 'expires', None)
+    DEADLINE.expires = time.time() + seconds if seconds else None
+    try:
+        yield
+    finally:
+        DEADLINE.expires = previous
+
+def propagate(function):
+    """ Returns function wrapped to run under the current thread's deadline (use when submitting to a pool) """
+    expires = getattr(DEADLINE, 'expires', None)
+
+    def run(*args, **kwargs):
+        previous = getattr(DEADLINE, 'expires', None)
+        DEADLINE.expires = expires
+        try:
+            return function(*args, **kwargs)
+        finally:
+            DEADLINE.expires = previous
+    return run
+
+def get_remaining_time():
+    expires = getattr(DEADLINE, 'expires', None)
+    return expires - time.time() if expires else None
+
+def check_deadline(url):
+    remaining = get_remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise BrokenSourceException('Resource time budget exceeded, not downloading {}'.format(url))
+
+def get_timeout():
+    """ Returns the (connect, read) timeout for a request, shortened to fit the current deadline """
+    read_timeout = settings.FETCH_READ_TIMEOUT
+    remaining = get_remaining_time()
+    if remaining is not None:
+        read_timeout = max(1, min(read_timeout, remaining))
+    return (settings.FETCH_CONNECT_TIMEOUT, read_timeout)
+
+
+def request(url):
+    """ Downloads url with timeouts, retrying connection errors (raises HTTPError for error responses) """
+    for attempt in range(settings.FETCH_RETRIES + 1):
+        try:
+            response = downloader.DOWNLOAD_SESSION.get(url, headers=downloader.DEFAULT_HEADERS, timeout=get_timeout())
+            response.raise_for_status()
+            return response.content
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == settings.FETCH_RETRIES:
+                raise
+            check_deadline(url)
+            time.sleep(attempt + 1)
+
+def render(url, **kwargs):
+    """ Loads url in a browser (downloader.read has no timeout for this), raising Timeout if it takes too long """
+    result = {}
+
+    def load():
+        loop = asyncio.new_event_loop()     # pyppeteer needs a loop on this thread
+        asyncio.set_event_loop(loop)
+        try:
+            result['contents'] = downloader.read(url, **kwargs)
+        except Exception as e:
+            result['error'] = e
+        finally:
+            loop.close()
+
+    # The browser can't be interrupted, so it's left to finish in the background
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    thread.join(sum(get_timeout()))
+    if thread.is_alive():
+        raise requests.exceptions.Timeout('Timed out loading {}'.format(url))
+    if 'error' in result:
+        raise result['error']
+    return result['contents']
+
+def get_cache_key(url, kwargs):
+    return (url,) + tuple(sorted(kwargs.items())) if kwargs else url
+
+def read(url, **kwargs):
+    """ Downloads url (or returns it from the run-wide cache if it was prefetched) """
+    key = get_cache_key(url, kwargs)
+    with PINNED_LOCK:
+        pinned = PINNED.get(key)
+    if pinned:
+        return pinned[0]
+    contents = ASSET_CACHE.get(key)
+    if contents is not None:
+        return contents
+    if not url.startswith('http'):
+        return downloader.read(url, **kwargs)   # Local file
+
+    check_deadline(url)
+    check_host(url)
+    with get_host_limit(url):
+        try:
+            start = time.time()
+            contents = render(url, **kwargs) if kwargs.get('loadjs') else request(url)
+            if not kwargs.get('loadjs'):
+                record_throughput(url, len(contents), time.time() - start)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            record_host(url, failed=is_host_failure(e))
+            raise
+    record_host(url, failed=False)
+    return contents
+
+def probe(url):
+    """ Returns (size, content type) of url from a HEAD request (size is None if the server doesn't say) """
+    check_host(url)
+    with get_host_limit(url):
+        try:
+            response = downloader.DOWNLOAD_SESSION.head(url, headers=downloader.DEFAULT_HEADERS, timeout=get_timeout(), allow_redirects=True)
+            response.raise_for_status()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            record_host(url, failed=True)
+            raise
+    record_host(url, failed=False)
+    size = response.headers.get('Content-Length')
+    return int(size) if size and size.isdigit() else None, response.headers.get('Content-Type', '')
+
+def pin(url, contents, uses=1, **kwargs):
+    """ Makes reading url return contents read elsewhere (e.g. while planning) until unpin has been called uses times """
+    with PINNED_LOCK:
+        pinned = PINNED.setdefault(get_cache_key(url, kwargs), [contents, 0])
+        pinned[1] += uses
+
+def unpin(url, **kwargs):
+    """ Called once a build is done with a url it pinned (the contents are dropped after the last one) """
+    key = get_cache_key(url, kwargs)
+    with PINNED_LOCK:
+        pinned = PINNED.get(key)
+        if pinned:
+            pinned[1] -= 1
+            if pinned[1] <= 0:
+                del PINNED[key]
+
+def read_cached(url, **kwargs):
+    return ASSET_CACHE.get_or_set(get_cache_key(url, kwargs), lambda: read(url, **kwargs))
+
+def read_patched(url, patch, version):
+    """ Returns patch(text at url), downloading and patching each (url, patch, version) only once per run """
+    key = (url, '{}.{}'.format(patch.__module__, patch.__qualname__), version)     # Different patches of a url are cached apart
+    return ASSET_CACHE.get_or_set(key, lambda: patch(read(url).decode('utf-8')))
+
+def fetch_all(urls, workers=None):
+    """ Reads each url once (in parallel, through the run-wide cache) and returns {url: bytes or the exception it raised} """
+    urls = list(OrderedDict.fromkeys(urls))
+
+    def fetch(url):
+        try:
+            return read_cached(url)
+        except EXCEPTIONS as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers or settings.FETCH_WORKERS) as pool:
+        return OrderedDict(zip(urls, pool.map(propagate(fetch), urls)))
+
+def get_api_cache_path(url):
+    if not settings.API_CACHE_DIRECTORY:
+        return None
+    return os.path.join(settings.API_CACHE_DIRECTORY, '{}.json'.format(hashlib.md5(url.encode('utf-8')).hexdigest()))
+
+def read_api_cache(url):
+    path = get_api_cache_path(url)
+    if not path or not os.path.exists(path) or time.time() - os.path.getmtime(path) > settings.API_CACHE_MAX_AGE:
+        return None
+    with open(path, 'rb') as fobj:
+        return fobj.read()
+
+def write_api_cache(url, contents):
+    path = get_api_cache_path(url)
+    if not path:
+        return
+    os.makedirs(settings.API_CACHE_DIRECTORY, exist_ok=True)
+    temp_path = '{}.{}'.format(path, threading.get_ident())
+    with open(temp_path, 'wb') as fobj:
+        fobj.write(contents)
+    os.replace(temp_path, path)
+
+def read_json(url):
+    """ Returns the parsed json at url, reusing responses from this run or recent runs """
+    def fetch():
+        contents = read_api_cache(url)
+        if contents is None:
+            contents = read(url)
+            json.loads(contents)    # Don't cache error pages
+            write_api_cache(url, contents)
+        return contents
+
+    # Parse on every call so callers can modify the data they get back
+    return json.loads(API_CACHE.get_or_set(url, fetch))
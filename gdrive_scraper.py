@@ -8,10 +8,7 @@ import tempfile
 import io
 import pickle
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaIoBaseDownload
+import pdf
 from utils import BasicScraper, BrokenSourceException, UnscrapableSourceException
 
 """
@@ -51,6 +48,11 @@ class GoogleDriveScraper(BasicPageScraper):
         self.file_id = re.search(r'https://[^\.]+.google.com/.*(?:file|document)/d/([^/]+)/(?:preview|edit)', self.url).group(1)
 
     def get_service(self):
+        # Google's client libraries are slow to import, so they are only loaded once a drive file is scraped
+        from googleapiclient.discovery import build
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+
         creds = None
         # The file token.pickle stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
@@ -79,6 +81,7 @@ class GoogleDriveScraper(BasicPageScraper):
         return os.path.splitext(file_metadata.get('name') or '.pdf')[1]
 
     def _download_file(self, write_to_path):
+        from googleapiclient.http import MediaIoBaseDownload
         try:
             service = self.get_service()
 
@@ -92,6 +95,9 @@ class GoogleDriveScraper(BasicPageScraper):
             done = False
             while not done:
                 status, done = downloader.next_chunk()
+            fh.close()
+            if write_to_path.endswith('.pdf'):
+                pdf.optimize_file(write_to_path)
         except Exception as e:
             raise UnscrapableSourceException(str(e))
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Import-time benchmark (run by tests/test_import_time.py, or as `python import_time.py`)
+
+    Imports sushichef in fresh interpreters, like a worker process starting up, and exits with an
+    error if the fastest cold start is over IMPORT_TIME_BUDGET or a lazily loaded module was imported
+"""
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+MODULE = 'sushichef'
+RUNS = 5                        # Fresh interpreters to time (the fastest one is reported)
+IMPORT_TIME_BUDGET = 1.0        # Seconds
+
+# Only loaded once a resource needs them (see the imports inside pages.py, ceibal_scrapers.py, gdrive_scraper.py
+# and utils.py), by module checked: ricecooker's node classes load PIL themselves, so sushichef can't skip it
+LAZY_MODULES = OrderedDict([
+    (MODULE, ('youtube_dl', 'googleapiclient', 'google_auth_oauthlib', 'ceibal_scrapers', 'pages')),
+    ('pages', ('youtube_dl', 'googleapiclient', 'google_auth_oauthlib', 'PIL')),
+])
+
+SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print('seconds=' + str(time.perf_counter() - start))
+print('loaded=' + ','.join(sorted(name for name in {lazy_modules} if name in sys.modules)))
+"""
+
+
+def time_import(module):
+    """ Returns (seconds to import module in a new interpreter, lazy modules it loaded) """
+    script = SCRIPT.format(module=module, lazy_modules=LAZY_MODULES.get(module, ()))
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.realpath(__file__)))
+    values = dict(line.split('=', 1) for line in output.decode('utf-8').splitlines() if line.startswith(('seconds=', 'loaded=')))
+    return float(values['seconds']), [name for name in values['loaded'].split(',') if name]
+
+
+def get_lazy_imports():
+    """ Returns the lazy modules that were loaded by importing the modules in LAZY_MODULES """
+    return [name for module in LAZY_MODULES for name in time_import(module)[1]]
+
+
+def main():
+    seconds = min(time_import(MODULE)[0] for _ in range(RUNS))
+    loaded = get_lazy_imports()
+    print('import {}: {:.3f}s (budget {:.3f}s)'.format(MODULE, seconds, IMPORT_TIME_BUDGET))
+    if loaded:
+        print('Imported lazy modules: {}'.format(', '.join(loaded)))
+    return 1 if seconds > IMPORT_TIME_BUDGET or loaded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,18 +2,34 @@
 # -*- coding: UTF-8 -*-
 import os
 from bs4 import BeautifulSoup
-from ricecooker.utils import downloader, html_writer
 from ricecooker.config import LOGGER              # Use LOGGER to print messages
 import re
-import youtube_dl
 import shutil
 import tempfile
+import time
+import zipfile
 import json
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from string import Template
 
 from le_utils.constants import content_kinds
 
 from tags import COMMON_TAGS, VideoTag
-from utils import EXCEPTIONS, BasicScraper, BrokenSourceException, UnscrapableSourceException, MESSAGES
+from utils import EXCEPTIONS, BasicScraper, BrokenSourceException, UnscrapableSourceException, MESSAGES, serialize, create_thumbnail
+import fetch
+import pdf
+import settings
+import storage
+from zipper import ZipWriter
+from crawler import SubpageCrawler
+
+def write_zip(zipper, write_to_path=None):
+    """ Writes a zip returned by HTMLPageScraper.build_zip and returns the metadata to record for it (see storage.write_atomic) """
+    zipper.close(write_to_path=write_to_path)
+    if zipper.split_media:
+        return {'media': list(zipper.split_media.values())}     # Recorded in the index (see sushichef.create_media_nodes)
+
 
 class BasicPageScraper(BasicScraper):
     dl_directory = 'downloads'
@@ -34,7 +50,7 @@ class BasicPageScraper(BasicScraper):
         pass
 
     def process(self):
-        return downloader.read(self.url)
+        return fetch.read(self.url)
 
     def postprocess(self, contents):
         """ Place for any operations to occur after main scraping method """
@@ -54,11 +70,16 @@ class BasicPageScraper(BasicScraper):
 
         write_to_path = os.path.join(directory, filename or self.get_filename(self.url))
 
-        if overwrite or not os.path.exists(write_to_path):
-            self._download_file(write_to_path)
+        # Files are only moved to write_to_path once they are complete, so interrupted runs never leave partial outputs
+        if overwrite or not storage.is_complete(write_to_path, validate=self.validate_file):
+            storage.write_atomic(write_to_path, self._download_file, url=self.url)
 
         return write_to_path
 
+    def validate_file(self, write_to_path):
+        """ Returns True if a file written by an earlier run (that didn't record it as complete) can be reused """
+        return False
+
     def to_zip(self, filename=None):
         return self.write_url(self.url, filename=filename)
 
@@ -80,17 +101,18 @@ class HTMLPageScraper(BasicPageScraper):
     extra_tags = None               # List of additional tags to look for (e.g. ImageTag)
     color = 'rgb(153, 97, 137)'     # Color to use for messages (consider contrast when setting this)
     kind = content_kinds.HTML5      # Content kind to write to
+    cacheable = True                # Determines whether other zips in the run can reuse this page when it's a subpage
 
 
     def __init__(self, *args, **kwargs):
         """
             url: string                                    # URL to read from
-            html_writer: ricecooker.utils.html_writer      # Zip to write files to
+            zipper: zipper.ZipWriter                       # Zip to write files to
             locale: string                                 # Language to use when writing error messages
         """
         super(HTMLPageScraper, self).__init__(*args, **kwargs)
-        self.omit_list = self.omit_list or []
-        self.omit_list += [
+        # Copy the list so the class attribute doesn't grow with every page (pages are scraped concurrently)
+        self.omit_list = (self.omit_list or []) + [
             ('link', {'type': 'image/x-icon'}),
             ('link', {'rel': 'apple-touch-icon'}),
             ('span', {'class': 'external-iframe-src'}),
@@ -102,7 +124,7 @@ class HTMLPageScraper(BasicPageScraper):
 
     def process(self):
         # Using html.parser as it is better at handling special characters
-        contents = BeautifulSoup(downloader.read(self.url, loadjs=self.loadjs), 'html.parser')
+        contents = BeautifulSoup(fetch.read(self.url, loadjs=self.loadjs), 'html.parser')
 
         self.preprocess(contents)
 
@@ -121,26 +143,48 @@ class HTMLPageScraper(BasicPageScraper):
                     zipper=self.zipper,
                     scrape_subpages=self.scrape_subpages,
                     triaged=self.triaged,
+                    crawler=self.crawler,
+                    depth=self.depth,
                     locale=self.locale,
                     extra_scrapers=self.scrapers,
                     color=self.color
                 )
                 scraper.scrape()
         self.postprocess(contents)
+        self.add_copy_link_script(contents)
 
-        return contents.prettify(formatter="minimal").encode('utf-8-sig', 'ignore')
+        return serialize(contents).encode('utf-8-sig', 'ignore')
 
     ##### Output methods #####
+    def build_zip(self, write_to_path=None):
+        """
+            Scrapes the page and its subpages into a zip that is only written by write_zip, so the rewriting
+            and the writing can happen in different places (e.g. pipeline stages, see sushichef.rewrite_resource)
+        """
+        zipper = ZipWriter(write_to_path)
+        zipper.open()
+        try:
+            self.zipper = zipper
+            self.crawler = SubpageCrawler(zipper, triaged=self.triaged, locale=self.locale)
+            self.triaged[self.url] = 'index.html'
+            self.to_zip(filename='index.html')
+            self.crawler.run()
+        except Exception as e:
+            # Log the original error (the zip is discarded, so nothing is written for this page)
+            LOGGER.error('Unable to scrape {} ({})'.format(self.url, str(e)))
+            zipper.discard()
+            raise
+        return zipper
+
     def _download_file(self, write_to_path):
+        return write_zip(self.build_zip(write_to_path))
 
-        with html_writer.HTMLWriter(write_to_path) as zipper:
-            try:
-                self.zipper = zipper
-                self.to_zip(filename='index.html')
-            except Exception as e:
-                # Any errors here will just say index.html file does not exist, so
-                # print out error for more descriptive debugging
-                LOGGER.error(str(e))
+    def validate_file(self, write_to_path):
+        try:
+            with zipfile.ZipFile(write_to_path) as zf:
+                return 'index.html' in zf.namelist()
+        except (zipfile.BadZipFile, OSError):
+            return False
 
     def to_file(self, filename=None, **kwargs):
         # Make sure html is being written to a zip file here
@@ -172,6 +216,16 @@ class PDFScraper(BasicPageScraper):
     def test(self, url):
         return url.split('?')[0].lower().endswith('.pdf')
 
+    def process(self):
+        return pdf.optimize(fetch.read(self.url))
+
+    def to_zip(self, filename=None):
+        filename = filename or self.get_filename(self.url)
+        path = '{}/{}'.format(self.directory, filename)
+        if self.zipper.contains(path):
+            return path     # Already downloaded and optimised for another link to it
+        return self.write_contents(filename, self.process())
+
     def to_tag(self, filename=None):
         try:
             embed = self.create_tag('embed')
@@ -219,7 +273,6 @@ class VideoScraper(BasicPageScraper):
             video = self.create_tag('video')
             video['controls'] = 'controls'
             video['style'] = 'width: 100%;'
-            video['preload'] = 'auto'
             source = self.create_tag('source')
             source['src'] = self.to_zip(filename=filename)
             video.append(source)
@@ -260,7 +313,7 @@ class FlashScraper(BasicPageScraper):
         return url.split('?')[0].lower().endswith('.swf')
 
     def process(self, **kwargs):
-        downloader.read(self.url) # Raises broken link error if fails
+        fetch.read(self.url) # Raises broken link error if fails
         raise UnscrapableSourceException('Cannot scrape Flash content')
 
     def to_tag(self, **kwargs):
@@ -281,17 +334,27 @@ class WebVideoScraper(VideoScraper):
             return fobj.read()
 
     def _download_file(self, write_to_path):
-        try:
-            dl_settings = {
-                'outtmpl': write_to_path,
-                'quiet': True,
-                'overwrite': True,
-                'format': self.default_ext.split('.')[-1],
-            }
-            with youtube_dl.YoutubeDL(dl_settings) as ydl:
-                ydl.download([self.url])
-        except (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError) as e:
-            raise UnscrapableSourceException(str(e))  # Some errors are region-specific, so allow link
+        import youtube_dl       # Only loaded once a video needs it (importing it is slow)
+        fetch.check_deadline(self.url)
+        fetch.check_host(self.url)
+        dl_settings = {
+            'outtmpl': write_to_path,
+            'quiet': True,
+            'overwrite': True,
+            'format': self.default_ext.split('.')[-1],
+            'socket_timeout': fetch.get_timeout()[1],
+        }
+        with fetch.get_host_limit(self.url):
+            try:
+                start = time.time()
+                with youtube_dl.YoutubeDL(dl_settings) as ydl:
+                    ydl.download([self.url])
+            except (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError) as e:
+                fetch.record_host(self.url, failed=fetch.is_host_failure(e))
+                raise UnscrapableSourceException(str(e))  # Some errors are region-specific, so allow link
+        fetch.record_host(self.url, failed=False)
+        if os.path.exists(write_to_path):
+            fetch.record_throughput(self.url, os.path.getsize(write_to_path), time.time() - start)
 
 
     def to_zip(self, filename=None):
@@ -311,7 +374,6 @@ class WebVideoScraper(VideoScraper):
         video = self.create_tag('video')
         video['controls'] = 'controls'
         video['style'] = 'width: 100%;'
-        video['preload'] = 'auto'
         source = self.create_tag('source')
         source['src'] = self.to_zip(filename=filename)
         video.append(source)
@@ -328,6 +390,102 @@ DEFAULT_PAGE_HANDLERS = [
 
 ########## LESS COMMON SCRAPERS (import as needed) ##########
 
+SLIDESHOW_TEMPLATE = Template(
+    '<!DOCTYPE html><html><head><meta charset="utf-8"><style>'
+    '#gallery {width: 100vw;}\n'
+    '#progress, #navigation, .wrapper, #gallery {max-width: 900px;}\n'
+    'button {cursor: pointer}\n'
+    'button:disabled { cursor: not-allowed; opacity: 0.5; }\n'
+    'body.fullscreen .wrapper {max-width: 100%;}\n'
+    'body.fullscreen #gallery, body.fullscreen #navigation, body.fullscreen #progress {max-width: 100%;}\n'
+    '#counter::after { content: "▲"; padding-left: 10px; font-size: 7pt; vertical-align: middle; }\n'
+    '#navigation-menu {list-style: none; padding: 0px; overflow-y: auto; overflow-x: none; height: 250px; max-height: 100vh;background: '
+        'white; width: max-content; margin: 0 auto; margin-top: -275px; border: 1px solid #ddd; display: none; position: relative;}\n'
+    '#navigation-menu li:not(:first-child) {border-top: 1px solid #ddd; }'
+    '#navigation-menu li:hover { background-color: #ddd; }\n'
+    '#progressbar { height: 10px; background-color: $color; transition: width 0.5s; }'
+    '</style></head>'
+    '<body style="background-color: black; height: 100vh; margin: 0px;" class="collapsed" onclick="closeDropdown()">'
+    '<div style="width: max-content; margin: 0 auto; text-align: center;">'
+    '<img id="gallery" style="cursor:pointer; height: auto; max-height: calc(100vh - 45px); object-fit: contain; color: white; font-family: sans-serif;" '
+        'onclick="updateImage(1)" src="$first_image"/>'
+    '<div id="progress" style="background-color: #4E4E4E; width: 100vw; height: 10px;"><div id="progressbar"></div></div>'
+    '<div id="navigation" style="background-color:#353535; text-align:center; height: 33px; width: 100vw;">'
+    '<button id="next-btn" style="float:right; background-color: transparent; border: none; font-size: 17pt; color: white; width:75px; font-size:16pt;" '
+        'onclick="updateImage(1)" title="$next">🡒</button>'
+    '<a id="fullscreen" style="float:right; color: white; font-size: 15pt; padding: 5px; cursor: pointer;" '
+        'onclick="toggleFullScreen()" title="$toggle_fullscreen">⤢</a>'
+    '<button id="prev-btn" style="float:left; background-color: transparent; border: none; font-size: 17pt; color: white; width:75px; font-size:16pt;" '
+        'onclick="updateImage(-1)" title="$previous">🡐</button>'
+    '$attribution'
+    '<div><div id="counter" style="padding-top: 5px; color: white; cursor: pointer; font-family: sans-serif;" onclick="openDropdown(event)"></div>'
+    '<ul id="navigation-menu">$menu</ul></div>'
+    '</div></div>'
+    '<script>var images = $images;</script>'
+    '<script src="$script"></script>'
+    '</body></html>'
+)
+
+SLIDESHOW_ATTRIBUTION_TEMPLATE = Template(
+    '<div id="attribution" style="float:left; margin-top:3px;">$logo'
+    '<div id="created" style="text-align: left; color: white; font-family: sans-serif; font-size: 7pt; display: inline-block;">$created'
+    '<div style="font-size: 12pt;">$source</div></div></div>'
+)
+
+SLIDESHOW_LOGO_TEMPLATE = Template('<img id="sourceLogo" src="$src" style="width: 24px; height: auto; margin-right: 5px;"/>')
+
+SLIDESHOW_MENU_ITEM_TEMPLATE = Template(
+    '<li style="font-family: sans-serif; text-align: left; padding: 10px 25px; cursor: pointer;" onclick="jumpToImage($index)">'
+    '<img class="slide" loading="lazy" src="$src" style="width: 150px; vertical-align: middle; font-size: 12pt; margin-right: 20px;"/>$label</li>'
+)
+
+# Written once per zip as js/slideshow.js (expects an `images` list to be defined by the page)
+SLIDESHOW_SCRIPT = "var index = 0;\n"\
+    "var menuExpanded = false;\n"\
+    "var img = document.getElementById('gallery');\n"\
+    "var prevbutton = document.getElementById('prev-btn');\n"\
+    "var nextbutton = document.getElementById('next-btn');\n"\
+    "var countText = document.getElementById('counter');\n"\
+    "var progress = document.getElementById('progress');\n"\
+    "var menu = document.getElementById('navigation-menu');\n"\
+    "function updateImage(step) {\n"\
+    "  if(index + step >= 0 && index + step < images.length)\n"\
+    "    index += step;\n"\
+    "  jumpToImage(index);\n"\
+    "}\n"\
+    "function jumpToImage(step) {\n"\
+    "  index = step;\n"\
+    "  countText.innerHTML = index + 1 + ' / ' + images.length;\n"\
+    "  img.setAttribute('src', images[index]);\n"\
+    "  if (index + 1 < images.length) { new Image().src = images[index + 1]; }  // Load the next slide ahead of time\n"\
+    "  (index === 0)? prevbutton.setAttribute('disabled', 'disabled') : prevbutton.removeAttribute('disabled');\n"\
+    "  (index === images.length - 1)? nextbutton.setAttribute('disabled', 'disabled') : nextbutton.removeAttribute('disabled');\n"\
+    "  progress.children[0].setAttribute('style', 'width:' + ((index + 1) / images.length * 100) + '%;')\n"\
+    "}\n"\
+    "function toggleFullScreen() {\n"\
+    "if ((document.fullScreenElement && document.fullScreenElement !== null) ||(!document.mozFullScreen && !document.webkitIsFullScreen)) {\n"\
+    "document.body.setAttribute('class', 'fullscreen');\n"\
+    "if (document.documentElement.requestFullScreen) { document.documentElement.requestFullScreen();} \n"\
+    "else if (document.documentElement.mozRequestFullScreen) { document.documentElement.mozRequestFullScreen(); } \n"\
+    "else if (document.documentElement.webkitRequestFullScreen) { document.documentElement.webkitRequestFullScreen(Element.ALLOW_KEYBOARD_INPUT); }\n"\
+    "} else {\n"\
+    "document.body.setAttribute('class', 'collapsed');\n"\
+    "if (document.cancelFullScreen) { document.cancelFullScreen(); }\n"\
+    "else if (document.mozCancelFullScreen) { document.mozCancelFullScreen(); }\n"\
+    "else if (document.webkitCancelFullScreen) { document.webkitCancelFullScreen(); }\n"\
+    "}\n"\
+    "}\n"\
+    "function closeDropdown() {\n"\
+    "menu.setAttribute('style', 'display: none;');\n"\
+    "menuExpanded = false;\n"\
+    "}\n"\
+    "function openDropdown(event) {\n"\
+    "event.stopPropagation();\n"\
+    "menu.setAttribute('style', (menuExpanded)? 'display:none;' : 'display:block;');\n"\
+    "menuExpanded = !menuExpanded;\n"\
+    "}\n"\
+    "updateImage(0);\n"
+
 class PresentationScraper(HTMLPageScraper):
     thumbnail = None
     source = ""
@@ -339,214 +497,53 @@ class PresentationScraper(HTMLPageScraper):
         return False
 
     def process(self):
-        contents = BeautifulSoup(downloader.read(self.url, loadjs=self.loadjs), 'html.parser')
-        images = []
-        for img  in contents.find_all(*self.img_selector):
-            images.append(self.write_url(img[self.img_attr], directory="slides"))
-        return self.generate_slideshow(images)
+        contents = BeautifulSoup(fetch.read(self.url, loadjs=self.loadjs), 'html.parser')
+        links = [img[self.img_attr] for img in contents.find_all(*self.img_selector)]
+        with ThreadPoolExecutor(max_workers=settings.SLIDE_WORKERS) as pool:
+            slides = list(pool.map(fetch.propagate(self.write_slide), links))
+        return self.generate_slideshow([image for image, _ in slides], thumbnails=[thumbnail for _, thumbnail in slides])
+
+    def write_slide(self, link):
+        """ Writes slide and a small version of it for the navigation menu, returning both paths """
+        filename = self.get_filename(link)
+        slide = fetch.read(self.get_relative_url(link))
+        image = self.write_contents(filename, slide, directory="slides")
+        try:
+            thumbnail = create_thumbnail(slide, settings.SLIDE_THUMBNAIL_WIDTH)
+            return image, self.write_contents(os.path.splitext(filename)[0] + '.jpg', thumbnail, directory="slides/thumbnails")
+        except (IOError, ValueError) as e:
+            LOGGER.warning('Unable to create thumbnail for slide {} ({})'.format(link, str(e)))
+            return image, image
 
     def to_zip(self, filename=None):
         contents = self.process()
         return self.write_contents(filename or self.get_filename(self.url), contents)
 
-    def generate_slideshow(self, images):
-        # <body>
-        page = BeautifulSoup('', 'html5lib')
-        page.body['style'] = 'background-color: black; height: 100vh; margin: 0px;'
-        page.body['class'] = ['collapsed']
-        page.body['onclick'] = 'closeDropdown()'
-
-        # <style>
-        style = self.create_tag('style')
-        style.string = '#gallery {width: 100vw;}\n'\
-                    '#progress, #navigation, .wrapper, #gallery {max-width: 900px;}\n'\
-                    'button {cursor: pointer}\n'\
-                    'button:disabled { cursor: not-allowed; opacity: 0.5; }\n'\
-                    'body.fullscreen .wrapper {max-width: 100%;}\n'\
-                    'body.fullscreen #gallery, body.fullscreen #navigation, body.fullscreen #progress {max-width: 100%;}\n'\
-                    '#counter::after { content: "▲"; padding-left: 10px; font-size: 7pt; vertical-align: middle; }\n'\
-                    '#navigation-menu {list-style: none; padding: 0px; overflow-y: auto; overflow-x: none; height: 250px; max-height: 100vh;background: '\
-                        'white; width: max-content; margin: 0 auto; margin-top: -275px; border: 1px solid #ddd; display: none; position: relative;}\n'\
-                    '#navigation-menu li:not(:first-child) {border-top: 1px solid #ddd; }'\
-                    '#navigation-menu li:hover { background-color: #ddd; }\n'
-
-        style.string += '#progressbar {{ height: 10px; background-color: {}; transition: width 0.5s; }}'.format(self.color)
-
-        page.head.append(style)
-
-        # <div class="wrapper">
-        wrapper = self.create_tag('div')
-        wrapper['style'] = 'width: max-content; margin: 0 auto; text-align: center;'
-        page.body.append(wrapper)
-
-        # <img id="gallery"/>
-        gallery = self.create_tag('img')
-        gallery['id'] = 'gallery'
-        gallery['style'] = 'cursor:pointer; height: auto; max-height: calc(100vh - 45px); object-fit: contain; color: white; font-family: sans-serif;'
-        gallery['onclick'] = 'updateImage(1)'
-        gallery['src'] = images[0]
-        wrapper.append(gallery)
-
-        # <div id="progress">
-        progress = self.create_tag('div')
-        progress['id'] = 'progress'
-        progress['style'] = 'background-color: #4E4E4E; width: 100vw; height: 10px;'
-        wrapper.append(progress)
-
-        # <div id="progressbar">
-        progressbar = self.create_tag('div')
-        progressbar['id'] = 'progressbar'
-        progress.append(progressbar)
-
-        # <div id="navigation">
-        navigation = self.create_tag('div')
-        navigation['id'] = 'navigation'
-        navigation['style'] = 'background-color:#353535; text-align:center; height: 33px; width: 100vw;'
-        wrapper.append(navigation)
-
-        # <button id="next-btn">
-        nextbutton = self.create_tag('button')
-        nextbutton['id'] = 'next-btn'
-        nextbutton.string = '🡒'
-        nextbutton['style'] = 'float:right; background-color: transparent; border: none; font-size: 17pt; color: white; width:75px; font-size:16pt;'
-        nextbutton['onclick'] = 'updateImage(1)'
-        nextbutton['title'] = MESSAGES[self.locale]['next']
-        navigation.append(nextbutton)
-
-        # <a id="fullscreen">
-        fullscreentoggle = self.create_tag('a')
-        fullscreentoggle['id'] = 'fullscreen'
-        fullscreentoggle['style'] = 'float:right; color: white; font-size: 15pt; padding: 5px; cursor: pointer;'
-        fullscreentoggle['onclick'] = 'toggleFullScreen()'
-        fullscreentoggle['title'] = MESSAGES[self.locale]['toggle_fullscreen']
-        fullscreentoggle.string = '⤢'
-        navigation.append(fullscreentoggle)
-
-        # <button id="prev-btn">
-        prevbutton = self.create_tag('button')
-        prevbutton['id'] = 'prev-btn'
-        prevbutton.string = '🡐'
-        prevbutton['style'] = 'float:left; background-color: transparent; border: none; font-size: 17pt; color: white; width:75px; font-size:16pt;'
-        prevbutton['onclick'] = 'updateImage(-1)'
-        prevbutton['title'] = MESSAGES[self.locale]['previous']
-        navigation.append(prevbutton)
-
-        # <div id="attribution">
+    def generate_slideshow(self, images, thumbnails=None):
+        attribution = ''
         if self.source:
-            attribution = self.create_tag('div')
-            attribution['id'] = 'attribution'
-            attribution['style'] = 'float:left; margin-top:3px;'
-            navigation.append(attribution)
-
-            # <img id="sourceLogo">
+            source_logo = ''
             if self.thumbnail:
-                source_logo = self.create_tag('img')
-                source_logo['id'] = 'sourceLogo'
-                source_logo['src'] = os.path.basename(self.write_url(self.thumbnail, default_ext=".png"))
-                source_logo['style'] = 'width: 24px; height: auto; margin-right: 5px;'
-                attribution.append(source_logo)
-
-            # <div id="created">
-            created = self.create_tag('div')
-            created['style'] = 'text-align: left; color: white; font-family: sans-serif; font-size: 7pt; display: inline-block;'
-            created['id'] = 'created'
-            created.string = MESSAGES[self.locale]['presentation_source']
-            attribution.append(created)
-
-            # <div id="sourceText">
-            source_text = self.create_tag('div')
-            source_text.string = self.source
-            source_text['style'] = 'font-size: 12pt;'
-            created.append(source_text)
-
-        # <div id='center'>
-        center_nav = self.create_tag('div')
-        navigation.append(center_nav)
-
-        # <div id='counter'>
-        counter = self.create_tag('div')
-        counter['id'] = 'counter'
-        counter['style'] = 'padding-top: 5px; color: white; cursor: pointer; font-family: sans-serif;'
-        counter['onclick'] = 'openDropdown(event)'
-        center_nav.append(counter)
-
-        # <ul id="navigation-menu">
-        navmenu = self.create_tag('ul')
-        navmenu['id'] = 'navigation-menu'
-        center_nav.append(navmenu)
-
-        for index, img  in enumerate(images):
-            # <li>
-            navmenuitem = self.create_tag('li')
-            navmenuitem['style'] = 'font-family: sans-serif; text-align: left; padding: 10px 25px; cursor: pointer;'
-            navmenuitem['onclick'] = 'jumpToImage({})'.format(index)
-            navmenu.append(navmenuitem)
-
-            # <img class="slide"> Slide #
-            slideimg = self.create_tag('img')
-            slideimg['class'] = ['slide']
-            slideimg['src'] = img
-            slideimg['style'] = 'width: 150px; vertical-align: middle; font-size: 12pt; margin-right: 20px;'
-            navmenuitem.append(slideimg)
-            navmenuitem.append(MESSAGES[self.locale]['slide'].format(index + 1))
-
-        # <script>
-        script = self.create_tag('script')
-        script.string = "let images = [{images}]; \n"\
-            "let index = 0;\n"\
-            "let menuExpanded = false;\n"\
-            "let img = document.getElementById('gallery');\n"\
-            "let prevbutton = document.getElementById('prev-btn');\n"\
-            "let nextbutton = document.getElementById('next-btn');\n"\
-            "let countText = document.getElementById('counter');\n"\
-            "let progress = document.getElementById('progress');\n"\
-            "let menu = document.getElementById('navigation-menu');"\
-            .format(images=','.join(['\"{}\"'.format(i) for i in images]))
-
-        script.string += "function updateImage(step) {\n"\
-            "  if(index + step >= 0 && index + step < images.length)\n"\
-            "    index += step;\n"\
-            "  jumpToImage(index);\n"\
-            "}"
-
-        script.string += "function jumpToImage(step) {\n"\
-            "  index = step;\n"\
-            "  countText.innerHTML = index + 1 + ' / ' + images.length;\n"\
-            "  img.setAttribute('src', images[index]);\n"\
-            "  countText.innerHTML = index + 1 + ' / ' + images.length;\n"\
-            "  img.setAttribute('src', images[index]);\n"\
-            "  (index === 0)? prevbutton.setAttribute('disabled', 'disabled') : prevbutton.removeAttribute('disabled');\n"\
-            "  (index === images.length - 1)? nextbutton.setAttribute('disabled', 'disabled') : nextbutton.removeAttribute('disabled');\n"\
-            "  progress.children[0].setAttribute('style', 'width:' + ((index + 1) / images.length * 100) + '%;')\n"\
-            "}\n"
-
-        script.string += "function toggleFullScreen() {\n"\
-            "if ((document.fullScreenElement && document.fullScreenElement !== null) ||(!document.mozFullScreen && !document.webkitIsFullScreen)) {\n"\
-            "document.body.setAttribute('class', 'fullscreen');\n"\
-            "if (document.documentElement.requestFullScreen) { document.documentElement.requestFullScreen();} \n"\
-            "else if (document.documentElement.mozRequestFullScreen) { document.documentElement.mozRequestFullScreen(); } \n"\
-            "else if (document.documentElement.webkitRequestFullScreen) { document.documentElement.webkitRequestFullScreen(Element.ALLOW_KEYBOARD_INPUT); }\n"\
-            "} else {\n"\
-            "document.body.setAttribute('class', 'collapsed');\n"\
-            "if (document.cancelFullScreen) { document.cancelFullScreen(); }\n"\
-            "else if (document.mozCancelFullScreen) { document.mozCancelFullScreen(); }\n"\
-            "else if (document.webkitCancelFullScreen) { document.webkitCancelFullScreen(); }\n"\
-            "}\n"\
-            "}\n"
-
-        script.string += "function closeDropdown() {\n"\
-            "menu.setAttribute('style', 'display: none;');\n"\
-            "menuExpanded = false;\n"\
-            "}\n"
-
-        script.string += "function openDropdown(event) {\n"\
-            "event.stopPropagation();\n"\
-            "menu.setAttribute('style', (menuExpanded)? 'display:none;' : 'display:block;');\n"\
-            "menuExpanded = !menuExpanded;\n"\
-            "}\n"
-
-        script.string += 'updateImage(0);'
-
-        page.body.append(script)
-
-        return page.prettify()
+                source_logo = SLIDESHOW_LOGO_TEMPLATE.substitute(src=os.path.basename(self.write_url(self.thumbnail, default_ext=".png")))
+            attribution = SLIDESHOW_ATTRIBUTION_TEMPLATE.substitute(
+                logo=source_logo,
+                created=escape(MESSAGES[self.locale]['presentation_source']),
+                source=escape(self.source),
+            )
+
+        menu = ''.join(
+            SLIDESHOW_MENU_ITEM_TEMPLATE.substitute(index=index, src=escape(img), label=escape(MESSAGES[self.locale]['slide'].format(index + 1)))
+            for index, img in enumerate(thumbnails or images)
+        )
+
+        return SLIDESHOW_TEMPLATE.substitute(
+            color=self.color,
+            first_image=escape(images[0]),
+            next=escape(MESSAGES[self.locale]['next']),
+            previous=escape(MESSAGES[self.locale]['previous']),
+            toggle_fullscreen=escape(MESSAGES[self.locale]['toggle_fullscreen']),
+            attribution=attribution,
+            menu=menu,
+            images=json.dumps(images),
+            script=self.write_contents('slideshow.js', SLIDESHOW_SCRIPT, directory='js'),
+        )
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Optional pdf optimisation (settings.OPTIMIZE_PDFS)
+
+    Pdfs over settings.PDF_MIN_BYTES are rewritten with Ghostscript (downsampling images) and then qpdf
+    (compressing object streams), whichever are installed, by the thread scraping them (at most
+    settings.PDF_WORKERS at a time). Optimised pdfs are kept in settings.PDF_CACHE_DIRECTORY by the md5
+    of the original, and the original is used whenever the tools fail or don't make the file smaller
+    (the cache only records that, it doesn't keep another copy of the original)
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import settings
+import storage
+from utils import RunCache
+
+# Commands run on each pdf, in order (each one reads the previous one's output)
+GS_COMMAND = ['gs', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.5', '-dPDFSETTINGS={image_settings}',
+              '-dNOPAUSE', '-dBATCH', '-dQUIET', '-dSAFER', '-sOutputFile={output}', '{input}']
+QPDF_COMMAND = ['qpdf', '--object-streams=generate', '--compress-streams=y', '--recompress-flate', '{input}', '{output}']
+
+UNCHANGED_SUFFIX = '.unchanged'     # Empty file in the cache for each pdf that is written as downloaded
+
+SLOTS = threading.BoundedSemaphore(settings.PDF_WORKERS)    # Only limits how many pdfs are optimised at the same time
+RESULTS = RunCache()        # Maps md5s of original pdfs to the cached file to use instead (None to use the original)
+TOOLS = None                # Commands whose tool is installed (found the first time a pdf is optimised)
+TOOLS_LOCK = threading.Lock()
+
+
+def get_tools():
+    global TOOLS
+    with TOOLS_LOCK:
+        if TOOLS is None:
+            TOOLS = [command for command in (GS_COMMAND, QPDF_COMMAND) if shutil.which(command[0])]
+            if not TOOLS:
+                LOGGER.warning('Neither gs nor qpdf is installed, so pdfs are written as downloaded')
+        return TOOLS
+
+def run_tools(contents):
+    """ Returns contents rewritten by the installed tools (None if there are none or one of them failed) """
+    tools = get_tools()
+    if not tools:
+        return None
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, '0.pdf')
+        with open(path, 'wb') as fobj:
+            fobj.write(contents)
+        for index, command in enumerate(tools):
+            output = os.path.join(tempdir, '{}.pdf'.format(index + 1))
+            arguments = [argument.format(input=path, output=output, image_settings=settings.PDF_IMAGE_SETTINGS) for argument in command]
+            subprocess.run(arguments, check=True, timeout=settings.PDF_TIMEOUT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            path = output
+        with open(path, 'rb') as fobj:
+            return fobj.read()
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        LOGGER.warning('Unable to optimise pdf ({})'.format(str(e)))
+        return None
+    finally:
+        shutil.rmtree(tempdir)
+
+def create_optimized(md5, contents):
+    """ Returns the path of the optimised version of contents, writing it to the cache first if needed (None if it isn't smaller) """
+    path = os.path.join(settings.PDF_CACHE_DIRECTORY, '{}.pdf'.format(md5))
+    unchanged_path = path + UNCHANGED_SUFFIX
+    if storage.is_complete(path):
+        return path
+    if storage.is_complete(unchanged_path):
+        return None
+
+    # The scraping thread waits for its pdf anyway, so it runs the tools itself
+    with SLOTS:
+        optimized = run_tools(contents)
+    os.makedirs(settings.PDF_CACHE_DIRECTORY, exist_ok=True)
+    if optimized and len(optimized) < len(contents):
+        LOGGER.info('Optimised pdf from {} to {} bytes'.format(len(contents), len(optimized)))
+        storage.write_contents(path, optimized, original_size=len(contents))
+        return path
+    storage.write_contents(unchanged_path, b'', store=False, original_size=len(contents))
+    return None
+
+def optimize(contents):
+    """ Returns the pdf in contents optimised if settings.OPTIMIZE_PDFS is on and it's large enough (contents otherwise) """
+    if not settings.OPTIMIZE_PDFS or len(contents) < settings.PDF_MIN_BYTES or not get_tools():
+        return contents
+    md5 = hashlib.md5(contents).hexdigest()
+    path = RESULTS.get_or_set(md5, lambda: create_optimized(md5, contents))
+    if not path:
+        return contents
+    with open(path, 'rb') as fobj:
+        return fobj.read()
+
+def optimize_file(path):
+    """ Replaces the pdf at path with its optimised version """
+    if not settings.OPTIMIZE_PDFS or os.path.getsize(path) < settings.PDF_MIN_BYTES:
+        return
+    with open(path, 'rb') as fobj:
+        contents = fobj.read()
+    optimized = optimize(contents)
+    if optimized is not contents and len(optimized) < len(contents):
+        with open(path, 'wb') as fobj:
+            fobj.write(optimized)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from queue import Queue
+from ricecooker import config
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import settings
+
+STOP = object()     # Put on a stage's queue once per worker when there is nothing left to process
+PRELOAD_MODULE = 'preload'
+
+PROCESS_CONTEXT = None          # Set up once by get_process_context (the forkserver is shared by every pool)
+PROCESS_CONTEXT_LOCK = threading.Lock()
+
+
+def can_preload():
+    """ The forkserver doesn't get sys.path, so it only finds preload.py in the working directory or on PYTHONPATH """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.getcwd()] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+    return any(os.path.abspath(path) == directory for path in paths if path)
+
+def get_process_context():
+    """
+        Returns the context worker processes are started from, or None if they can't be started safely here
+        Workers aren't forked from this process: other threads may be running, and a child forked from here could
+        inherit locks they hold (e.g. requests' connection pools). They are forked from a single-threaded forkserver
+        instead, which imports ricecooker once without deleting the chef's temp files (see preload.py)
+    """
+    global PROCESS_CONTEXT
+    with PROCESS_CONTEXT_LOCK:
+        if PROCESS_CONTEXT is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods() and can_preload():
+                PROCESS_CONTEXT = multiprocessing.get_context('forkserver')
+                PROCESS_CONTEXT.set_forkserver_preload([PRELOAD_MODULE])
+            else:
+                PROCESS_CONTEXT = False
+        return PROCESS_CONTEXT or None
+
+def init_worker(directory, temp_directory, storage_directory, filecache_directory):
+    """ Runs in every worker process before it takes any items, so it works with the chef's files """
+    os.chdir(directory)
+    tempfile.tempdir = temp_directory   # Shared with the chef, so files written by workers can be read by later stages
+    config.STORAGE_DIRECTORY = storage_directory
+    config.FILECACHE_DIRECTORY = filecache_directory
+
+def create_process_pool(stage):
+    """ Returns a pool of worker processes for stage (None if they can't be used here, so stage runs in threads) """
+    context = get_process_context()
+    if not context:
+        LOGGER.warning('Pipeline {} stage runs in threads (worker processes need the forkserver, and the chef '
+            'to run from its own directory)'.format(stage.name))
+        return None
+    # Only loaded here, after ricecooker: exit handlers run in reverse, and multiprocessing's removes a directory
+    # in ricecooker's temp directory, so it has to run before ricecooker's removes the whole thing
+    return concurrent.futures.ProcessPoolExecutor(max_workers=stage.workers, mp_context=context, initializer=init_worker,
+        initargs=(os.getcwd(), tempfile.gettempdir(), config.STORAGE_DIRECTORY, config.FILECACHE_DIRECTORY))
+
+
+class Stage(object):
+    """ Step of a Pipeline: runs function on every item with its own pool of workers """
+
+    def __init__(self, name, function, workers=1, processes=False, expand=False):
+        """
+            name: string               # Name to use in log messages
+            function: function         # Takes the output of the previous stage and returns the input of the next one
+            workers: int               # Number of items processed at the same time
+            processes: bool            # Run function in worker processes (function and items must be picklable,
+                                       # and workers don't see settings changed after their module was imported)
+            expand: bool               # function returns a list of items that each go through the next stages
+                                       # on their own (e.g. the resources found on a listing page)
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+        self.expand = expand
+
+
+class Pipeline(object):
+    """
+        Runs items through stages connected by bounded queues
+
+        Every stage works on its own items at the same time as the others (e.g. the next pages are
+        downloaded while earlier ones are rewritten), and put blocks while the first queue is full,
+        so a fast stage can't run ahead of a slow one and pile up items in memory
+
+        An item that fails in a stage is logged and skipped, but if a pool of worker processes breaks
+        (e.g. a worker was killed) every later item would fail too, so put and close raise the error
+    """
+
+    def __init__(self, stages, queue_size=None):
+        """
+            stages: [Stage]            # Steps to run each item through, in order
+            queue_size: int            # Number of items that can wait between two stages
+        """
+        self.stages = stages
+        self.queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+        self.queues = [Queue(maxsize=self.queue_size) for stage in stages]
+        self.results = {}               # Maps item positions to the output of the last stage
+        self.count = 0
+        self.lock = threading.RLock()
+        self.error = None               # Set when a pool of worker processes breaks
+        self.threads = []
+        self.pools = []
+        self.start()
+
+    def run_stage(self, index, stage, pool):
+        queue = self.queues[index]
+        while True:
+            item = queue.get()
+            if item is STOP:
+                return
+            if self.error:
+                continue                # Keep taking items so the stages before this one don't block
+            position, value = item
+            try:
+                value = pool.submit(stage.function, value).result() if pool else stage.function(value)
+                if index + 1 == len(self.stages):
+                    self.results[position] = value
+                elif stage.expand:
+                    self.expand(index + 1, position, value)
+                else:
+                    self.queues[index + 1].put((position, value))
+            except concurrent.futures.BrokenExecutor as e:
+                LOGGER.error('Pipeline {} stage stopped ({})'.format(stage.name, str(e)))
+                self.error = e
+            except Exception as e:
+                LOGGER.error('Pipeline {} stage failed ({})'.format(stage.name, str(e)))
+
+    def start(self):
+        pools = [create_process_pool(stage) if stage.processes else None for stage in self.stages]
+        self.pools = [pool for pool in pools if pool]
+        for index, (stage, pool) in enumerate(zip(self.stages, pools)):
+            stage_threads = [threading.Thread(target=self.run_stage, args=(index, stage, pool), daemon=True) for _ in range(stage.workers)]
+            for thread in stage_threads:
+                thread.start()
+            self.threads.append(stage_threads)
+
+    def next_position(self):
+        with self.lock:
+            position = self.count
+            self.count += 1
+        return position
+
+    def add(self, index, item, position=None):
+        """ Sends item through the stages from index on (waits while that stage is backed up) and returns its position """
+        if self.error:
+            raise self.error
+        position = self.next_position() if position is None else position
+        self.queues[index].put((position, item))
+        return position
+
+    def expand(self, index, position, items):
+        """ Sends each of the items an expanding stage returned for the item at position through the stages from index on """
+        for item in items:
+            self.add(index, item)
+
+    def put(self, item):
+        """ Adds item to the pipeline and returns its position """
+        return self.add(0, item)
+
+    def close(self):
+        """ Waits for every item to go through the pipeline and returns {position: output of the last stage} """
+        for index, stage_threads in enumerate(self.threads):
+            for _ in stage_threads:
+                self.queues[index].put(STOP)
+            for thread in stage_threads:
+                thread.join()
+        for pool in self.pools:
+            pool.shutdown()
+        if self.error:
+            raise self.error
+        return self.results
+
+
+class ResourcePipeline(Pipeline):
+    """
+        Pipeline of channel resources (each resource url goes through the stages once, however often it is listed)
+        Listing pages can be added too, for a first expanding stage that returns the (resource url, topic) they list
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ResourcePipeline, self).__init__(*args, **kwargs)
+        self.entries = []                   # (resource url, topic) in listing order (set by close)
+        self.listed = []                    # (order, resource url, topic) as resources were added
+        self.urls = OrderedDict()           # Maps resource urls to their positions
+
+    def add_listing(self, url, topic):
+        """ Adds a page listing resources of topic (the first stage returns them, see expand) """
+        self.put((url, topic))
+
+    def add_resource(self, url, topic, index=0, order=None):
+        with self.lock:
+            # Listings are crawled at the same time, so order keeps their resources in the order they were added
+            self.listed.append((order or (self.next_position(), 0), url, topic))
+            if url in self.urls:
+                return
+            self.urls[url] = position = self.next_position()
+        self.add(index, url, position=position)
+
+    def expand(self, index, position, items):
+        for rank, (url, topic) in enumerate(items):
+            self.add_resource(url, topic, index=index, order=(position, rank))
+
+    def close(self):
+        """ Returns {resource url: output of the last stage} """
+        results = super(ResourcePipeline, self).close()
+        self.entries = [(url, topic) for order, url, topic in sorted(self.listed, key=lambda entry: entry[0])]
+        return OrderedDict((url, results.get(position)) for url, position in self.urls.items())
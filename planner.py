@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from bs4 import BeautifulSoup
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import fetch
+import settings
+from utils import EXCEPTIONS, BasicScraper
+
+# Attributes that point to assets a page needs (checked while planning, so scrapers get them from the fetch cache)
+ASSET_SELECTORS = (
+    (('img',), 'src'),
+    (('script',), 'src'),
+    (('source',), 'src'),
+    (('video',), 'poster'),
+    (('link', {'rel': 'stylesheet'}), 'href'),
+)
+
+
+def find_assets(url, contents):
+    """ Returns the absolute urls of the assets the html in contents refers to """
+    page = BeautifulSoup(contents, 'html.parser')
+    scraper = BasicScraper(url)
+    assets = []
+    for selector, attribute in ASSET_SELECTORS:
+        for tag in page.find_all(*selector):
+            link = tag.get(attribute)
+            if link and not link.startswith(('data:', '#', 'javascript:')):
+                assets.append(scraper.get_relative_url(link))
+    return assets
+
+
+class PlannedResource(object):
+    """ A resource in the plan, with the pages and assets it depends on """
+
+    def __init__(self, url):
+        self.url = url
+        self.pages = []         # (url, read options) of the pages read for the resource (pinned until it's built)
+        self.assets = set()     # Urls of the assets those pages refer to
+
+
+class FetchPlan(object):
+    """
+        Whole-channel graph of resource -> pages -> assets, built before any zip is written
+
+        Resources are deduplicated across the channel (a resource listed under several topics
+        is only scraped once), and assets used by more than one resource are prefetched once
+        for every zip that needs them. Pages and prefetched assets are pinned (see fetch.pin) rather
+        than kept in the size-limited fetch cache, so they are still there when the zips are built
+    """
+
+    def __init__(self, get_pages, workers=None):
+        """
+            get_pages: function        # Returns [(url, read options, html)] for the pages of a resource url
+            workers: int               # Number of resources to read pages for at the same time
+        """
+        self.get_pages = get_pages
+        self.workers = workers or settings.PLAN_WORKERS
+        self.entries = []                   # (resource url, topic) in the order resources were listed
+        self.resources = OrderedDict()      # Maps resource urls to PlannedResource
+        self.assets = OrderedDict()         # Maps asset urls to the urls of the resources that use them
+        self.lock = threading.Lock()
+
+    def add_resource(self, url, topic):
+        self.entries.append((url, topic))
+        if url not in self.resources:
+            self.resources[url] = PlannedResource(url)
+
+    def discover_resource(self, resource):
+        try:
+            for url, options, contents in self.get_pages(resource.url):
+                fetch.pin(url, contents, **options)
+                resource.pages.append((url, options))
+                resource.assets.update(find_assets(url, contents))
+        except EXCEPTIONS as e:
+            LOGGER.warning('Unable to plan {} ({})'.format(resource.url, str(e)))
+        with self.lock:
+            for asset in resource.assets:
+                self.assets.setdefault(asset, []).append(resource.url)
+
+    def discover(self):
+        """ Reads the pages of every planned resource to find the assets they share """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(self.discover_resource, self.resources.values()))
+        LOGGER.info('Planned {} resources ({} listings) using {} assets ({} shared)'.format(
+            len(self.resources), len(self.entries), len(self.assets), len(self.get_shared_assets())))
+
+    def get_shared_assets(self):
+        """ Returns the assets used by more than one resource, in the order resources were listed """
+        shared = OrderedDict()
+        for resource in self.resources.values():
+            for asset in sorted(resource.assets):
+                if len(self.assets.get(asset, [])) > 1:
+                    shared[asset] = True
+        return list(shared)
+
+
+class Scheduler(object):
+    """
+        Runs a FetchPlan: shared assets are prefetched (fetch.read limits requests per host),
+        and each resource is built as soon as the shared assets it needs are in the cache
+    """
+
+    def __init__(self, plan, build, fetch_workers=None, build_workers=None):
+        """
+            plan: FetchPlan            # Plan to run (FetchPlan.discover must have been called)
+            build: function            # Scrapes a resource url, returning its result
+            fetch_workers: int         # Number of shared assets to prefetch at the same time
+            build_workers: int         # Number of resources to build at the same time
+        """
+        self.plan = plan
+        self.build = build
+        self.fetch_workers = fetch_workers or settings.PLAN_FETCH_WORKERS
+        self.build_workers = build_workers or settings.PLAN_BUILD_WORKERS
+
+    def prefetch(self, url):
+        try:
+            fetch.pin(url, fetch.read(url), uses=len(self.plan.assets[url]))  # Unpinned by each resource using it
+        except EXCEPTIONS as e:
+            LOGGER.warning('Unable to prefetch {} ({})'.format(url, str(e)))
+
+    def build_resource(self, resource, prefetches):
+        wait([prefetches[asset] for asset in resource.assets if asset in prefetches])
+        try:
+            return self.build(resource.url)
+        except Exception as e:
+            LOGGER.error('Unable to build {} ({})'.format(resource.url, str(e)))
+        finally:
+            for url, options in resource.pages:
+                fetch.unpin(url, **options)
+            for asset in resource.assets:
+                if asset in prefetches:
+                    fetch.unpin(asset)
+
+    def run(self):
+        """ Returns {resource url: build result} for every resource in the plan """
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetch_pool, \
+                ThreadPoolExecutor(max_workers=self.build_workers) as build_pool:
+            # Assets are queued in the order resources need them, so the first zips can start right away
+            prefetches = OrderedDict((asset, fetch_pool.submit(self.prefetch, asset)) for asset in self.plan.get_shared_assets())
+            builds = OrderedDict(
+                (url, build_pool.submit(self.build_resource, resource, prefetches))
+                for url, resource in self.plan.resources.items()
+            )
+            return OrderedDict((url, future.result()) for url, future in builds.items())
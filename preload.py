@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Forkserver preload
+
+    Imported by the forkserver that pipeline worker processes are forked from (see pipeline.get_process_context).
+    Importing ricecooker deletes .ricecooker-temp in the working directory, which is where the chef keeps its
+    temp files, so it is imported once here from a scratch directory and the workers inherit it instead
+"""
+import os
+import shutil
+import tempfile
+
+directory = os.getcwd()
+scratch_directory = tempfile.mkdtemp()
+os.chdir(scratch_directory)
+try:
+    from ricecooker import config       # Its paths are set for each worker by pipeline.init_worker
+finally:
+    os.chdir(directory)
+    shutil.rmtree(scratch_directory, ignore_errors=True)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Run-wide settings shared by the scrapers (override from sushichef.py before scraping)
+"""
+import os
+
+# Output settings
+################################################################################
+COMPACT_HTML = True             # Serialize pages as-is instead of using prettify() (faster, smaller zips)
+MINIFY_ASSETS = False           # Minify inline <style>/<script> and the css/js files written to zips
+                                # (js minification requires the optional rjsmin package)
+VERIFY_SERIALIZATION = False    # Re-parse compact output and warn if it would render differently
+OUTPUT_PROFILE = 'default'      # What pages load up front: 'default', 'low_bandwidth' or 'minimal' (see utils.OUTPUT_PROFILES)
+
+# Storage settings
+################################################################################
+VERIFY_CACHED_OUTPUTS = False   # Hash finished outputs before reusing them (instead of trusting their size and mtime)
+OBJECT_STORE = 'hardlink'       # Keep outputs once in OBJECT_STORE_DIRECTORY, named by their hash, and link them
+                                # to their usual paths ('hardlink', 'symlink' or None to write plain files)
+OBJECT_STORE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'objects')
+OBJECT_GC_MIN_AGE = 24 * 60 * 60    # Seconds since an object was last linked before garbage collection can delete it
+TREE_CHECKPOINT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'tree.json')  # Channel tree saved after crawling (see checkpoint.py)
+
+# Zip settings
+################################################################################
+ZIP_WORKERS = 4                 # Threads used to deflate text entries when a zip is closed
+ZIP_COMPRESS_LEVEL = 6          # zlib level for text entries (media is always stored uncompressed)
+
+# Subpage settings
+################################################################################
+SUBPAGE_WORKERS = 4             # Subpages scraped at the same time within a zip
+SUBPAGE_MAX_DEPTH = 8           # Links followed from index.html before subpages are left unscraped
+SUBPAGE_MAX_PAGES = 500         # Subpages scraped per zip
+SUBPAGE_MAX_BYTES = 2 * 1024 ** 3   # Stop scraping subpages once a zip holds this many bytes
+SUBPAGE_CACHE = True            # Reuse subpages scraped for earlier zips in the same run
+
+# Media settings
+################################################################################
+SPLIT_MEDIA = False             # Move large videos, audio and pdfs out of zips into their own nodes
+SPLIT_MEDIA_MIN_BYTES = 20 * 1024 ** 2  # Smaller media stays in the zip
+SPLIT_MEDIA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'media')
+
+# Thumbnail settings
+################################################################################
+THUMBNAIL_SIZE = (400, 225)     # Node thumbnails are cropped and resized to this (Studio's thumbnail size)
+THUMBNAIL_WORKERS = 4           # Thumbnails converted at the same time (alongside page scraping)
+THUMBNAIL_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'thumbnails')
+
+# PDF settings
+################################################################################
+OPTIMIZE_PDFS = False           # Shrink pdfs with Ghostscript and/or qpdf (whichever are installed) before writing them
+PDF_MIN_BYTES = 2 * 1024 ** 2   # Smaller pdfs are written as downloaded
+PDF_IMAGE_SETTINGS = '/ebook'   # Ghostscript preset for images (/ebook downsamples to 150 dpi, /screen to 72 dpi)
+PDF_WORKERS = 2                 # Pdfs optimised at the same time (other threads wait for a turn)
+PDF_TIMEOUT = 5 * 60            # Seconds a tool can take on a pdf before the original is used
+PDF_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'pdf')
+
+# Presentation settings
+################################################################################
+SLIDE_WORKERS = 8               # Slides downloaded at the same time
+SLIDE_THUMBNAIL_WIDTH = 150     # Width of the slide previews in the navigation menu
+
+# Fetch settings
+################################################################################
+FETCH_WORKERS = 8               # Assets downloaded at the same time when a page fetches several at once
+FETCH_HOST_WORKERS = 4          # Requests sent to the same host at the same time (across the whole run)
+FETCH_CONNECT_TIMEOUT = 10      # Seconds to wait for a host to accept a connection
+FETCH_READ_TIMEOUT = 60         # Seconds to wait for a host to send data (also used for youtube_dl)
+FETCH_RETRIES = 2               # Times a request is retried after a connection error or timeout
+HOST_FAILURE_LIMIT = 5          # Failed requests in a row before a host is skipped
+HOST_RETRY_AFTER = 10 * 60      # Seconds a failing host is skipped for before it is tried again
+RESOURCE_DEADLINE = 30 * 60     # Seconds a resource can take before its remaining downloads are skipped (None to disable)
+ASSET_CACHE_MAX_BYTES = 256 * 1024 ** 2     # Memory used to keep shared assets (icons, nubbins) for the whole run
+API_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'api')
+                                # Where API responses (e.g. genial.ly views) are kept between runs (None to disable)
+API_CACHE_MAX_AGE = 24 * 60 * 60    # Seconds before a cached API response is requested again
+HOST_STATS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'downloads', 'host-stats.json')
+                                # Bytes and seconds downloaded from each host, added up across runs (used by dry runs)
+
+# Dry run settings (used when the chef is run with dry_run=1)
+################################################################################
+ESTIMATE_WORKERS = 8            # Resources probed at the same time
+ESTIMATE_THROUGHPUT = 512 * 1024    # Bytes per second assumed for hosts no earlier run downloaded from
+
+# Plan settings (used when the chef is run with plan=1)
+################################################################################
+PLAN_WORKERS = 8                # Resources whose pages are read at the same time while planning
+PLAN_FETCH_WORKERS = 8          # Shared assets prefetched at the same time
+PLAN_BUILD_WORKERS = 4          # Resource zips assembled at the same time
+
+# Pipeline settings (used when the chef is run with pipeline=1)
+################################################################################
+PIPELINE_QUEUE_SIZE = 16        # Items waiting between two stages (a stage pauses while the next one's queue is full)
+PIPELINE_CRAWL_WORKERS = 2      # Listings whose pages are read at the same time
+PIPELINE_FETCH_WORKERS = 8      # Resources whose pages are downloaded at the same time
+PIPELINE_REWRITE_WORKERS = 4    # Resources whose pages are rewritten at the same time
+PIPELINE_REWRITE_PROCESSES = False  # Rewrite in worker processes instead of threads (run-wide caches are then
+                                # kept per process, and the chef has to run from its own directory)
+PIPELINE_ZIP_WORKERS = 2        # Resource zips written at the same time
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Sharded runs
+
+    Every shard crawls the whole listing (it's cheap compared to scraping), but only scrapes the
+    resources whose source id hashes to it, then saves a manifest with the topics, the order
+    resources were listed in and the records of its own resources. Once every shard has written
+    its manifest to the shared directory, a merge run rebuilds the full tree from them in listing order
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from ricecooker.classes import licenses
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import checkpoint
+import storage
+
+
+def get_shard(source_id, count):
+    """ Returns the shard (0 to count - 1) source_id belongs to (the same on every machine and run) """
+    return int(hashlib.md5(source_id.encode('utf-8')).hexdigest(), 16) % count
+
+def parse_shard(value):
+    """ Parses 'i/N' into (i, N) """
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise ValueError('Invalid shard {} (use i/N with 0 <= i < N)'.format(value))
+    return index, count
+
+def get_manifest_path(directory, index, count):
+    return os.path.join(directory, 'tree-shard-{}-of-{}.json'.format(index, count))
+
+def get_topic_key(topic):
+    """ Identifies a topic by the source ids of its ancestors, as topics in different places can share a source id """
+    path = []
+    while topic is not None and getattr(topic, 'parent', None) is not None:
+        path.insert(0, topic.source_id)
+        topic = topic.parent
+    return json.dumps(path)
+
+
+class Shard(object):
+    """ Collects the resources listed during the crawl (passed as scrape_channel's plan) """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.entries = []                   # (resource url, topic) in the order resources were listed
+
+    def add_resource(self, url, topic):
+        self.entries.append((url, topic))
+
+    def owns(self, url):
+        return get_shard(url, self.count) == self.index
+
+    def get_urls(self):
+        """ Returns the resources this shard has to scrape, in listing order """
+        return list(OrderedDict.fromkeys(url for url, _ in self.entries if self.owns(url)))
+
+
+def serialize_record(record):
+    return dict(record, license=checkpoint.serialize_license(record['license']))
+
+def deserialize_record(record):
+    license = record['license']
+    return dict(record, license=license and licenses.get_license(license['id'], copyright_holder=license['copyright_holder']))
+
+def save_manifest(channel, shard, records, directory):
+    """ Writes the topics of channel, the resources listed under them and records ({url: read_resource record}) """
+    listings = OrderedDict()
+    for url, topic in shard.entries:
+        listings.setdefault(get_topic_key(topic), []).append(url)
+    manifest = {
+        'shard': shard.index,
+        'count': shard.count,
+        'topics': [checkpoint.serialize_node(child) for child in channel.children],
+        'listings': listings,
+        'records': OrderedDict((url, serialize_record(record)) for url, record in records.items() if record),
+    }
+    path = get_manifest_path(directory, shard.index, shard.count)
+    os.makedirs(directory, exist_ok=True)
+    storage.write_contents(path, json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8'), store=False)
+    LOGGER.info('Saved shard {}/{} manifest ({} resources) to {}'.format(shard.index, shard.count, len(manifest['records']), path))
+
+
+def load_manifests(directory, count):
+    manifests = []
+    for index in range(count):
+        path = get_manifest_path(directory, index, count)
+        if not os.path.exists(path):
+            raise FileNotFoundError('Shard {}/{} has no manifest at {} (has it finished?)'.format(index, count, path))
+        with open(path) as fobj:
+            manifests.append(json.load(fobj, object_pairs_hook=OrderedDict))
+    return manifests
+
+def iter_topics(node):
+    for child in node.children:
+        yield child
+        for topic in iter_topics(child):
+            yield topic
+
+def merge(channel, directory, count, add_resource_nodes):
+    """
+        Adds the tree the shards in directory scraped to channel, in the order resources were listed
+        add_resource_nodes(topic, url, record) adds a resource's nodes to a topic
+    """
+    manifests = load_manifests(directory, count)
+    for data in manifests[0]['topics']:
+        channel.add_child(checkpoint.create_node(data))
+
+    topics = {get_topic_key(topic): topic for topic in iter_topics(channel)}
+    for key, urls in manifests[0]['listings'].items():
+        for url in urls:
+            record = manifests[get_shard(url, count)]['records'].get(url)
+            if record:
+                add_resource_nodes(topics[key], url, deserialize_record(record))
+    LOGGER.info('Merged {} shards from {}'.format(count, directory))
+    return channel
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Crash-safe output files
+
+    Outputs are written to a temporary file next to their final path and renamed into place once
+    they are complete, then recorded in their directory's index (.index.jsonl) with their hash, size and mtime.
+    Indexes are loaded once per process, so checking an output only needs a stat. A file without a
+    record was interrupted (or written before it was indexed) and is only reused if its scraper can validate it
+
+    Outputs are also content-addressed: the file itself is kept once in settings.OBJECT_STORE_DIRECTORY
+    (objects/ab/cdef...) and linked to its path, so identical outputs under different names share their
+    disk space. Reuse checks still only stat the output, and collect_garbage removes unlinked objects
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import settings
+
+INDEX_FILENAME = '.index.jsonl'
+TEMP_PREFIX = '.tmp-'
+HOSTNAME = socket.gethostname().replace('-', '_')     # Temp files name the machine writing them (download directories can be shared)
+
+# Maps directories to {filename: record} loaded from their index (see read_record)
+INDEXES = {}
+INDEX_LOCK = threading.Lock()
+
+
+def get_temp_path(path):
+    # Keep the extension last, as some writers (e.g. youtube_dl) pick formats from it
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, '{}{}-{}-{}-{}'.format(TEMP_PREFIX, HOSTNAME, os.getpid(), threading.get_ident(), filename))
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_files(directory):
+    """
+        Deletes temporary files left in directory (and its subdirectories) by runs that were killed before finishing them
+        Only this machine's files are checked, as other machines' runs can't be seen from here (e.g. shards sharing directory)
+    """
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.startswith(TEMP_PREFIX):
+                host, pid = (filename[len(TEMP_PREFIX):].split('-') + [''])[:2]
+                if host == HOSTNAME and pid.isdigit() and not is_running(int(pid)):
+                    os.remove(os.path.join(root, filename))
+
+def hash_file(path):
+    hash_object = hashlib.md5()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def load_index(directory):
+    """ Returns {filename: record} from directory's index (later lines replace earlier records of the same file) """
+    index = {}
+    try:
+        with open(os.path.join(directory, INDEX_FILENAME)) as fobj:
+            for line in fobj:
+                try:
+                    filename, record = json.loads(line)
+                except ValueError:
+                    continue    # Cut short by a crash
+                index[filename] = record
+    except OSError:
+        pass
+    return index
+
+def read_record(path):
+    """ Returns what was recorded when path was completed (None if it wasn't) """
+    directory, filename = os.path.split(os.path.abspath(path))
+    with INDEX_LOCK:
+        if directory not in INDEXES:
+            INDEXES[directory] = load_index(directory)
+        record = INDEXES[directory].get(filename)
+        if record is None and os.path.exists(path):
+            # Other processes (build workers, shards) append to the same index
+            INDEXES[directory] = load_index(directory)
+            record = INDEXES[directory].get(filename)
+    return record
+
+def write_record(path, md5=None, **metadata):
+    """ Records path as complete (metadata is kept with it, e.g. what the file was scraped from) """
+    stat = os.stat(path)
+    record = dict(read_record(path) or {}, **metadata)
+    record.update({'complete': True, 'md5': md5 or hash_file(path), 'size': stat.st_size, 'mtime': stat.st_mtime})
+    directory, filename = os.path.split(os.path.abspath(path))
+    line = '{}\n'.format(json.dumps([filename, record], sort_keys=True)).encode('utf-8')
+    with INDEX_LOCK:
+        # A single append, so records from other processes are never interleaved
+        fd = os.open(os.path.join(directory, INDEX_FILENAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        INDEXES[directory][filename] = record
+    return record
+
+
+def is_complete(path, validate=None):
+    """
+        Returns True if path holds a finished output
+        Files are checked against their record (size and mtime, or the full hash if they changed
+        or settings.VERIFY_CACHED_OUTPUTS is set); files without one are adopted if validate(path) passes
+    """
+    if not os.path.exists(path):
+        return False
+    record = read_record(path)
+    if not record or not record.get('complete'):
+        if validate and validate(path):
+            write_record(path)
+            return True
+        return False
+
+    stat = os.stat(path)
+    if stat.st_size != record.get('size'):
+        return False
+    if settings.VERIFY_CACHED_OUTPUTS or stat.st_mtime != record.get('mtime'):
+        if hash_file(path) != record.get('md5'):
+            return False
+        write_record(path)      # Same contents (e.g. copied from another machine), so record the new mtime
+    return True
+
+
+def get_object_path(md5):
+    return os.path.join(settings.OBJECT_STORE_DIRECTORY, md5[:2], md5[2:])
+
+def link_object(temp_path, path, md5):
+    """ Moves temp_path into the object store (unless it already holds the same contents) and links path to it """
+    object_path = get_object_path(md5)
+    try:
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path) and os.path.getsize(object_path) == os.path.getsize(temp_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, object_path)
+    except OSError as e:
+        LOGGER.warning('Unable to store {} ({})'.format(path, str(e)))
+        return False
+
+    try:
+        if settings.OBJECT_STORE == 'symlink':
+            os.symlink(object_path, temp_path)
+        else:
+            os.link(object_path, temp_path)
+    except OSError:
+        shutil.copyfile(object_path, temp_path)     # e.g. the store is on another filesystem
+    os.replace(temp_path, path)
+    return True
+
+def write_atomic(path, write, store=True, **metadata):
+    """
+        Calls write(temp_path) and moves the result to path only if it returned without errors (recording metadata in the index)
+        Set store to False for files that are edited by hand (they would change the stored object)
+    """
+    temp_path = get_temp_path(path)
+    try:
+        metadata.update(write(temp_path) or {})     # Writers can return more metadata to record
+        md5 = hash_file(temp_path)
+        if not (store and settings.OBJECT_STORE and link_object(temp_path, path, md5)):
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return write_record(path, md5=md5, **metadata)
+
+def write_contents(path, contents, store=True, **metadata):
+    def write(temp_path):
+        with open(temp_path, 'wb') as fobj:
+            fobj.write(contents)
+    return write_atomic(path, write, store=store, **metadata)
+
+
+def collect_garbage(directories):
+    """
+        Deletes stored objects that no output in directories links to anymore, returning the number of bytes freed
+        Hardlinked objects only need a stat (their link count); symlinks are found by walking directories
+    """
+    store = os.path.realpath(settings.OBJECT_STORE_DIRECTORY)
+    linked = set()
+    for directory in directories:
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [name for name in dirnames if os.path.realpath(os.path.join(root, name)) != store]
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                if os.path.islink(filepath):
+                    linked.add(os.path.realpath(filepath))
+
+    freed = 0
+    for root, _, filenames in os.walk(store):
+        for filename in filenames:
+            object_path = os.path.join(root, filename)
+            stat = os.stat(object_path)
+            # Objects are linked right after they are stored, and linking updates st_ctime, so recent ones may be in use
+            if stat.st_nlink > 1 or object_path in linked or time.time() - stat.st_ctime < settings.OBJECT_GC_MIN_AGE:
+                continue
+            os.remove(object_path)
+            freed += stat.st_size
+    LOGGER.info('Removed {} bytes of unused objects from {}'.format(freed, store))
+    return freed
@@ -4,14 +4,23 @@ import os
 import sys
 from bs4 import BeautifulSoup
 import subprocess
-from ricecooker.utils import downloader, html_writer
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, questions, licenses
 from ricecooker.config import LOGGER              # Use LOGGER to print messages
 from ricecooker.exceptions import raise_for_invalid_channel
 from le_utils.constants import exercises, content_kinds, file_formats, format_presets, languages
 import zipfile
-from ceibal_scrapers import CeibalPageScraper
+from collections import OrderedDict
+from planner import FetchPlan, Scheduler
+from pipeline import ResourcePipeline, Stage
+import checkpoint
+import estimate
+import fetch
+import settings
+import shards
+import storage
+import thumbnails
+from utils import RunCache
 # import tempfile
 import shutil
 
@@ -32,9 +41,7 @@ CHANNEL_THUMBNAIL = "https://yt3.ggpht.com/a/AGF-l78Li2_W_X6fyV3lu6etxgfcFmb1xr7
 # Additional constants
 ################################################################################
 BASE_URL = "https://rea.ceibal.edu.uy/"
-DOWNLOAD_DIRECTORY = os.path.sep.join([os.path.dirname(os.path.realpath(__file__)), "downloads"])
-if not os.path.exists(DOWNLOAD_DIRECTORY):
-    os.makedirs(DOWNLOAD_DIRECTORY)
+DOWNLOAD_DIRECTORY = os.path.sep.join([os.path.dirname(os.path.realpath(__file__)), "downloads"])   # Created by construct_channel
 
 # VIDEO_DIRECTORY = os.path.sep.join([os.path.dirname(os.path.realpath(__file__)), "videos"])
 # if not os.path.exists(VIDEO_DIRECTORY):
@@ -44,6 +51,9 @@ if not os.path.exists(DOWNLOAD_DIRECTORY):
 # if not os.path.exists(DRIVE_DIRECTORY):
 #     os.makedirs(DRIVE_DIRECTORY)
 
+# Maps resource urls to the records read_resource returned for them (see get_resource_record)
+RESOURCE_REGISTRY = RunCache()
+
 LICENSE_MAP = {
     'BY-NC': licenses.CC_BY_NCLicense,
     'BY-NC-SA':licenses.CC_BY_NC_SALicense,
@@ -79,6 +89,13 @@ class CeibalChef(SushiChef):
     # pre_run: to perform preliminary tasks, e.g., crawling and scraping website
     # __init__: if need to customize functionality or add command line arguments
 
+    def run(self, args, options):
+        # Shards only save a manifest for the merge run to upload, and dry runs only log their estimate (see construct_channel)
+        if options.get('shard') or get_flag(options, 'dry_run'):
+            self.construct_channel(**options)
+            return
+        super(CeibalChef, self).run(args, options)
+
     def construct_channel(self, *args, **kwargs):
         """
         Creates ChannelNode and build topic tree
@@ -91,19 +108,70 @@ class CeibalChef(SushiChef):
         """
         channel = self.get_channel(*args, **kwargs)  # Create ChannelNode from data in self.channel_info
 
-        scrape_channel(channel)
+        # from_tree=1: rebuild the tree saved by the last crawl instead of crawling again (tree=<path> to use another checkpoint)
+        tree_path = kwargs.get('tree') or settings.TREE_CHECKPOINT
+        if get_flag(kwargs, 'from_tree'):
+            checkpoint.load_tree(channel, tree_path)
+            raise_for_invalid_channel(channel)
+            return channel
+
+        # merge=N: rebuild the tree from the manifests of a run split in N shards (saved next to the tree checkpoint)
+        if int(kwargs.get('merge') or 0) > 0:
+            shards.merge(channel, os.path.dirname(tree_path), int(kwargs['merge']), add_resource_nodes)
+            checkpoint.save_tree(channel, tree_path)
+            raise_for_invalid_channel(channel)
+            return channel
+
+        os.makedirs(DOWNLOAD_DIRECTORY, exist_ok=True)
+        storage.remove_stale_files(DOWNLOAD_DIRECTORY)
+
+        # dry_run=1: only crawl the listings and estimate the size and duration of a full run
+        if get_flag(kwargs, 'dry_run'):
+            fetch.RECORD_THROUGHPUT = False     # Estimates use the throughput of full runs only
+            dry_run = estimate.Estimate(get_resource_endpoint)
+            scrape_channel(channel, plan=dry_run)
+            dry_run.run()
+            return channel
+
+        # shard=i/N: only scrape the resources that hash to shard i (DOWNLOAD_DIRECTORY should be shared by every shard)
+        if kwargs.get('shard'):
+            shard = shards.Shard(*shards.parse_shard(kwargs['shard']))
+            scrape_channel(channel, plan=shard)
+            records = OrderedDict((url, get_resource_record(url)) for url in shard.get_urls())
+            shards.save_manifest(channel, shard, records, os.path.dirname(tree_path))
+            fetch.save_host_stats()
+            return channel
+
+        # plan=1: list every resource first, then scrape them with a channel-wide fetch plan
+        # pipeline=1: crawl the listings and fetch, rewrite and zip their resources in stages that run at the same time
+        plan = None
+        if get_flag(kwargs, 'plan'):
+            plan = FetchPlan(get_resource_pages)
+        elif get_flag(kwargs, 'pipeline'):
+            plan = create_resource_pipeline()
+        scrape_channel(channel, plan=plan)
+        if plan:
+            scrape_planned_resources(plan)
+        checkpoint.save_tree(channel, tree_path)
+        fetch.save_host_stats()     # Throughput per host, for dry runs to estimate from
+        if get_flag(kwargs, 'gc'):
+            storage.collect_garbage([DOWNLOAD_DIRECTORY])   # gc=1: delete stored outputs the crawl didn't link to
 
         raise_for_invalid_channel(channel)  # Check for errors in channel construction
 
         return channel
 
+def get_flag(options, name):
+    """ Returns True if a key=value option is turned on (values are strings, so plan=0 or gc=false mean off) """
+    return str(options.get(name) or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
 def get_source_id(text):
     return "{}{}".format(BASE_URL, text.lstrip('/').lower().replace(' ', '_'))
 
 
-def scrape_channel(channel):
+def scrape_channel(channel, plan=None):
     # Read from Categorias dropdown menu
-    page = BeautifulSoup(downloader.read(BASE_URL), 'html5lib')
+    page = BeautifulSoup(fetch.read(BASE_URL), 'html5lib')
     dropdown = page.find('a', {'id': 'btn-categorias'}).find_next_sibling('ul')
 
     # Go through dropdown and generate topics and subtopics
@@ -128,37 +196,69 @@ def scrape_channel(channel):
                     topic.add_child(subtopic)
 
                     # Parse resources
-                    scrape_subcategory(subcategory_link, subtopic)
+                    scrape_subcategory(subcategory_link, subtopic, plan=plan)
 
 
-def scrape_subcategory(link, topic):
+def scrape_subcategory(link, topic, plan=None):
     url = "{}{}".format(BASE_URL, link.lstrip("/"))
-    resource_page = BeautifulSoup(downloader.read(url), 'html5lib')
+    resource_page = BeautifulSoup(fetch.read(url), 'html5lib')
 
     # Skip "All" category
     for resource_filter in resource_page.find('div', {'class': 'menu-filtro'}).find_all('a')[1:]:
         LOGGER.info('    {}'.format(resource_filter.text))
         source_id = get_source_id('{}/{}'.format(topic.title, resource_filter.text))
         filter_topic = nodes.TopicNode(title=resource_filter.text, source_id=source_id)
-        scrape_resource_list(url + resource_filter['href'], filter_topic)
+        scrape_resource_list(url + resource_filter['href'], filter_topic, plan=plan)
         topic.add_child(filter_topic)
 
-def scrape_resource_list(url, topic):
-    resource_list_page = BeautifulSoup(downloader.read(url), 'html5lib')
+def scrape_resource_list(url, topic, plan=None):
+    if isinstance(plan, ResourcePipeline):
+        plan.add_listing(url, topic)    # Crawled by the pipeline (see crawl_listing)
+        return
+    for resource_url in list_resources(url):
+        scrape_resource(resource_url, topic, plan=plan)
+
+def list_resources(url):
+    """ Returns the urls of the resources on every page of a listing """
+    resource_list_page = BeautifulSoup(fetch.read(url), 'html5lib')
+    resource_urls = []
 
     # Go through pages, omitting Previous and Next buttons
     for page in range(len(resource_list_page.find_all('a', {'class': 'page-link'})[1:-1])):
         # Use numbers instead of url as the links on the site are also broken
-        resource_list = BeautifulSoup(downloader.read("{}&page={}".format(url, page + 1)), 'html5lib')
-        for resource in resource_list.find_all('a', {'class': 'card-link'}):
-            resource_file = scrape_resource(resource['href'], topic)
+        resource_list = BeautifulSoup(fetch.read("{}&page={}".format(url, page + 1)), 'html5lib')
+        resource_urls.extend(resource['href'] for resource in resource_list.find_all('a', {'class': 'card-link'}))
+    return resource_urls
+
+
+def scrape_resource(url, topic, plan=None):
+    if plan is not None:
+        plan.add_resource(url, topic)   # Scraped once the whole channel has been planned
+        return
+    record = get_resource_record(url)
+    if record:
+        add_resource_nodes(topic, url, record)
 
 
-def scrape_resource(url, topic):
-    resource = BeautifulSoup(downloader.read(url), 'html5lib')
+def get_resource_record(url):
+    """ Returns read_resource(url), only reading each resource once per run however many filters list it """
+    return RESOURCE_REGISTRY.get_or_set(url, lambda: read_resource(url))
+
+def read_resource(url):
+    """ Scrapes a resource page and its zip, returning the metadata used to create its node (None if there's no zip) """
+    return write_resource(rewrite_resource(url))
+
+def rewrite_resource(url):
+    """
+        Scrapes a resource page and rewrites the pages of its zip, returning (metadata used to create its node, zip)
+        where zip is (url, zipper) for write_resource to write, or None if an earlier run wrote it already
+    """
+    resource = BeautifulSoup(fetch.read(url), 'html5lib')
     LOGGER.info('      {}'.format(resource.find('h2').text))
 
-    filepath = download_resource(resource.find('div', {'class': 'decargas'}).find('a')['href'])
+    # The thumbnail is converted while the resource is scraped
+    thumbnail = thumbnails.submit(resource.find('div', {'class': 'img-recurso'}).find('img')['src'])
+    filepath, resource_zip = build_resource_zip(resource.find('div', {'class': 'decargas'}).find('a')['href'])
     license = None
     author = ''
     for data_section in resource.find('div', {'class': 'datos_generales'}).find_all('h4'):
@@ -170,33 +270,157 @@ def scrape_resource(url, topic):
                 license = licenses.CC_BYLicense
         elif 'Autor' in data_section.text:
             author = data_section.find_next_sibling('p').text
-    if filepath:
-        thumbnail = resource.find('div', {'class': 'img-recurso'}).find('img')['src']
-        if thumbnail.endswith('.gif'):
-            thumbnail = os.path.sep.join([DOWNLOAD_DIRECTORY, thumbnail.split('/')[-1].replace('.gif', '.png')])
-            with open(thumbnail, 'wb') as fobj:
-                fobj.write(downloader.read(resource.find('div', {'class': 'img-recurso'}).find('img')['src']))
-
-        topic.add_child(nodes.HTML5AppNode(
-            title=resource.find('h2').text,
-            source_id=url,
-            license=license,
-            author=author,
-            description=resource.find('form').find_all('p')[1].text,
-            thumbnail=thumbnail,
-            tags = [tag.text[:30] for tag in resource.find_all('a', {'class': 'tags'})],
-            files=[files.HTMLZipFile(path=filepath)],
+    if not filepath:
+        return None, None
+
+    return {
+        'title': resource.find('h2').text,
+        'license': license,
+        'author': author,
+        'description': resource.find('form').find_all('p')[1].text,
+        'thumbnail': thumbnail.result(),
+        'tags': [tag.text[:30] for tag in resource.find_all('a', {'class': 'tags'})],
+        'filepath': filepath,
+    }, resource_zip
+
+def write_resource(rewritten):
+    """ Writes the zip rewrite_resource returned, returning the metadata used to create the resource's node (None if there's no zip) """
+    record, resource_zip = rewritten
+    if not record or (resource_zip and not write_resource_zip(record['filepath'], *resource_zip)):
+        return None
+    return dict(record, media=(storage.read_record(record['filepath']) or {}).get('media', []))  # Split out of the zip (see settings.SPLIT_MEDIA)
+
+
+def create_resource_node(url, record):
+    return nodes.HTML5AppNode(
+        title=record['title'],
+        source_id=url,
+        license=record['license'],
+        author=record['author'],
+        description=record['description'],
+        thumbnail=record['thumbnail'],
+        tags=list(record['tags']),
+        files=[files.HTMLZipFile(path=record['filepath'])],
+    )
+
+
+# Node and file classes for media split out of zips, by content kind
+MEDIA_NODE_CLASSES = {
+    content_kinds.VIDEO: (nodes.VideoNode, files.VideoFile),
+    content_kinds.AUDIO: (nodes.AudioNode, files.AudioFile),
+    content_kinds.DOCUMENT: (nodes.DocumentNode, files.DocumentFile),
+}
+
+def create_media_nodes(record):
+    """ Returns nodes for the media that was split out of a resource's zip (placed next to the resource's node) """
+    media_nodes = []
+    for media in record.get('media', []):
+        node_class, file_class = MEDIA_NODE_CLASSES[media['kind']]
+        media_nodes.append(node_class(
+            title=media['title'],
+            source_id=media['url'],
+            license=record['license'],
+            author=record['author'],
+            files=[file_class(path=media['path'])],
         ))
+    return media_nodes
 
-def download_resource(endpoint):
+def add_resource_nodes(topic, url, record):
+    """ Adds a resource's node and its split media nodes to topic (media shared by several resources is only added once) """
+    source_ids = {child.source_id for child in topic.children}
+    for node in [create_resource_node(url, record)] + create_media_nodes(record):
+        if node.source_id not in source_ids:
+            source_ids.add(node.source_id)
+            topic.add_child(node)
+
+
+def get_resource_scraper(resource):
+    from ceibal_scrapers import CeibalPageScraper     # The scraper hierarchy is only loaded once a resource is scraped
+    return CeibalPageScraper(get_resource_url(resource.find('div', {'class': 'decargas'}).find('a')['href']), locale='es')
+
+
+def get_resource_pages(url):
+    """ Downloads the pages read to scrape a resource, returning [(page url, read options, contents)] """
+    contents = fetch.read(url)
+    scraper = get_resource_scraper(BeautifulSoup(contents, 'html5lib'))
+    options = {'loadjs': scraper.loadjs}
+    return [(url, {}, contents), (scraper.url, options, fetch.read(scraper.url, **options))]
+
+
+def prefetch_resource(url):
+    """ Pipeline fetch stage: downloads the pages of a resource, returning (url, get_resource_pages(url)) """
+    return url, get_resource_pages(url)
+
+def rewrite_prefetched_resource(prefetched):
+    """ Pipeline rewrite stage: rewrites a resource from the pages downloaded by prefetch_resource (see rewrite_resource) """
+    url, pages = prefetched
+    for page_url, options, contents in pages:
+        fetch.pin(page_url, contents, **options)
+    try:
+        return rewrite_resource(url)
+    finally:
+        for page_url, options, contents in pages:
+            fetch.unpin(page_url, **options)
+
+def crawl_listing(listing):
+    """ Pipeline crawl stage: returns (resource url, topic) for every resource on a listing added with add_listing """
+    url, topic = listing
+    return [(resource_url, topic) for resource_url in list_resources(url)]
+
+
+def create_resource_pipeline():
+    return ResourcePipeline([
+        Stage('crawl', crawl_listing, workers=settings.PIPELINE_CRAWL_WORKERS, expand=True),
+        Stage('fetch', prefetch_resource, workers=settings.PIPELINE_FETCH_WORKERS),
+        Stage('rewrite', rewrite_prefetched_resource, workers=settings.PIPELINE_REWRITE_WORKERS, processes=settings.PIPELINE_REWRITE_PROCESSES),
+        Stage('zip', write_resource, workers=settings.PIPELINE_ZIP_WORKERS),
+    ])
+
+
+def scrape_planned_resources(plan):
+    """ Scrapes every resource in plan once, then adds its node to each topic it was listed under """
+    if isinstance(plan, ResourcePipeline):
+        records = plan.close()
+    else:
+        plan.discover()
+        records = Scheduler(plan, get_resource_record).run()
+    for url, topic in plan.entries:
+        if records.get(url):
+            add_resource_nodes(topic, url, records[url])
+
+def get_resource_endpoint(contents):
+    """ Returns the url of the page scraped for a resource, given its detail page """
+    resource = BeautifulSoup(contents, 'html5lib')
+    return get_resource_url(resource.find('div', {'class': 'decargas'}).find('a')['href'])
+
+def get_resource_url(endpoint):
+    return '{}{}'.format(BASE_URL, endpoint.lstrip('/'))
+
+def build_resource_zip(endpoint):
+    """ Returns (path of a resource's zip, (url, zipper) to write it with or None if an earlier run wrote it already) """
     try:
-        url = '{}{}'.format(BASE_URL, endpoint.lstrip('/'))
+        url = get_resource_url(endpoint)
         filename, ext = os.path.splitext(endpoint)
-        filename = '{}.zip'.format(filename.lstrip('/').replace('/', '-'))
-        write_to_path = CeibalPageScraper(url, locale='es').to_file(filename=filename, directory=DOWNLOAD_DIRECTORY)
-        return write_to_path
+        write_to_path = os.path.join(DOWNLOAD_DIRECTORY, '{}.zip'.format(filename.lstrip('/').replace('/', '-')))
+        from ceibal_scrapers import CeibalPageScraper
+        scraper = CeibalPageScraper(url, locale='es')
+        if storage.is_complete(write_to_path, validate=scraper.validate_file):
+            return write_to_path, None
+        with fetch.deadline(settings.RESOURCE_DEADLINE):
+            return write_to_path, (url, scraper.build_zip())
+    except Exception as e:
+        LOGGER.error(str(e))
+        return None, None
+
+def write_resource_zip(write_to_path, url, zipper):
+    """ Writes a zip built by build_resource_zip (only moved to write_to_path once it's complete) """
+    from pages import write_zip
+    try:
+        storage.write_atomic(write_to_path, lambda temp_path: write_zip(zipper, temp_path), url=url)
+        return True
     except Exception as e:
         LOGGER.error(str(e))
+        return False
 
 
 # CLI
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 import os
-from ricecooker.utils import downloader
 from ricecooker.config import LOGGER              # Use LOGGER to print messages
-import cssutils
-import logging
 from le_utils.constants import content_kinds
-cssutils.log.setLevel(logging.FATAL)
 
-from utils import EXCEPTIONS, BasicScraper, BrokenSourceException, UnscrapableSourceException, MESSAGES
+from utils import EXCEPTIONS, BasicScraper, BrokenSourceException, UnscrapableSourceException, MESSAGES, minify_css, minify_js, \
+    CSS_URL_REGEX, find_matches, rewrite_matches
+import fetch
+import settings
+
+# Kinds of the nodes created for media moved out of zips (see BasicScraperTag.split_media)
+SPLIT_MEDIA_KINDS = {
+    '.mp4': content_kinds.VIDEO,
+    '.webm': content_kinds.VIDEO,
+    '.mp3': content_kinds.AUDIO,
+    '.pdf': content_kinds.DOCUMENT,
+}
+SPLIT_MEDIA_ELEMENTS = ['audio', 'video', 'source', 'embed']     # Elements whose src can be split out
 
 class BasicScraperTag(BasicScraper):
     default_attribute = 'src'
@@ -64,6 +72,34 @@ class BasicScraperTag(BasicScraper):
         self.tag[self.attribute] = self.format_url(self.write_url(self.link))
         return self.tag[self.attribute]
 
+    def split_media(self, tag):
+        """ Moves the media tag plays out of the zip if settings.SPLIT_MEDIA is on and it's large, returning the tag to use instead """
+        if not settings.SPLIT_MEDIA or not tag:
+            return tag
+        # Check every src the tag plays, as it can come after others (e.g. SoundCloud's artwork)
+        elements = ([tag] if tag.name in SPLIT_MEDIA_ELEMENTS else []) + tag.find_all(SPLIT_MEDIA_ELEMENTS)
+        for element in elements:
+            path = (element.get('src') or '').split('#')[0].split('?')[0]
+            kind = SPLIT_MEDIA_KINDS.get(os.path.splitext(path)[1].lower())
+            if kind and path in self.zipper.split_media:
+                # Already split for an earlier tag (the zipper treats it as present, so it wasn't downloaded again)
+                return self.create_split_media_message(self.zipper.split_media[path]['title'])
+            if kind and (self.zipper.get_size(path) or 0) >= settings.SPLIT_MEDIA_MIN_BYTES:
+                break
+        else:
+            return tag
+
+        title = self.tag.get('title') or self.tag.get_text(strip=True) or os.path.basename(path)
+        filepath = os.path.join(settings.SPLIT_MEDIA_DIRECTORY, os.path.basename(path))
+        if not self.zipper.split(path, filepath, kind=kind, url=self.link, title=title):
+            return tag
+        return self.create_split_media_message(title)
+
+    def replace_tag(self, new_tag):
+        if new_tag is not self.tag:
+            self.tag.replaceWith(new_tag)
+            self.tag = new_tag
+
     def handle_error(self):
         self.tag.replaceWith(self.create_broken_link_message(self.link))
 
@@ -83,15 +119,17 @@ class ImageTag(BasicScraperTag):
 class MediaTag(BasicScraperTag):
     directory = "media"
     config = {
-        'controls': 'controls',
-        'preload': 'auto'
+        'controls': 'controls',     # preload is set by the output profile (see utils.apply_output_profile)
     }
     def process(self):
         if self.tag.find('source'):
             for source in self.tag.find_all('source'):
-                self.source_class(source, self.zipper, self.url)
+                self.source_class(source, self.url, zipper=self.zipper, triaged=self.triaged, locale=self.locale, color=self.color).scrape()
+            self.replace_tag(self.split_media(self.tag))
         else:
-            return super(MediaTag, self).process()
+            path = super(MediaTag, self).process()
+            self.replace_tag(self.split_media(self.tag))
+            return path
 
 class SourceTag(BasicScraperTag):
     selector = ('source',)
@@ -126,16 +164,14 @@ class StyleTag(BasicScraperTag):
             self.tag.decompose()
             return
 
-        # Parse urls in css (using parseString because it is much faster than parseUrl)
-        style_sheet = downloader.read(self.link).decode('utf-8-sig', errors='ignore')
-        sheet = cssutils.parseString(style_sheet)
-        for css_url in cssutils.getUrls(sheet):
-            if not css_url.startswith('data:image') and not css_url.startswith('data:application'):
-                try:
-                    style_sheet = style_sheet.replace(css_url, os.path.basename(self.write_url(css_url, url=self.link, default_ext='.png')))
-                except EXCEPTIONS as e:
-                    LOGGER.warn('Unable to download stylesheet url at {} ({})'.format(self.url, str(e)))
+        # Download urls in css (relative to the style sheet, which is written next to them)
+        style_sheet = fetch.read(self.link).decode('utf-8-sig', errors='ignore')
+        css_urls = [css_url for css_url in find_matches(CSS_URL_REGEX, style_sheet) if not css_url.startswith(('data:', '#'))]
+        paths = self.write_urls(css_urls, url=self.link, default_ext='.png')
+        style_sheet = rewrite_matches(CSS_URL_REGEX, style_sheet, lambda css_url: os.path.basename(paths[css_url]) if css_url in paths else None)
 
+        if settings.MINIFY_ASSETS:
+            style_sheet = minify_css(style_sheet)
         self.tag[self.attribute] = self.format_url(self.write_contents(self.get_filename(self.link), style_sheet))
         return self.tag[self.attribute]
 
@@ -154,6 +190,13 @@ class ScriptTag(BasicScraperTag):
             return
         elif 'google' in self.link:
             self.tag.decompose()
+        elif settings.MINIFY_ASSETS:
+            filename = self.get_filename(self.link)
+            if not self.zipper.contains('{}/{}'.format(self.directory, filename)):
+                script = fetch.read(self.link).decode('utf-8-sig', errors='ignore')
+                self.write_contents(filename, minify_js(script))
+            self.tag[self.attribute] = self.format_url('{}/{}'.format(self.directory, filename))
+            return self.tag[self.attribute]
         else:
             return super(ScriptTag, self).process()
 
@@ -168,7 +211,7 @@ class LinkedPageTag(BasicScraperTag):
             if handler.test(self.link):
                 return handler
 
-        downloader.read(self.link) # Will raise an error if this is broken
+        fetch.read(self.link) # Will raise an error if this is broken
         raise UnscrapableSourceException
 
 
@@ -183,7 +226,8 @@ class EmbedTag(LinkedPageTag):
     def process(self):
         scraper_class = self.get_scraper()
         scraper = scraper_class(self.link, locale=self.locale, triaged=self.triaged, zipper=self.zipper)
-        scraper.to_zip(filename=self.get_filename(self.link))
+        self.tag[self.attribute] = scraper.to_zip(filename=self.get_filename(self.link))
+        self.replace_tag(self.split_media(self.tag))
 
 
 class LinkTag(LinkedPageTag):
@@ -210,10 +254,17 @@ class LinkTag(LinkedPageTag):
             self.handle_error()
 
         elif not self.triaged.get(self.link):
-            self.triaged[self.link] = self.get_filename(self.link)
+            scraper_class = self.get_scraper()
+            if scraper_class.kind == content_kinds.HTML5:
+                filename = self.scrape_subpage(scraper_class, self.link)
+                if not filename:
+                    self.handle_error()
+                    return
+                self.tag[self.attribute] = filename
+                return
 
+            self.triaged[self.link] = self.get_filename(self.link)
             if not self.zipper.contains(self.triaged[self.link]):
-                scraper_class = self.get_scraper()
                 scraper = scraper_class(self.link, locale=self.locale, triaged=self.triaged, zipper=self.zipper)
                 self.triaged[self.link] = scraper.to_zip()
             self.tag[self.attribute] = self.triaged[self.link]
@@ -252,14 +303,15 @@ class IframeTag(LinkedPageTag):
             self.tag.decompose()
         else:
             scraper_class = self.get_scraper()
-            scraper = scraper_class(self.link, locale=self.locale, triaged=self.triaged, zipper=self.zipper)
 
-            if scraper.kind != content_kinds.HTML5:
-                new_tag = scraper.to_tag()
-                self.tag.replaceWith(new_tag)
-                self.tag = new_tag
+            if scraper_class.kind != content_kinds.HTML5:
+                scraper = scraper_class(self.link, locale=self.locale, triaged=self.triaged, zipper=self.zipper)
+                self.replace_tag(self.split_media(scraper.to_tag()))
             else:
-                self.tag[self.attribute] = scraper.to_zip()
+                filename = self.scrape_subpage(scraper_class, self.link)
+                if not filename:
+                    raise UnscrapableSourceException('Subpage budget exceeded at {}'.format(self.link))
+                self.tag[self.attribute] = filename
 
 COMMON_TAGS = [
     ImageTag,
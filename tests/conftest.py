@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The chef's modules are flat files at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+
+def read_fixture(filename):
+    with open(os.path.join(FIXTURES_DIRECTORY, filename), encoding='utf-8') as fobj:
+        return fobj.read()
@@ -0,0 +1,107 @@
+import zipfile
+
+import pytest
+import requests
+
+import crawler
+import settings
+from crawler import SubpageCache, SubpageCrawler
+from utils import BasicScraper
+from zipper import ZipWriter
+
+SITE = 'http://example.com/'
+
+# Maps page names to the pages they link to ('index' is the zip's index.html)
+LINKS = {
+    'a': ['c'],
+    'b': ['d', 'index'],
+    'c': [],
+    'd': [],
+    'dead': [],
+}
+
+
+class FakePage(BasicScraper):
+    """ Writes a page linking to LINKS[name] and an image shared by every page """
+    cacheable = True
+    scraped = []
+
+    @classmethod
+    def prefetch_filename(cls, url):
+        return '{}.html'.format(url.rsplit('/', 1)[-1])
+
+    def to_zip(self, filename=None):
+        name = self.url.rsplit('/', 1)[-1]
+        self.scraped.append(name)
+        if name == 'dead':
+            raise requests.exceptions.HTTPError('404')
+        links = []
+        for link in LINKS[name]:
+            url = SITE + link
+            links.append(self.triaged.get(url) or self.crawler.enqueue(FakePage, url, self.depth + 1))
+        self.zipper.write_contents('shared.png', b'png', directory='img')
+        return self.zipper.write_contents(filename, ' '.join(filter(None, links)))
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(crawler, 'SUBPAGE_CACHE', SubpageCache())
+    monkeypatch.setattr(FakePage, 'scraped', [])
+
+
+def crawl(path, links, **kwargs):
+    """ Writes a zip whose index.html links to links, returning the crawler """
+    with ZipWriter(str(path)) as zipper:
+        subpages = SubpageCrawler(zipper, triaged={SITE + 'index': 'index.html'}, workers=1, **kwargs)
+        zipper.write_index_contents(' '.join(subpages.enqueue(FakePage, SITE + link, 1) or '' for link in links))
+        subpages.run()
+    return subpages
+
+
+def read_zip(path):
+    with zipfile.ZipFile(str(path)) as zf:
+        return {name: zf.read(name).decode('utf-8') for name in zf.namelist()}
+
+
+def test_subpages_are_scraped_breadth_first(tmp_path):
+    crawl(tmp_path / 'out.zip', ['a', 'b'])
+    assert FakePage.scraped == ['a', 'b', 'c', 'd']
+    assert read_zip(tmp_path / 'out.zip')['b.html'] == 'd.html index.html'
+
+
+def test_subpage_budgets(tmp_path):
+    crawl(tmp_path / 'depth.zip', ['a', 'b'], max_depth=1)
+    assert FakePage.scraped == ['a', 'b']
+    assert 'c.html' not in read_zip(tmp_path / 'depth.zip')
+
+    FakePage.scraped[:] = []
+    crawl(tmp_path / 'pages.zip', ['a', 'b'], max_pages=3)
+    assert FakePage.scraped == ['a', 'b', 'c']
+
+
+def test_dead_links_get_placeholders(tmp_path):
+    crawl(tmp_path / 'out.zip', ['dead'])
+    entries = read_zip(tmp_path / 'out.zip')
+    assert 'copy-link' in entries['dead.html']
+    assert 'js/copy-link.js' in entries
+
+
+def test_cached_subpages_are_replayed_into_other_zips(tmp_path):
+    crawl(tmp_path / 'first.zip', ['a'])
+    crawl(tmp_path / 'second.zip', ['a'])
+    assert FakePage.scraped == ['a', 'c']       # Not scraped again for the second zip
+    assert read_zip(tmp_path / 'second.zip') == read_zip(tmp_path / 'first.zip')
+
+
+def test_pages_linking_to_index_are_not_cached(tmp_path):
+    crawl(tmp_path / 'first.zip', ['b'])
+    crawl(tmp_path / 'second.zip', ['b'])
+    assert FakePage.scraped == ['b', 'd', 'b']  # b links to the first zip's index.html, d can be reused
+
+
+def test_cache_key_includes_locale_and_output_settings(tmp_path, monkeypatch):
+    crawl(tmp_path / 'first.zip', ['c'])
+    crawl(tmp_path / 'spanish.zip', ['c'], locale='es')
+    monkeypatch.setattr(settings, 'COMPACT_HTML', not settings.COMPACT_HTML)
+    crawl(tmp_path / 'compact.zip', ['c'])
+    assert FakePage.scraped == ['c', 'c', 'c']
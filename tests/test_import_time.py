@@ -0,0 +1,10 @@
+import import_time
+
+
+def test_chef_imports_within_budget():
+    seconds = min(import_time.time_import(import_time.MODULE)[0] for _ in range(import_time.RUNS))
+    assert seconds <= import_time.IMPORT_TIME_BUDGET
+
+
+def test_lazy_modules_are_not_imported():
+    assert import_time.get_lazy_imports() == []
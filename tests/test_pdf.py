@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+import pytest
+
+import pdf
+import settings
+
+ORIGINAL = b'%PDF-1.4 original' * 64
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'OPTIMIZE_PDFS', True)
+    monkeypatch.setattr(settings, 'PDF_MIN_BYTES', 0)
+    monkeypatch.setattr(settings, 'PDF_CACHE_DIRECTORY', str(tmp_path / 'pdf'))
+    monkeypatch.setattr(settings, 'OBJECT_STORE', None)
+    monkeypatch.setattr(pdf, 'RESULTS', pdf.RunCache())
+    monkeypatch.setattr(pdf, 'get_tools', lambda: [pdf.QPDF_COMMAND])
+    return tmp_path / 'pdf'
+
+
+def test_optimized_pdfs_are_cached(cache, monkeypatch):
+    monkeypatch.setattr(pdf, 'run_tools', lambda contents: b'%PDF-1.4 small')
+    assert pdf.optimize(ORIGINAL) == b'%PDF-1.4 small'
+    assert os.path.exists(str(cache / '{}.pdf'.format(hashlib.md5(ORIGINAL).hexdigest())))
+
+
+def test_originals_are_not_copied_to_the_cache(cache, monkeypatch):
+    monkeypatch.setattr(pdf, 'run_tools', lambda contents: contents + b'larger')
+    assert pdf.optimize(ORIGINAL) == ORIGINAL
+    assert all(os.path.getsize(str(cache / name)) == 0 for name in os.listdir(str(cache)) if not name.startswith('.'))
+
+    # Later runs know the tools didn't help without running them again
+    monkeypatch.setattr(pdf, 'RESULTS', pdf.RunCache())
+    monkeypatch.setattr(pdf, 'run_tools', lambda contents: pytest.fail('pdf was optimised again'))
+    assert pdf.optimize(ORIGINAL) == ORIGINAL
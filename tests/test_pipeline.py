@@ -0,0 +1,41 @@
+import os
+from concurrent.futures import BrokenExecutor
+
+import pytest
+
+import pipeline
+from pipeline import Pipeline, ResourcePipeline, Stage
+
+
+def list_resources(listing):
+    url, topic = listing
+    return [('{}/{}'.format(url, page), topic) for page in range(3)] + [('shared', topic)]
+
+
+def exit_worker(item):
+    os._exit(1)
+
+
+def test_listings_are_expanded_in_listing_order():
+    plan = ResourcePipeline([
+        Stage('crawl', list_resources, workers=2, expand=True),
+        Stage('build', str.upper, workers=2),
+    ])
+    for url in ['a', 'b']:
+        plan.add_listing(url, url.upper())
+    records = plan.close()
+
+    assert records['a/1'] == 'A/1'
+    assert records['shared'] == 'SHARED'        # Built once, however often it is listed
+    assert plan.entries == [
+        ('a/0', 'A'), ('a/1', 'A'), ('a/2', 'A'), ('shared', 'A'),
+        ('b/0', 'B'), ('b/1', 'B'), ('b/2', 'B'), ('shared', 'B'),
+    ]
+
+
+@pytest.mark.skipif(not pipeline.get_process_context(), reason='worker processes need the forkserver')
+def test_broken_process_pool_fails_loudly():
+    plan = Pipeline([Stage('build', exit_worker, processes=True)])
+    plan.put(1)
+    with pytest.raises(BrokenExecutor):
+        plan.close()
@@ -0,0 +1,47 @@
+import pytest
+
+import fetch
+from planner import FetchPlan, Scheduler
+from utils import RunCache
+
+SITE = 'http://example.com/'
+
+PAGES = {
+    SITE + 'a': '<img src="shared.png"><img src="a.png">',
+    SITE + 'b': '<img src="shared.png"><img src="b.png">',
+}
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    requested = []
+    def request(url):
+        requested.append(url)
+        return PAGES.get(url, b'asset')
+    monkeypatch.setattr(fetch, 'request', request)
+    monkeypatch.setattr(fetch, 'RECORD_THROUGHPUT', False)
+    monkeypatch.setattr(fetch, 'PINNED', {})
+    monkeypatch.setattr(fetch, 'ASSET_CACHE', RunCache(max_size=1, sizeof=len))   # Evicts everything right away
+    return requested
+
+
+def get_pages(url):
+    return [(url, {}, fetch.read(url))]
+
+
+def build(url):
+    """ Reads what a resource's zip needs, like a scraper would """
+    return [fetch.read(url), fetch.read(SITE + 'shared.png')]
+
+
+def test_planned_pages_and_assets_outlast_the_fetch_cache(downloads):
+    plan = FetchPlan(get_pages, workers=1)
+    for url in PAGES:
+        plan.add_resource(url, None)
+    plan.discover()
+    assert plan.get_shared_assets() == [SITE + 'shared.png']
+
+    results = Scheduler(plan, build, fetch_workers=1, build_workers=1).run()
+    assert results[SITE + 'a'] == [PAGES[SITE + 'a'], b'asset']
+    assert sorted(downloads) == sorted(list(PAGES) + [SITE + 'shared.png'])     # Nothing downloaded twice
+    assert fetch.PINNED == {}       # Released once every resource using them was built
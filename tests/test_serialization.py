@@ -0,0 +1,30 @@
+from bs4 import BeautifulSoup
+import pytest
+
+import utils
+from conftest import read_fixture
+
+FIXTURES = ['resource.html', 'article.html']
+
+
+@pytest.mark.parametrize('filename', FIXTURES)
+def test_compact_output_renders_like_prettify(filename):
+    contents = BeautifulSoup(read_fixture(filename), 'html.parser')
+    html = contents.decode(formatter="minimal")
+    assert utils.check_serialization(contents, html)
+
+
+@pytest.mark.parametrize('filename', FIXTURES)
+def test_check_serialization_detects_changes(filename):
+    contents = BeautifulSoup(read_fixture(filename), 'html.parser')
+    html = contents.decode(formatter="minimal").replace('</h', ' extra</h', 1)
+    assert not utils.check_serialization(contents, html)
+
+
+def test_minify_css_keeps_strings():
+    style_sheet = '[title="x > y"] > p , a { content: "a, b" ; } /* c, d */ q { content: \'it\\\'s ; \' ; }'
+    assert utils.minify_css(style_sheet) == '[title="x > y"]>p,a{content: "a, b"}q{content: \'it\\\'s ; \'}'
+
+
+def test_minify_css_removes_comments():
+    assert utils.minify_css('a/* x */b { color : red ; }') == 'a b{color : red}'
@@ -0,0 +1,140 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from ricecooker.classes import licenses, nodes
+
+import shards
+import storage
+
+
+def get_dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+    return path
+
+
+def test_remove_stale_files_walks_subdirectories(tmpdir):
+    pid = get_dead_pid()
+    stale = touch(os.path.join(str(tmpdir), 'thumbnails', '{}{}-{}-1-a.png'.format(storage.TEMP_PREFIX, storage.HOSTNAME, pid)))
+    running = touch(os.path.join(str(tmpdir), 'pdf', '{}{}-{}-1-b.pdf'.format(storage.TEMP_PREFIX, storage.HOSTNAME, os.getpid())))
+    output = touch(os.path.join(str(tmpdir), 'media', 'c.mp4'))
+
+    storage.remove_stale_files(str(tmpdir))
+    assert not os.path.exists(stale)
+    assert os.path.exists(running)
+    assert os.path.exists(output)
+
+
+def test_remove_stale_files_keeps_other_hosts_files(tmpdir):
+    # Shards on other machines can write to the same directory, and their pids mean nothing here
+    other = touch(os.path.join(str(tmpdir), '{}other_host-{}-1-a.zip'.format(storage.TEMP_PREFIX, get_dead_pid())))
+    storage.remove_stale_files(str(tmpdir))
+    assert os.path.exists(other)
+
+
+def test_temp_path_names_host_and_keeps_extension():
+    temp_path = storage.get_temp_path(os.path.join('downloads', 'video.mp4'))
+    assert os.path.basename(temp_path).startswith('{}{}-{}-'.format(storage.TEMP_PREFIX, storage.HOSTNAME, os.getpid()))
+    assert temp_path.endswith('video.mp4')
+
+
+def test_outputs_are_recorded_in_one_index_per_directory(tmpdir, monkeypatch):
+    monkeypatch.setattr(storage.settings, 'OBJECT_STORE', None)
+    path = os.path.join(str(tmpdir), 'page.zip')
+    storage.write_contents(path, b'contents', url='http://example.com/page')
+    assert sorted(os.listdir(str(tmpdir))) == [storage.INDEX_FILENAME, 'page.zip']
+    assert storage.is_complete(path)
+
+    # A new process (or another worker) only has the index to go on
+    monkeypatch.setattr(storage, 'INDEXES', {})
+    assert storage.read_record(path)['url'] == 'http://example.com/page'
+    assert storage.is_complete(path)
+
+    with open(path, 'wb') as fobj:
+        fobj.write(b'changed')
+    assert not storage.is_complete(path)
+
+
+def test_shard_manifests_merge_in_listing_order(tmpdir):
+    urls = ['http://example.com/resource/{}'.format(index) for index in range(6)]
+    assert {shards.get_shard(url, 2) for url in urls} == {0, 1}
+
+    channel = nodes.ChannelNode(source_domain='example.com', source_id='channel', title='Channel', language='es')
+    topics = [nodes.TopicNode(title=title, source_id=title) for title in ('first', 'second')]
+    for topic in topics:
+        channel.add_child(topic)
+    entries = [(url, topics[index % 2]) for index, url in enumerate(urls)]
+
+    # Every shard lists every resource, but only scrapes its own
+    for index in range(2):
+        shard = shards.Shard(index, 2)
+        for url, topic in entries:
+            shard.add_resource(url, topic)
+        records = {url: {'title': url, 'license': licenses.CC_BYLicense('Ceibal')} for url in shard.get_urls()}
+        shards.save_manifest(channel, shard, records, str(tmpdir))
+
+    merged = []
+    def add_resource_nodes(topic, url, record):
+        merged.append((topic.title, url, record['license'].license_id))
+
+    shards.merge(nodes.ChannelNode(source_domain='example.com', source_id='channel', title='Channel', language='es'),
+        str(tmpdir), 2, add_resource_nodes)
+    license_id = licenses.CC_BYLicense('Ceibal').license_id
+    assert merged == [(topic.title, url, license_id) for topic in topics for url, listed in entries if listed is topic]
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    monkeypatch.setattr(storage.settings, 'OBJECT_STORE', 'hardlink')
+    monkeypatch.setattr(storage.settings, 'OBJECT_STORE_DIRECTORY', os.path.join(str(tmpdir), 'objects'))
+    monkeypatch.setattr(storage.settings, 'OBJECT_GC_MIN_AGE', 0)
+    return str(tmpdir)
+
+
+def test_outputs_are_copied_when_they_cant_be_hardlinked(store, monkeypatch):
+    def link(source, destination):
+        raise OSError('cross-device link')
+    monkeypatch.setattr(os, 'link', link)
+
+    path = os.path.join(store, 'page.zip')
+    record = storage.write_contents(path, b'contents')
+    assert not os.path.islink(path)
+    assert os.stat(path).st_nlink == 1
+    with open(storage.get_object_path(record['md5']), 'rb') as fobj:
+        assert fobj.read() == b'contents'
+    assert storage.is_complete(path)
+
+
+def test_outputs_can_be_symlinked(store, monkeypatch):
+    monkeypatch.setattr(storage.settings, 'OBJECT_STORE', 'symlink')
+    path = os.path.join(store, 'page.zip')
+    record = storage.write_contents(path, b'contents')
+    assert os.path.realpath(path) == os.path.realpath(storage.get_object_path(record['md5']))
+    assert storage.is_complete(path)
+
+
+def test_garbage_collection_keeps_linked_and_recent_objects(store, monkeypatch):
+    kept = storage.write_contents(os.path.join(store, 'kept.zip'), b'kept')
+    monkeypatch.setattr(storage.settings, 'OBJECT_STORE', 'symlink')
+    symlinked = storage.write_contents(os.path.join(store, 'symlinked.zip'), b'symlinked')
+    removed = storage.write_contents(os.path.join(store, 'removed.zip'), b'removed')
+    os.remove(os.path.join(store, 'removed.zip'))
+
+    # The unlinked object may still be about to be linked by another run
+    monkeypatch.setattr(storage.settings, 'OBJECT_GC_MIN_AGE', 60 * 60)
+    assert storage.collect_garbage([store]) == 0
+    assert os.path.exists(storage.get_object_path(removed['md5']))
+
+    monkeypatch.setattr(storage.settings, 'OBJECT_GC_MIN_AGE', 0)
+    assert storage.collect_garbage([store]) == len(b'removed')
+    assert not os.path.exists(storage.get_object_path(removed['md5']))
+    assert os.path.exists(storage.get_object_path(kept['md5']))
+    assert os.path.exists(storage.get_object_path(symlinked['md5']))
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+from bs4 import BeautifulSoup
+
+import fetch
+import settings
+from ceibal_scrapers import CeibalAudioTag, CeibalVideoTag, SoundCloudScraper
+from tags import IframeTag, VideoTag
+from zipper import ZipWriter
+
+PAGE_URL = 'http://example.com/page.html'
+MEDIA_SIZE = 1024
+
+READS = []
+
+SOUNDCLOUD_PAGE = '<div class="sc-artwork"><span style="background-image:url(http://example.com/art.png)"></span></div>'
+
+
+def read(url, loadjs=False):
+    READS.append(url)
+    if loadjs:
+        return SOUNDCLOUD_PAGE
+    return b'x' * MEDIA_SIZE
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'SPLIT_MEDIA', True)
+    monkeypatch.setattr(settings, 'SPLIT_MEDIA_MIN_BYTES', MEDIA_SIZE)
+    monkeypatch.setattr(settings, 'SPLIT_MEDIA_DIRECTORY', str(tmp_path / 'media'))
+    monkeypatch.setattr(settings, 'OBJECT_STORE_DIRECTORY', str(tmp_path / 'objects'))
+    monkeypatch.setattr(fetch, 'read', read)
+    del READS[:]
+    with ZipWriter(str(tmp_path / 'out.zip')) as writer:
+        writer.write_index_contents('<html></html>')
+        yield writer
+
+
+def scrape(tag_class, html, writer, **kwargs):
+    contents = BeautifulSoup('<body>{}</body>'.format(html), 'html.parser')
+    tag_class(contents.find(*tag_class.selector), PAGE_URL, zipper=writer, **kwargs).scrape()
+    return contents
+
+
+def check_split(contents, writer, extension):
+    assert len(writer.split_media) == 1
+    path, media = list(writer.split_media.items())[0]
+    assert path.endswith(extension)
+    assert path not in writer.entries
+    assert writer.contains(path)    # Later tags for the same media don't download it again
+    assert os.path.getsize(media['path']) == MEDIA_SIZE
+    assert not contents.find(['audio', 'video', 'source'])
+
+
+def test_video_sources_are_split(writer):
+    contents = scrape(VideoTag, '<video><source src="movie.mp4" type="video/mp4"></video>', writer)
+    check_split(contents, writer, '.mp4')
+
+
+def test_media_is_only_split_once(writer):
+    html = '<video><source src="movie.mp4" type="video/mp4"></video>'
+    check_split(scrape(VideoTag, html, writer), writer, '.mp4')
+    contents = scrape(VideoTag, html, writer)
+    check_split(contents, writer, '.mp4')
+    assert READS == ['http://example.com/movie.mp4']
+    assert contents.find('div', {'class': 'split-media'})
+
+
+def test_ceibal_video_is_split(writer):
+    contents = scrape(CeibalVideoTag, '<div class="mejs-video"><video><source src="clip.mp4"></video></div>', writer)
+    check_split(contents, writer, '.mp4')
+
+
+def test_ceibal_audio_is_split(writer):
+    contents = scrape(CeibalAudioTag, '<div class="mejs-audio"><audio src="song.mp3"></audio></div>', writer)
+    check_split(contents, writer, '.mp3')
+
+
+def test_soundcloud_audio_is_split_after_artwork(writer, monkeypatch):
+    def to_zip(self, filename=None):
+        return self.zipper.write_contents('song.mp3', read(self.url), directory=self.directory)
+
+    monkeypatch.setattr(SoundCloudScraper, 'to_zip', to_zip)
+    contents = scrape(IframeTag, '<iframe src="https://soundcloud.com/artist/song"></iframe>', writer,
+        extra_scrapers=[SoundCloudScraper])
+    check_split(contents, writer, '.mp3')
+    assert any(path.startswith('webimg/') for path in writer.entries)  # The artwork stays in the zip
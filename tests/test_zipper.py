@@ -0,0 +1,76 @@
+import os
+import pickle
+import zipfile
+
+import pytest
+
+import settings
+import zipper
+from zipper import ZipWriter
+
+ENTRIES = {
+    'index.html': '<html><body>{}</body></html>'.format('<p>Hola</p>' * 500),
+    'css/style.css': 'body { color: red; }\n' * 200,
+    'js/tiny.js': 'x',
+    'img/photo.png': os.urandom(4096),
+}
+
+
+def write_zip(path):
+    with ZipWriter(path) as writer:
+        for filename, contents in ENTRIES.items():
+            writer.write_contents(filename, contents)
+
+
+def check_zip(path):
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        for filename, contents in ENTRIES.items():
+            expected = contents.encode('utf-8') if isinstance(contents, str) else contents
+            assert zf.read(filename) == expected
+        assert zf.getinfo('index.html').compress_type == zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.skipif(not zipper.can_write_precompressed(), reason='precompressed writes are off on this python')
+def test_precompressed_entries_are_valid(tmp_path):
+    path = str(tmp_path / 'out.zip')
+    write_zip(path)
+    check_zip(path)
+
+
+def test_fallback_entries_are_valid(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipper, 'can_write_precompressed', lambda: False)
+    path = str(tmp_path / 'out.zip')
+    write_zip(path)
+    check_zip(path)
+
+
+def test_entries_added_after_split_keep_their_contents(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECT_STORE_DIRECTORY', str(tmp_path / 'objects'))
+    videos = {name: os.urandom(1024) for name in ('a.mp4', 'b.mp4', 'c.mp4')}
+    path = str(tmp_path / 'out.zip')
+    with ZipWriter(path) as writer:
+        writer.write_index_contents('<html></html>')
+        writer.write_contents('a.mp4', videos['a.mp4'])
+        writer.write_contents('b.mp4', videos['b.mp4'])
+        assert writer.split('a.mp4', str(tmp_path / 'media' / 'a.mp4'))
+        writer.write_contents('c.mp4', videos['c.mp4'])     # Spooled after an entry was removed
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert 'a.mp4' not in zf.namelist()
+        assert zf.read('b.mp4') == videos['b.mp4']
+        assert zf.read('c.mp4') == videos['c.mp4']
+    with open(str(tmp_path / 'media' / 'a.mp4'), 'rb') as fobj:
+        assert fobj.read() == videos['a.mp4']
+
+
+def test_zip_built_elsewhere_is_written_after_pickling(tmp_path):
+    # Pipelines can rewrite pages in a worker process and write their zip in another (see pages.HTMLPageScraper.build_zip)
+    writer = ZipWriter(None)
+    writer.open()
+    for filename, contents in ENTRIES.items():
+        writer.write_contents(filename, contents)
+    path = str(tmp_path / 'out.zip')
+    pickle.loads(pickle.dumps(writer)).close(write_to_path=path)
+    check_zip(path)
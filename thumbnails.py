@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Node thumbnails
+
+    Thumbnails are downloaded, decoded (only the first frame of animated gifs), cropped and resized to
+    settings.THUMBNAIL_SIZE, then kept as pngs named after the hash of their source url, so later runs
+    reuse them. They are converted in a pool of their own while the resource's pages are scraped
+"""
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import fetch
+import settings
+import storage
+from utils import EXCEPTIONS, RunCache
+
+POOL = ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS)
+FUTURES = RunCache()        # Maps source urls to the futures converting them (each url is converted once per run)
+
+
+def get_thumbnail_path(url):
+    return os.path.join(settings.THUMBNAIL_DIRECTORY, '{}.png'.format(hashlib.md5(url.encode('utf-8')).hexdigest()))
+
+def convert_thumbnail(contents, size=None):
+    """ Returns a png of the image in contents cropped to the aspect ratio of size and resized to it """
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(contents))
+    image.seek(0)
+    image = image.convert('RGBA' if image.mode in ('P', 'LA', 'RGBA') else 'RGB')
+    image = ImageOps.fit(image, size or settings.THUMBNAIL_SIZE, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+def create_thumbnail(url):
+    """ Returns the path of the thumbnail for the image at url (None if it can't be read) """
+    path = get_thumbnail_path(url)
+    if storage.is_complete(path):
+        return path
+    try:
+        contents = convert_thumbnail(fetch.read(url))
+    except EXCEPTIONS + (OSError, ValueError) as e:
+        LOGGER.warning('Unable to create thumbnail from {} ({})'.format(url, str(e)))
+        return None
+    os.makedirs(settings.THUMBNAIL_DIRECTORY, exist_ok=True)
+    storage.write_contents(path, contents, url=url)
+    return path
+
+def submit(url):
+    """ Starts creating the thumbnail for url in the background, returning a future for its path """
+    return FUTURES.get_or_set(url, lambda: POOL.submit(create_thumbnail, url))
@@ -1,11 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+import io
+import json
 import os
 from bs4 import BeautifulSoup
+from bs4.element import Tag, NavigableString, PreformattedString
 import requests
 import re
 import hashlib
+import threading
+from collections import OrderedDict
+from html import escape
+from string import Template
 from urllib.parse import urlparse
+from ricecooker.config import LOGGER              # Use LOGGER to print messages
+
+import settings
+
+try:
+    import rjsmin      # Optional, only used when settings.MINIFY_ASSETS is set
+except ImportError:
+    rjsmin = None
 
 MESSAGES = {
     'en': {
@@ -22,7 +37,8 @@ MESSAGES = {
         'toggle_fullscreen': 'Toggle Fullscreen',
         'next': 'Next',
         'previous': 'Previous',
-        'jump_to': 'Jump to...'
+        'jump_to': 'Jump to...',
+        'split_media': 'This content is available as a separate item next to this one',
     },
     'es': {
         'broken_link': 'No se pudo cargar este contenido',
@@ -39,6 +55,7 @@ MESSAGES = {
         'next': 'Siguiente',
         'previous': 'Anterior',
         'jump_to': 'Saltar a ...',
+        'split_media': 'Este contenido está disponible como un elemento aparte junto a este',
 
     }
 }
@@ -53,7 +70,105 @@ class UnscrapableSourceException(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
-EXCEPTIONS = (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.InvalidURL, BrokenSourceException)
+EXCEPTIONS = (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.InvalidURL, BrokenSourceException)
+
+
+class RunCache(object):
+    """
+        Thread-safe memo shared by everything scraped during a run
+        Concurrent lookups of the same key wait for the first one instead of computing it again,
+        and the least recently used items are dropped once the cache holds more than max_size
+    """
+
+    def __init__(self, max_size=None, sizeof=None):
+        """
+            max_size: int              # Maximum total size of cached items (unbounded if None)
+            sizeof: function           # Returns the size of an item (defaults to counting items)
+        """
+        self.items = OrderedDict()
+        self.pending = {}
+        self.size = 0
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.sizeof(self.items.pop(key))
+            self.items[key] = value
+            self.size += self.sizeof(value)
+            while self.max_size and self.size > self.max_size and len(self.items) > 1:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def get_or_set(self, key, factory):
+        """ Returns the cached value for key, calling factory() to create it if it isn't cached yet """
+        while True:
+            with self.lock:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    return self.items[key]
+                event = self.pending.get(key)
+                if not event:
+                    event = self.pending[key] = threading.Event()
+                    break
+            event.wait()    # Another thread is creating this value (loop around in case it failed)
+
+        try:
+            value = factory()
+            self.set(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+
+
+######### TEMPLATES #########
+
+TAG_FACTORY = BeautifulSoup('', 'html.parser')
+
+COPY_LINK_HEADER_TEMPLATE = Template('<p style="font-size: 12pt;margin-bottom: 0px;color: $color;font-weight: bold;">$message</p>')
+
+COPY_LINK_TEMPLATE = Template(
+    '<div class="copy-link" style="text-align: center;">$header'
+    # Add "Please copy this link in your browser to see the original source"
+    '<p style="font-weight: bold;margin-bottom: 10px;color: #555;margin-top:5px;">$subheader</p>'
+    # Add copy link section
+    '<p><input type="text" value="$link" readonly="readonly" style="width: 250px; max-width: 100vw;text-align: center;font-size: 12pt;'
+    'background-color: #EDEDED;border: none;padding: 10px;color: #555;outline:none;"/>'
+    '<button onclick="copyLink(this)" data-text="$copy" data-success="$success" data-failed="$failed" '
+    'style="display: inline-block;cursor: pointer;min-width: 64px;max-width: 100%;min-height: 36px;padding: 0 16px;margin: 8px;'
+    'overflow: hidden;font-size: 14px;font-weight: bold;line-height: 36px;text-align: center;text-decoration: none;text-transform: uppercase;'
+    'white-space: nowrap;cursor: pointer;user-select: none;border: 0;border-radius: 2px;outline: none;background-color:$color;color:white;">$copy</button></p>'
+    '</div>'
+)
+
+# Shown in place of media that was moved out of the zip into its own node
+SPLIT_MEDIA_TEMPLATE = Template(
+    '<div class="split-media" style="text-align: center;">'
+    '<p style="font-size: 12pt;margin-bottom: 0px;color: $color;font-weight: bold;">$title</p>'
+    '<p style="font-weight: bold;margin-bottom: 10px;color: #555;margin-top:5px;">$message</p>'
+    '</div>'
+)
+
+# Written once per zip as js/copy-link.js
+COPY_LINK_SCRIPT = "function copyLink(button) {\n"\
+    "  var text = button.previousElementSibling;\n"\
+    "  text.select();\n"\
+    "  try { document.execCommand('copy'); button.innerHTML = button.getAttribute('data-success'); }\n"\
+    "  catch (e) { button.innerHTML = button.getAttribute('data-failed'); }\n"\
+    "  if (window.getSelection) { window.getSelection().removeAllRanges(); }\n"\
+    "  setTimeout(function() { button.innerHTML = button.getAttribute('data-text'); }, 2500);\n"\
+    "}\n"
 
 
 class BasicScraper(object):
@@ -62,18 +177,22 @@ class BasicScraper(object):
     directory = None
     color = 'rgb(153, 97, 137)'
 
-    def __init__(self, url, locale='en', zipper=None, triaged=None):
+    def __init__(self, url, locale='en', zipper=None, triaged=None, crawler=None, depth=0):
         """
             url: string                                    # URL to read from
             locale: string                                 # Language to use when writing error messages
+            crawler: crawler.SubpageCrawler                # Queue to add subpages to
+            depth: int                                     # Number of links between index.html and this page
         """
         self.url = self.get_relative_url(url)
-        self.triaged = triaged or {}
+        self.triaged = triaged if triaged is not None else {}
         self.locale = locale
         self.zipper = zipper
+        self.crawler = crawler
+        self.depth = depth
 
     def create_tag(self, tag):
-        return BeautifulSoup('', 'html.parser').new_tag(tag)
+        return TAG_FACTORY.new_tag(tag)
 
 
     def get_filename(self, link, default_ext=None):
@@ -103,6 +222,65 @@ class BasicScraper(object):
     def write_url(self, link, url=None, default_ext=None, filename=None, directory=None):
         return self.zipper.write_url(self.get_relative_url(link, url=url), filename or self.get_filename(link, default_ext=default_ext), directory=directory or self.directory)
 
+    def write_urls(self, links, url=None, default_ext=None, directory=None):
+        """ Downloads links in parallel (each url only once per run) and returns {link: zip path} for the ones that worked """
+        from fetch import fetch_all
+        directory = directory or self.directory
+        paths = {}
+        for link in filter(None, links):
+            filename = self.get_filename(link, default_ext=default_ext)
+            paths[link] = '{}/{}'.format(directory, filename) if directory else filename
+
+        # Only download what isn't in the zip yet
+        downloads = fetch_all(self.get_relative_url(link, url=url) for link, path in paths.items() if not self.zipper.contains(path))
+        for link, path in list(paths.items()):
+            contents = downloads.get(self.get_relative_url(link, url=url))
+            if isinstance(contents, Exception):
+                LOGGER.warning('Unable to download {} at {} ({})'.format(link, self.url, str(contents)))
+                del paths[link]
+            elif contents is not None:
+                self.write_contents(os.path.basename(path), contents, directory=directory)
+        return paths
+
+    def rewrite_urls(self, regex, text, url=None, default_ext=None, directory=None):
+        """ Downloads every url matched by regex in text and points the matches to their zip paths """
+        paths = self.write_urls(find_matches(regex, text), url=url, default_ext=default_ext, directory=directory)
+        return rewrite_matches(regex, text, paths.get)
+
+    def write_patched_script(self, link, patch, version, directory=None):
+        """
+            Writes the script at link with patch(script_contents) applied and returns its zip path
+            Patched scripts are kept for the whole run by (url, version), so patch must not depend on the page
+            (bump version whenever patch changes, and pass per-page data with create_data_script instead)
+        """
+        from fetch import read_patched
+        url = self.get_relative_url(link)
+        directory = directory or self.directory
+        filename = '{}-v{}.js'.format(hashlib.md5(url.encode('utf-8')).hexdigest(), version)
+        path = '{}/{}'.format(directory, filename) if directory else filename
+        if not self.zipper.contains(path):
+            self.write_contents(filename, read_patched(url, patch, version), directory=directory)
+        return path
+
+    def create_data_script(self, name, data):
+        """ Returns a <script> tag that sets window.<name> to data (insert it before the scripts that read it) """
+        script = self.create_tag('script')
+        script.string = 'window.{} = {};'.format(name, json.dumps(data).replace('</', '<\\/'))
+        self.mark_tag_to_skip(script)
+        return script
+
+    def scrape_subpage(self, scraper_class, link):
+        """ Returns the zip path link will be written to (None if it's over the crawl budget) """
+        if self.crawler:
+            return self.crawler.enqueue(scraper_class, link, self.depth + 1)
+
+        # Not part of a crawl, so scrape the page right away
+        filename = scraper_class.prefetch_filename(link)
+        self.triaged[link] = filename
+        if not self.zipper.contains(filename):
+            scraper_class(link, locale=self.locale, triaged=self.triaged, zipper=self.zipper).to_zip(filename=filename)
+        return filename
+
     def write_contents(self, filename, contents, directory=None):
         return self.zipper.write_contents(filename, contents, directory=directory or self.directory)
 
@@ -112,78 +290,209 @@ class BasicScraper(object):
     def create_broken_link_message(self, link):
         return self.create_copy_link_message(link, broken=True)
 
-    def create_copy_link_message(self, link, supported_by_kolibri=False, partially_scrapable=False, broken=False):
-        div = self.create_tag('div')
-        div['style'] = 'text-align: center;'
-
+    def get_copy_link_html(self, link, supported_by_kolibri=False, partially_scrapable=False, broken=False):
+        messages = MESSAGES[self.locale]
         header_msg = ''
-        subheader_msg = MESSAGES[self.locale]['copy_text']
+        subheader_msg = messages['copy_text']
 
         if partially_scrapable:
-            header_msg = MESSAGES[self.locale]['partially_supported']
-            subheader_msg = MESSAGES[self.locale]['partially_supported_copy_text']
+            header_msg = messages['partially_supported']
+            subheader_msg = messages['partially_supported_copy_text']
         elif broken:
-            header_msg = MESSAGES[self.locale]['broken_link']
+            header_msg = messages['broken_link']
         elif not supported_by_kolibri:
-            header_msg = MESSAGES[self.locale]['not_supported']
-
-
-        # Add "This content is not able to be viewed from within Kolibri"
-        if header_msg:
-            header = self.create_tag('p')
-            header['style'] = 'font-size: 12pt;margin-bottom: 0px;color: {};font-weight: bold;'.format(self.color)
-            header.string = header_msg
-            div.append(header)
-
-        # Add "Please copy this link in your browser to see the original source"
-        subheader = self.create_tag('p')
-        subheader['style'] = 'font-weight: bold;margin-bottom: 10px;color: #555;margin-top:5px;'
-        subheader.string = subheader_msg
-        div.append(subheader)
-
-        # Add copy link section
-        paragraph = self.create_tag('p')
-        div.append(paragraph)
-        copytext = self.create_tag('input')
-        copytext['type'] = 'text'
-        copytext['value'] = link
-        copytext['style'] = 'width: 250px; max-width: 100vw;text-align: center;font-size: 12pt;'\
-            'background-color: #EDEDED;border: none;padding: 10px;color: #555;outline:none;'
-        copytext['readonly'] = 'readonly'
-        copytext['id'] = "".join(re.findall(r"[a-zA-Z]+", link))
-        paragraph.append(copytext)
-
-        # Add copy button
-        copybutton = self.create_tag('button')
-        copybutton['style'] = 'display: inline-block;cursor: pointer;min-width: 64px;max-width: 100%;min-height: 36px;padding: 0 16px;margin: 8px;'\
-            'overflow: hidden;font-size: 14px;font-weight: bold;line-height: 36px;text-align: center;text-decoration: none;text-transform: uppercase;'\
-            'white-space: nowrap;cursor: pointer;user-select: none;border: 0;border-radius: 2px;outline: none;background-color:{};color:white;'.format(self.color)
-        copybutton.string = MESSAGES[self.locale]['copy_button']
-        copybutton['id'] = 'btn-{}'.format(copytext['id'])
-        copybutton['onclick'] = '{}()'.format(copytext['id'][-15:])  # Keep unique in case there are other copy buttons on the page
-        paragraph.append(copybutton)
-
-        # Add copy script
-        copyscript = self.create_tag('script')
-        copyscript.string = "function {function}(){{ " \
-                            "  let text = document.getElementById('{id}');" \
-                            "  let button = document.getElementById('btn-{id}');" \
-                            "  text.select();" \
-                            "  try {{ document.execCommand('copy'); button.innerHTML = '{success}';}}" \
-                            "  catch (e) {{ button.innerHTML = '{failed}'; }}" \
-                            "  if (window.getSelection) {{window.getSelection().removeAllRanges();}}"\
-                            "  setTimeout(() => {{ button.innerHTML = '{text}';}}, 2500);" \
-                            "}}".format(
-                                id=copytext['id'],
-                                function=copytext['id'][-15:],
-                                success=MESSAGES[self.locale]['copy_success'],
-                                text=MESSAGES[self.locale]['copy_button'],
-                                failed=MESSAGES[self.locale]['copy_error']
-                            )
-        self.mark_tag_to_skip(copyscript)
-        div.append(copyscript)
-
-        return div
+            header_msg = messages['not_supported']
+
+        return COPY_LINK_TEMPLATE.substitute(
+            # Add "This content is not able to be viewed from within Kolibri"
+            header=header_msg and COPY_LINK_HEADER_TEMPLATE.substitute(color=self.color, message=escape(header_msg)),
+            subheader=escape(subheader_msg),
+            link=escape(link),
+            color=self.color,
+            copy=escape(messages['copy_button']),
+            success=escape(messages['copy_success']),
+            failed=escape(messages['copy_error']),
+        )
+
+    def create_copy_link_message(self, link, **kwargs):
+        return BeautifulSoup(self.get_copy_link_html(link, **kwargs), 'html.parser').div
+
+    def create_split_media_message(self, title):
+        html = SPLIT_MEDIA_TEMPLATE.substitute(
+            color=self.color,
+            title=escape(title),
+            message=escape(MESSAGES[self.locale]['split_media']),
+        )
+        return BeautifulSoup(html, 'html.parser').div
+
+    def write_copy_link_script(self):
+        """ Writes the script used by copy link buttons to the zip (shared by every page) """
+        return self.zipper.write_contents('copy-link.js', COPY_LINK_SCRIPT, directory='js')
+
+    def add_copy_link_script(self, contents):
+        """ Links the copy link script from contents if it has any copy link messages """
+        if contents.find('div', {'class': 'copy-link'}):
+            script = self.create_tag('script')
+            script['src'] = self.write_copy_link_script()
+            self.mark_tag_to_skip(script)
+            (contents.head or contents.body or contents).append(script)
+
+
+######### SERIALIZATION #########
+
+# Comments and quoted strings in css (strings are kept as they are, e.g. content: "a, b" or [title="x > y"])
+CSS_TOKEN_REGEX = re.compile(r'(/\*.*?\*/)|("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', re.DOTALL)
+CSS_PLACEHOLDER_REGEX = re.compile(r'\x00(\d+)\x00')
+CSS_SPACE_REGEX = re.compile(r'\s+')
+CSS_PUNCTUATION_REGEX = re.compile(r'\s*([{};,>])\s*')
+JS_TYPES = (None, '', 'text/javascript', 'application/javascript', 'module')
+RJSMIN_WARNING = threading.Event()      # Set once the missing rjsmin has been reported
+
+def minify_css_code(code):
+    code = CSS_SPACE_REGEX.sub(' ', code)
+    code = CSS_PUNCTUATION_REGEX.sub(r'\1', code)
+    return code.replace(';}', '}').strip()
+
+def minify_css(style_sheet):
+    """ Removes comments and unnecessary whitespace from a style sheet (leaving quoted strings untouched) """
+    strings = []
+
+    def hold(match):
+        if not match.group(2):
+            return ' '      # Comments can separate tokens, so leave a space (dropped next to punctuation)
+        strings.append(match.group(2))
+        return '\x00{}\x00'.format(len(strings) - 1)
+
+    style_sheet = minify_css_code(CSS_TOKEN_REGEX.sub(hold, style_sheet))
+    return CSS_PLACEHOLDER_REGEX.sub(lambda match: strings[int(match.group(1))], style_sheet)
+
+def minify_js(script):
+    """ Minifies javascript if rjsmin is available (js is left untouched otherwise) """
+    if not rjsmin:
+        if not RJSMIN_WARNING.is_set():
+            RJSMIN_WARNING.set()
+            LOGGER.warning('rjsmin is not installed, so javascript is not minified (pip install rjsmin)')
+        return script
+    return rjsmin.jsmin(script)
+
+# What generated pages make devices download as soon as they are opened (settings.OUTPUT_PROFILE picks one)
+OUTPUT_PROFILES = {
+    'default': {'preload': 'auto', 'lazy_loading': False, 'defer_scripts': False},
+    'low_bandwidth': {'preload': 'metadata', 'lazy_loading': True, 'defer_scripts': True},
+    'minimal': {'preload': 'none', 'lazy_loading': True, 'defer_scripts': True},
+}
+
+def get_output_profile():
+    return OUTPUT_PROFILES[settings.OUTPUT_PROFILE]
+
+def defer_scripts(contents):
+    """ Defers external scripts that no inline script after them can depend on (deferred scripts still run in order) """
+    if contents.find(onload=True):
+        return      # Load handlers may call into the scripts before deferred ones have run
+    inline_after = False
+    for script in reversed(contents.find_all('script')):
+        if script.get('type') not in JS_TYPES:
+            continue
+        if not script.get('src'):
+            inline_after = inline_after or bool(script.string and script.string.strip())
+        elif not inline_after and not script.has_attr('async') and script.get('type') != 'module':
+            script['defer'] = 'defer'
+
+def apply_output_profile(contents):
+    profile = get_output_profile()
+    for media in contents.find_all(['audio', 'video']):
+        media['preload'] = profile['preload']
+    if profile['lazy_loading']:
+        for tag in contents.find_all(['img', 'iframe']):
+            if not tag.get('loading'):
+                tag['loading'] = 'lazy'
+    if profile['defer_scripts']:
+        defer_scripts(contents)
+
+def minify_inline_code(contents):
+    for style in contents.find_all('style'):
+        if style.string:
+            style.string = minify_css(style.string)
+    for script in contents.find_all('script'):
+        if script.string and not script.get('src') and script.get('type') in JS_TYPES:
+            script.string = minify_js(script.string)
+
+def get_render_signature(contents):
+    """ Returns the tags, attributes and whitespace-normalized text that affect how contents render """
+    signature = []
+    text = []
+    for element in contents.descendants:
+        if isinstance(element, Tag):
+            if text:
+                signature.append(' '.join(text))
+                text = []
+            attributes = {key: ' '.join(value) if isinstance(value, list) else value for key, value in element.attrs.items()}
+            signature.append((element.name, sorted(attributes.items())))
+        elif isinstance(element, NavigableString) and not isinstance(element, PreformattedString):
+            text.extend(element.split())
+    if text:
+        signature.append(' '.join(text))
+    return signature
+
+def check_serialization(contents, html):
+    """ Logs a warning if the compact html would not render the same as the prettify() output it replaces """
+    baseline = BeautifulSoup(contents.prettify(formatter="minimal"), 'html.parser')
+    if get_render_signature(baseline) != get_render_signature(BeautifulSoup(html, 'html.parser')):
+        LOGGER.warning('Compact serialization changed the rendered output of {}'.format(contents.title and contents.title.text))
+        return False
+    return True
+
+def serialize(contents):
+    """ Writes contents to an html string (compact unless settings.COMPACT_HTML is turned off) """
+    apply_output_profile(contents)
+    if settings.MINIFY_ASSETS:
+        minify_inline_code(contents)
+
+    if not settings.COMPACT_HTML:
+        return contents.prettify(formatter="minimal")
+
+    html = contents.decode(formatter="minimal")
+    if settings.VERIFY_SERIALIZATION:
+        check_serialization(contents, html)
+    return html
+
+
+######### REWRITING #########
+
+# Urls in css (url(...) values and @import strings)
+CSS_URL_REGEX = re.compile(r"""url\(\s*['"]?([^'"()]+?)['"]?\s*\)|@import\s+['"]([^'"]+)['"]""")
+
+def get_match_group(match):
+    """ Returns the index of the first group that took part in match """
+    return next(index for index in range(1, len(match.groups()) + 1) if match.group(index) is not None)
+
+def find_matches(regex, text):
+    """ Returns the first group that took part in each match of regex in text """
+    return [match.group(get_match_group(match)) for match in regex.finditer(text)]
+
+def rewrite_matches(regex, text, resolve):
+    """
+        Replaces the first group that took part in each match of regex with resolve(group)
+        in a single pass over text (matches resolved to None are left as they are)
+    """
+    def replace(match):
+        index = get_match_group(match)
+        value = resolve(match.group(index))
+        if value is None:
+            return match.group(0)
+        start, end = match.start(index) - match.start(), match.end(index) - match.start()
+        return match.group(0)[:start] + value + match.group(0)[end:]
+    return regex.sub(replace, text)
+
+
+def create_thumbnail(contents, width):
+    """ Returns a jpg of the image in contents scaled down to width """
+    from PIL import Image      # Only loaded once a page has images to scale (see import_time.LAZY_MODULES)
+    image = Image.open(io.BytesIO(contents))
+    image.thumbnail((width, width * 4))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=80, optimize=True)
+    return output.getvalue()
 
 
 def guess_scraper(url, scrapers=None, allow_default=False):
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fetch
+import settings
+import storage
+
+# Formats that are already compressed, so deflating them again only costs time
+STORED_EXTENSIONS = (
+    '.mp4', '.m4a', '.m4v', '.webm', '.ogg', '.ogv', '.mp3', '.wav',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico',
+    '.pdf', '.zip', '.swf', '.woff', '.woff2',
+)
+
+# Entry metadata is fixed so unchanged resources produce byte-identical zips (and skip upload)
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+ZIP_PERMISSIONS = 0o644 << 16
+ZIP_CREATE_SYSTEM = 3       # Unix, regardless of the platform the chef runs on
+
+# Precompressed entries are written through zipfile internals (see ZipWriter._write_deflated), which are only
+# relied on for the versions tests/test_zipper.py has checked; other versions let zipfile compress entries itself
+PRECOMPRESSED_PYTHON_VERSIONS = ((3, 8), (3, 9), (3, 10), (3, 11), (3, 12))
+
+def can_write_precompressed():
+    return sys.version_info[:2] in PRECOMPRESSED_PYTHON_VERSIONS
+
+def is_stored(filename):
+    return os.path.splitext(filename.split('?')[0])[1].lower() in STORED_EXTENSIONS
+
+def deflate(data, level):
+    """ Returns raw deflate stream and crc of data (zlib releases the GIL, so this can run in threads) """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data)
+
+
+class ZipWriter(object):
+    """
+        Drop-in replacement for ricecooker's html_writer.HTMLWriter
+        Entries are collected while scraping and written when the zip is closed:
+        already-compressed media is stored as-is (and spooled to disk rather than kept
+        in memory), everything else is deflated in a thread pool and then written in order
+
+        Output is deterministic: entries are sorted by name and written with fixed
+        timestamps and permissions, regardless of the order they were scraped in
+    """
+
+    def __init__(self, write_to_path, workers=None, compress_level=None):
+        """
+            write_to_path: string      # Where to write zip file (can be given to close instead)
+            workers: int               # Number of threads used to deflate entries
+            compress_level: int        # zlib compression level for deflated entries
+        """
+        self.write_to_path = write_to_path
+        self.workers = workers or settings.ZIP_WORKERS
+        self.compress_level = compress_level if compress_level is not None else settings.ZIP_COMPRESS_LEVEL
+        self.entries = OrderedDict()    # Maps zip path to bytes (deflated entries) or spooled file path (stored entries)
+        self.spool_directory = None
+        self.spool_count = 0            # Names of spooled files (entries can be split out, so len(self.entries) repeats)
+        self.size = 0                   # Uncompressed bytes added so far
+        self.split_media = OrderedDict()    # Maps zip paths of media moved out of the zip to where they went (see split)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Zips can be built in a worker process and written by another one (spooled files are in the shared temp directory)
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type:
+            self.discard()  # Don't write a zip for a page that failed partway
+        else:
+            self.close()
+
+    def _add_entry(self, filename, contents=None, filepath=None):
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+
+        with self.lock:
+            if filename in self.entries or filename in self.split_media:
+                return
+            if is_stored(filename):
+                # Keep large media out of memory until it's written
+                spooled_path = os.path.join(self.spool_directory, str(self.spool_count))
+                self.spool_count += 1
+                if filepath:
+                    try:
+                        os.link(filepath, spooled_path)
+                    except OSError:
+                        shutil.copyfile(filepath, spooled_path)
+                else:
+                    with open(spooled_path, 'wb') as fobj:
+                        fobj.write(contents)
+                self.entries[filename] = spooled_path
+                self.size += os.path.getsize(spooled_path)
+            else:
+                if filepath:
+                    with open(filepath, 'rb') as fobj:
+                        contents = fobj.read()
+                self.entries[filename] = contents
+                self.size += len(contents)
+
+    def _get_zip_info(self, filename):
+        zinfo = zipfile.ZipInfo(filename, date_time=ZIP_TIMESTAMP)
+        zinfo.external_attr = ZIP_PERMISSIONS
+        zinfo.create_system = ZIP_CREATE_SYSTEM
+        return zinfo
+
+    def _write_stored(self, zf, filename, filepath):
+        zinfo = self._get_zip_info(filename)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as source, zf.open(zinfo, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dest:
+            shutil.copyfileobj(source, dest, 1024 * 1024)
+
+    def _write_deflated(self, zf, filename, contents, compressed, crc):
+        zinfo = self._get_zip_info(filename)
+        if len(compressed) >= len(contents):
+            # Tiny files can grow when deflated
+            zinfo.compress_type = zipfile.ZIP_STORED
+            zf.writestr(zinfo, contents)
+            return
+
+        # zipfile can only compress entries itself, so write the precompressed
+        # entry the same way ZipFile._open_to_write + _ZipWriteFile.close do
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.file_size = len(contents)
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+        zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zinfo.compress_size > zipfile.ZIP64_LIMIT))
+        zf.fp.write(compressed)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[filename] = zinfo
+
+    def _write_compressed(self, zf, filename, contents):
+        # Fallback for python versions whose zipfile internals haven't been checked (compresses while writing)
+        zinfo = self._get_zip_info(filename)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zf.writestr(zinfo, contents, compresslevel=self.compress_level)
+
+    def _write_zip(self):
+        entries = sorted(self.entries.items())
+        precompress = can_write_precompressed()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, zipfile.ZipFile(self.write_to_path, 'w') as zf:
+            compressed = OrderedDict(
+                (filename, pool.submit(deflate, contents, self.compress_level))
+                for filename, contents in entries if precompress and isinstance(contents, bytes)
+            )
+            for filename, contents in entries:
+                if filename in compressed:
+                    self._write_deflated(zf, filename, contents, *compressed.pop(filename).result())
+                elif isinstance(contents, bytes):
+                    self._write_compressed(zf, filename, contents)
+                else:
+                    self._write_stored(zf, filename, contents)
+
+
+    """ USER-FACING METHODS """
+
+    def open(self):
+        self.spool_directory = tempfile.mkdtemp()
+
+    def close(self, write_to_path=None):
+        """ Writes the zip (to write_to_path instead of the path it was created with if given) """
+        self.write_to_path = write_to_path or self.write_to_path
+        try:
+            self._write_zip()
+        finally:
+            shutil.rmtree(self.spool_directory, ignore_errors=True)
+
+        if not self.contains('index.html'):
+            raise ReferenceError('Invalid Zip at {}: missing index.html file (use write_index_contents method)'.format(self.write_to_path))
+
+    def discard(self):
+        shutil.rmtree(self.spool_directory, ignore_errors=True)
+
+    def contains(self, filename):
+        """ Returns True if filename was added to the zip (media split out of it counts, see split) """
+        with self.lock:
+            return filename in self.entries or filename in self.split_media
+
+    def write_contents(self, filename, contents, directory=None):
+        filepath = '{}/{}'.format(directory.rstrip('/'), filename) if directory else filename
+        self._add_entry(filepath, contents=contents)
+        return filepath
+
+    def write_file(self, filepath, filename=None, directory=None):
+        arcname = None
+        if filename or directory:
+            directory = directory.rstrip('/') + '/' if directory else ''
+            filename = filename or os.path.basename(filepath)
+            arcname = '{}{}'.format(directory, filename)
+        self._add_entry(arcname or filepath, filepath=filepath)
+        return arcname or filepath
+
+    def write_url(self, url, filename, directory=None):
+        filepath = '{}/{}'.format(directory.rstrip('/'), filename) if directory else filename
+        if not self.contains(filepath):
+            self._add_entry(filepath, contents=fetch.read(url))
+        return filepath
+
+    def get_size(self, filename):
+        """ Returns the size of an entry that was added to the zip (None if there is no such entry) """
+        with self.lock:
+            contents = self.entries.get(filename)
+        if contents is None:
+            return None
+        return len(contents) if isinstance(contents, bytes) else os.path.getsize(contents)
+
+    def split(self, filename, write_to_path, **metadata):
+        """ Moves an entry out of the zip to write_to_path, recording it with metadata in split_media """
+        with self.lock:
+            contents = self.entries.pop(filename, None)
+            if contents is None:
+                return False
+            self.size -= len(contents) if isinstance(contents, bytes) else os.path.getsize(contents)
+
+        def write(temp_path):
+            if isinstance(contents, bytes):
+                with open(temp_path, 'wb') as fobj:
+                    fobj.write(contents)
+            else:
+                shutil.move(contents, temp_path)
+
+        # Other resources may have split the same file already
+        if not storage.is_complete(write_to_path):
+            os.makedirs(os.path.dirname(write_to_path), exist_ok=True)
+            storage.write_atomic(write_to_path, write)
+        with self.lock:
+            self.split_media[filename] = dict(metadata, path=write_to_path)
+        return True
+
+    def export(self, filename, write_to_path):
+        """ Copies an entry that was added to the zip to write_to_path (returns False if there is no such entry) """
+        with self.lock:
+            contents = self.entries.get(filename)
+        if contents is None:
+            return False
+        if isinstance(contents, bytes):
+            with open(write_to_path, 'wb') as fobj:
+                fobj.write(contents)
+        else:
+            shutil.copyfile(contents, write_to_path)
+        return True
+
+    def write_index_contents(self, contents):
+        return self.write_contents('index.html', contents)